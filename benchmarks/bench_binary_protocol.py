@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Bytes per location update and per-subscriber send cost, JSON vs binary frames.
+
+Replays a stream of fixes from a moving fleet and compares the JSON
+location_update frame with the binary subprotocol frame (buses/binary.py),
+each raw and with permessage-deflate. Deflate runs once per connection, with
+context takeover as browsers negotiate it by default, so its CPU cost is paid
+per subscriber. Run from the repository root:
+
+    python benchmarks/bench_binary_protocol.py
+"""
+import math
+import os
+import random
+import sys
+import time
+import zlib
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+import django
+
+django.setup()
+
+from django.utils import timezone
+
+from buses.binary import locations_frame
+from buses.broadcast import location_update_event
+from buses.models import BusLocation
+
+BUSES = 200
+UPDATES = 5000
+
+
+def sample_stream():
+    """Fixes of BUSES buses driving around Manhattan, one every few seconds each"""
+    rng = random.Random(7)
+    now = timezone.now()
+    positions = {bus_id: (40.70 + rng.random() * 0.1, -74.02 + rng.random() * 0.08, rng.uniform(0, 360))
+                 for bus_id in range(1, BUSES + 1)}
+    for sequence in range(1, UPDATES + 1):
+        bus_id = rng.randint(1, BUSES)
+        latitude, longitude, heading = positions[bus_id]
+        heading = (heading + rng.uniform(-20, 20)) % 360
+        latitude += math.cos(math.radians(heading)) * 0.0002
+        longitude += math.sin(math.radians(heading)) * 0.0002
+        positions[bus_id] = latitude, longitude, heading
+        location = BusLocation(
+            id=100000 + sequence, bus_id=bus_id, latitude=latitude, longitude=longitude,
+            speed=rng.uniform(0, 50), heading=heading, accuracy=rng.uniform(3, 15),
+            timestamp=now + timedelta(seconds=sequence / 10),
+        )
+        location.fleet_sequence = sequence
+        yield location
+
+
+def json_frame(event):
+    # What the ASGI server writes for a text frame
+    return event['text'].encode()
+
+
+def binary_frame(event):
+    return locations_frame([event['packed']])
+
+
+def measure(events, build, deflate):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS) if deflate else None
+    total = 0
+    started = time.perf_counter()
+    for event in events:
+        frame = build(event)
+        if compressor is not None:
+            # permessage-deflate strips the trailing 00 00 ff ff of each sync flush
+            frame = (compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        total += len(frame)
+    elapsed = time.perf_counter() - started
+    return total / len(events), elapsed / len(events)
+
+
+def main():
+    events = [location_update_event(location) for location in sample_stream()]
+
+    print(f'{UPDATES} single-fix frames from {BUSES} buses')
+    print(f"{'encoding':>16} {'bytes/update':>13} {'us/subscriber/update':>21}")
+    for label, build, deflate in (
+        ('json', json_frame, False),
+        ('json + deflate', json_frame, True),
+        ('binary', binary_frame, False),
+        ('binary + deflate', binary_frame, True),
+    ):
+        size, cost = measure(events, build, deflate)
+        print(f'{label:>16} {size:>13.1f} {cost * 1e6:>21.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Insert and serialization throughput of Decimal vs float coordinate storage.
+
+Builds two throwaway tables in an in-memory SQLite database, one with the old
+DecimalField(10/11, 8) coordinates and one with the current FloatField ones,
+bulk inserts the same fixes into both and then reads them back through a
+ModelSerializer shaped like BusLocationSerializer. Run from the repository root:
+
+    python benchmarks/bench_coordinates.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+from django.conf import settings
+
+# Never touch the real database
+settings.DATABASES['default']['NAME'] = ':memory:'
+
+import django
+
+django.setup()
+
+from decimal import Decimal
+
+from django.db import connection, models
+from django.utils import timezone
+from rest_framework import serializers
+
+BATCH_SIZE = 5000
+READ_CHUNK_SIZE = 5000
+
+
+class DecimalFix(models.Model):
+    latitude = models.DecimalField(max_digits=10, decimal_places=8)
+    longitude = models.DecimalField(max_digits=11, decimal_places=8)
+    speed = models.FloatField(default=0.0)
+    heading = models.FloatField(null=True)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        app_label = 'buses'
+        db_table = 'bench_decimal_fix'
+
+
+class FloatFix(models.Model):
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    speed = models.FloatField(default=0.0)
+    heading = models.FloatField(null=True)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        app_label = 'buses'
+        db_table = 'bench_float_fix'
+
+
+class DecimalFixSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DecimalFix
+        fields = ['id', 'latitude', 'longitude', 'speed', 'heading', 'timestamp']
+
+
+class FloatFixSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FloatFix
+        fields = ['id', 'latitude', 'longitude', 'speed', 'heading', 'timestamp']
+
+
+def sample_fixes(rows):
+    now = timezone.now()
+    rng = random.Random(42)
+    for _ in range(rows):
+        yield (
+            40.7 + rng.random() * 0.2,
+            -74.0 + rng.random() * 0.2,
+            rng.uniform(0, 60),
+            rng.uniform(0, 360),
+            now,
+        )
+
+
+def bench_insert(model, rows, decimal_coordinates):
+    started = time.perf_counter()
+    batch = []
+    for lat, lng, speed, heading, timestamp in sample_fixes(rows):
+        if decimal_coordinates:
+            # What the old API path did: validated Decimal quantized to 8 places
+            lat, lng = Decimal(f'{lat:.8f}'), Decimal(f'{lng:.8f}')
+        batch.append(model(latitude=lat, longitude=lng, speed=speed, heading=heading, timestamp=timestamp))
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+    return rows / (time.perf_counter() - started)
+
+
+def bench_serialize(model, serializer_class, rows):
+    started = time.perf_counter()
+    serializer = serializer_class()
+    for instance in model.objects.order_by('id').iterator(chunk_size=READ_CHUNK_SIZE):
+        serializer.to_representation(instance)
+    return rows / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with connection.schema_editor() as editor:
+        editor.create_model(DecimalFix)
+        editor.create_model(FloatFix)
+
+    print(f'{args.rows} rows, in-memory SQLite')
+    print(f"{'storage':>8} {'insert rows/s':>14} {'serialize rows/s':>17}")
+    for label, model, serializer_class, decimal_coordinates in (
+        ('decimal', DecimalFix, DecimalFixSerializer, True),
+        ('float', FloatFix, FloatFixSerializer, False),
+    ):
+        inserted = bench_insert(model, args.rows, decimal_coordinates)
+        serialized = bench_serialize(model, serializer_class, args.rows)
+        print(f'{label:>8} {inserted:>14,.0f} {serialized:>17,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Per-message CPU cost of fanning one location update out to N subscribers.
+
+Compares the old handler (json.dumps of the event dict in every subscriber)
+with the current one (every subscriber forwards the frame encoded once by the
+broadcaster). Runs against a throwaway SQLite database. Run from the
+repository root:
+
+    python benchmarks/bench_fanout.py
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+from django.conf import settings
+
+# Never touch the real database
+DATABASE_DIR = tempfile.TemporaryDirectory(prefix='bus-fanout-')
+settings.DATABASES['default']['NAME'] = os.path.join(DATABASE_DIR.name, 'fanout.sqlite3')
+
+import django
+
+django.setup()
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from buses.broadcast import location_update_event
+from buses.consumers import RouteTrackingConsumer
+from buses.models import BusLocation
+from buses.motion import locations_motion
+from buses.serializers import BusLocationSerializer
+
+SUBSCRIBER_COUNTS = [1, 10, 100, 1000, 5000]
+MESSAGES = 200
+
+
+class Subscriber(RouteTrackingConsumer):
+    """Consumer whose socket just counts bytes"""
+
+    def __init__(self):
+        super().__init__()
+        self.bytes_sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.bytes_sent += len(text_data)
+
+
+class LegacySubscriber(Subscriber):
+    """Consumer with the per-subscriber json.dumps handler used before pre-encoding"""
+
+    async def bus_location_update(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'location_update',
+            'bus_id': event['bus_id'],
+            'location': event['location']
+        }))
+
+
+def sample_locations(count):
+    """Fresh unsaved fixes, so no build reuses what an earlier one cached on its instance"""
+    now = timezone.now()
+    locations = [
+        BusLocation(
+            id=number + 1, bus_id=42, latitude=40.7589, longitude=-73.9851,
+            speed=32.5, heading=181.0, accuracy=4.2, timestamp=now,
+        )
+        for number in range(count)
+    ]
+    # The fleet state receiver works out motion before the broadcast; keep it out of the timing
+    locations_motion(locations)
+    return locations
+
+
+async def fan_out(subscribers, event):
+    for subscriber in subscribers:
+        await subscriber.bus_location_update(event)
+
+
+def measure(subscriber_class, event, count):
+    subscribers = [subscriber_class() for _ in range(count)]
+    loop = asyncio.new_event_loop()
+    try:
+        started = time.process_time()
+        for _ in range(MESSAGES):
+            loop.run_until_complete(fan_out(subscribers, event))
+        elapsed = time.process_time() - started
+    finally:
+        loop.close()
+    return elapsed / MESSAGES
+
+
+def legacy_event(location):
+    return {
+        'type': 'bus_location_update',
+        'bus_id': location.bus_id,
+        'bus_number': 'B42',
+        'location': BusLocationSerializer(location).data,
+    }
+
+
+def build_cost(build):
+    """Average CPU seconds the broadcaster spends building one event"""
+    build(sample_locations(1)[0])
+    locations = sample_locations(MESSAGES)
+    started = time.process_time()
+    for location in locations:
+        build(location)
+    return (time.process_time() - started) / MESSAGES
+
+
+def main():
+    call_command('migrate', verbosity=0)
+    legacy_build = build_cost(legacy_event)
+    encoded_build = build_cost(location_update_event)
+    location = sample_locations(1)[0]
+
+    print(f"{'subscribers':>11} {'legacy ms/msg':>14} {'pre-encoded ms/msg':>19} {'speedup':>8}")
+    for count in SUBSCRIBER_COUNTS:
+        legacy = measure(LegacySubscriber, legacy_event(location), count) + legacy_build
+        encoded = measure(Subscriber, location_update_event(location), count) + encoded_build
+        print(f"{count:>11} {legacy * 1000:>14.3f} {encoded * 1000:>19.3f} {legacy / encoded:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
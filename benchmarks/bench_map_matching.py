@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Map matching throughput: NumPy batch projection vs. the pure Python grid path.
+
+Builds a synthetic winding route shape and matches noisy fixes along it the way
+batch ingest does (one call for the whole batch). No database involved. Run
+from the repository root:
+
+    python benchmarks/bench_map_matching.py --shape-points 3000 --fixes 10000
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+import django
+
+django.setup()
+
+from buses import mapmatch
+from buses.geo import METERS_PER_DEGREE_LAT
+
+
+def winding_shape(count, spacing_m=10.0):
+    """A route wandering north-east with gentle turns, one point every spacing_m"""
+    rng = random.Random(7)
+    lat, lng, heading = 40.70, -74.00, 45.0
+    points = [(lat, lng)]
+    for _ in range(count - 1):
+        heading += rng.uniform(-8, 8)
+        lat += spacing_m * math.cos(math.radians(heading)) / METERS_PER_DEGREE_LAT
+        lng += spacing_m * math.sin(math.radians(heading)) / (METERS_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+        points.append((lat, lng))
+    return points
+
+
+def noisy_fixes(shape, count, noise_m):
+    rng = random.Random(11)
+    fixes = []
+    for _ in range(count):
+        lat, lng = shape[rng.randrange(len(shape))]
+        fixes.append((lat + rng.gauss(0, noise_m) / METERS_PER_DEGREE_LAT,
+                      lng + rng.gauss(0, noise_m) / (METERS_PER_DEGREE_LAT * math.cos(math.radians(lat)))))
+    return fixes
+
+
+def run(label, shape, fixes, max_offset, repeat):
+    index = mapmatch.ShapeIndex(shape)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        matches = index.match(fixes, max_offset)
+        best = min(best, time.perf_counter() - started)
+    matched = sum(match is not None for match in matches)
+    print(f'{label:8} {len(fixes) / best:12,.0f} fixes/s  ({best * 1000:8.1f} ms per batch, {matched} matched)')
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shape-points', type=int, default=3000, help='Points in the route shape')
+    parser.add_argument('--fixes', type=int, default=10000, help='Fixes matched per batch')
+    parser.add_argument('--noise', type=float, default=8.0, help='GPS noise in meters (standard deviation)')
+    parser.add_argument('--max-offset', type=float, default=50.0, help='BUS_MAP_MATCH_MAX_OFFSET_M')
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+
+    shape = winding_shape(options.shape_points)
+    fixes = noisy_fixes(shape, options.fixes, options.noise)
+    print(f'{options.fixes} fixes onto a {options.shape_points}-point shape')
+
+    numpy_matches = None
+    if mapmatch.numpy is not None:
+        numpy_matches = run('numpy', shape, fixes, options.max_offset, options.repeat)
+    else:
+        print('numpy    not installed')
+
+    numpy_module, mapmatch.numpy = mapmatch.numpy, None
+    try:
+        python_matches = run('python', shape, fixes, options.max_offset, options.repeat)
+    finally:
+        mapmatch.numpy = numpy_module
+
+    if numpy_matches is not None:
+        disagreements = sum(
+            (a is None) != (b is None) or (a is not None and abs(a[2] - b[2]) > 0.5)
+            for a, b in zip(numpy_matches, python_matches)
+        )
+        print(f'paths disagree on {disagreements} fixes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Cross-process fan-out through a Redis-compatible channel layer.
+
+Starts N worker processes, each hosting --clients route subscribers (the real
+RouteTrackingConsumer behind the ASGI router, minus its database query), and
+publishes location updates from this process. Every update must reach every
+subscriber in every worker; the end-to-end latency from group_send to the frame
+leaving the consumer is reported. Without --redis-url an in-process fakeredis
+server (see `manage.py run_local_redis`) stands in for Redis. Run from the
+repository root:
+
+    python benchmarks/bench_multiprocess_fanout.py --workers 4 --clients 50
+    python benchmarks/bench_multiprocess_fanout.py --redis-url redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+STAND_IN_ADDRESS = ('127.0.0.1', 16379)
+ROUTE_ID = 'bench'
+
+
+def setup_django(redis_url):
+    # Must happen before settings are read so CHANNEL_LAYERS picks Redis
+    os.environ['REDIS_URL'] = redis_url
+    import django
+
+    django.setup()
+
+
+def worker(redis_url, clients, messages, ready, results):
+    setup_django(redis_url)
+
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+    from django.urls import re_path
+
+    from buses.consumers import RouteTrackingConsumer
+
+    class Subscriber(RouteTrackingConsumer):
+        async def get_route_buses_data(self):
+            return '[]'
+
+    application = URLRouter([re_path(r'ws/route/(?P<route_id>\w+)/$', Subscriber.as_asgi())])
+
+    async def run():
+        communicators = []
+        for _ in range(clients):
+            communicator = WebsocketCommunicator(application, f'/ws/route/{ROUTE_ID}/')
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_json_from()  # initial_data
+            communicators.append(communicator)
+        ready.put(os.getpid())
+
+        async def collect(communicator):
+            latencies = []
+            for _ in range(messages):
+                try:
+                    text = await communicator.receive_from(timeout=10)
+                except asyncio.TimeoutError:
+                    break
+                received_at = time.time()
+                latencies.append(received_at - json.loads(text)['location']['sent_at'])
+            return latencies
+
+        per_client = await asyncio.gather(*(collect(communicator) for communicator in communicators))
+        for communicator in communicators:
+            await communicator.disconnect()
+        results.put([latency for latencies in per_client for latency in latencies])
+
+    asyncio.run(run())
+
+
+async def publish(messages, rate):
+    from channels.layers import get_channel_layer
+
+    from buses.broadcast import location_update_frame
+
+    channel_layer = get_channel_layer()
+    interval = 1 / rate if rate else 0
+    for sequence in range(messages):
+        update = json.dumps({'bus_id': sequence % 100, 'location': {'sequence': sequence, 'sent_at': time.time()}})
+        await channel_layer.group_send(f'route_{ROUTE_ID}', {
+            'type': 'bus_location_update',
+            'bus_id': sequence % 100,
+            'latitude': 0.0,
+            'longitude': 0.0,
+            'update': update,
+            'text': location_update_frame(update),
+        })
+        if interval:
+            await asyncio.sleep(interval)
+
+
+def start_stand_in():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(STAND_IN_ADDRESS, server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'redis://%s:%d/0' % STAND_IN_ADDRESS
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='ASGI worker processes')
+    parser.add_argument('--clients', type=int, default=25, help='WebSocket subscribers per worker')
+    parser.add_argument('--messages', type=int, default=200, help='Updates to publish')
+    parser.add_argument('--rate', type=float, default=100.0, help='Updates per second, 0 for as fast as possible')
+    parser.add_argument('--redis-url', help='Use a real Redis instead of the in-process stand-in')
+    args = parser.parse_args()
+
+    redis_url = args.redis_url or start_stand_in()
+    setup_django(redis_url)
+
+    from django.conf import settings
+
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=worker, args=(redis_url, args.clients, args.messages, ready, results))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get(timeout=60)
+
+    started = time.perf_counter()
+    asyncio.run(publish(args.messages, args.rate))
+    latencies = []
+    for _ in processes:
+        latencies.extend(results.get(timeout=60))
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    expected = args.workers * args.clients * args.messages
+    print(f"{settings.CHANNEL_LAYERS['default']['BACKEND']} at {redis_url}")
+    print(f'{args.workers} workers x {args.clients} clients, {args.messages} updates at '
+          f'{args.rate or "max"}/s: delivered {len(latencies)}/{expected} frames in {elapsed:.2f}s')
+    if latencies:
+        latencies.sort()
+        print('latency ms: p50 %.2f  p95 %.2f  p99 %.2f  max %.2f  mean %.2f' % (
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            latencies[-1] * 1000,
+            statistics.fmean(latencies) * 1000,
+        ))
+    sys.exit(0 if len(latencies) == expected else 1)
+
+
+if __name__ == '__main__':
+    main()
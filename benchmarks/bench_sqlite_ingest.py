@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""SQLite ingest throughput: default configuration vs. the high-ingest mode.
+
+--threads request threads store --fixes fixes between them against a fresh
+file database, the way concurrent update_location requests do:
+
+  default  rollback journal, deferred transactions, one commit per fix (SQLite's
+           defaults, used unless BUS_SQLITE_HIGH_INGEST is set)
+  tuned    BUS_SQLITE_HIGH_INGEST: BUS_SQLITE_PRAGMAS (WAL) and IMMEDIATE transactions,
+           one commit per fix
+  group    tuned, and every fix goes through the single ingest writer, which
+           stores whatever is pending in one transaction (BUS_INGEST_MODE = 'group')
+
+Each mode runs in its own process so connection settings can't leak between
+them. Fixes that fail (e.g. "database is locked") are counted, not retried.
+Run from the repository root:
+
+    python benchmarks/bench_sqlite_ingest.py --threads 32 --fixes 5000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+MODES = ('default', 'tuned', 'group')
+
+
+def setup_django(mode, database):
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = database
+    # The high-ingest mode is opt-in; switch it on or off regardless of the environment
+    settings.BUS_SQLITE_HIGH_INGEST = mode != 'default'
+    settings.DATABASES['default']['OPTIONS'] = (
+        {} if mode == 'default' else {'transaction_mode': 'IMMEDIATE', 'timeout': 20}
+    )
+
+    import django
+
+    django.setup()
+
+
+def run(mode, threads, fixes, buses, results):
+    directory = tempfile.TemporaryDirectory(prefix='bus-sqlite-bench-')
+    setup_django(mode, os.path.join(directory.name, 'bench.sqlite3'))
+
+    from django.core.management import call_command
+    from django.db import connection
+    from django.utils import timezone
+
+    from buses.ingest import IngestQueue
+    from buses.models import Bus, BusLocation, Route
+
+    call_command('migrate', verbosity=0)
+    route = Route.objects.create(route_number='bench', name='Bench route')
+    bus_ids = [bus.id for bus in Bus.objects.bulk_create(
+        Bus(bus_number=f'S{number}', license_plate=f'SQ-{number}', route=route) for number in range(buses)
+    )]
+    journal_mode = connection.cursor().execute('PRAGMA journal_mode').fetchone()[0]
+    connection.close()
+
+    queue = None
+    if mode == 'group':
+        queue = IngestQueue(max_size=fixes, batch_size=500, flush_interval=0,
+                            writer=BusLocation.objects.bulk_record)
+
+    latencies = []
+    failures = []
+
+    def post(worker):
+        from django.db import connection
+
+        for number in range(worker, fixes, threads):
+            location = dict(bus_id=bus_ids[number % buses], latitude=40.7 + number / 1e6,
+                            longitude=-74.0, speed=20.0, timestamp=timezone.now())
+            started = time.perf_counter()
+            try:
+                if queue is not None:
+                    queue.submit([BusLocation(**location)]).result()
+                else:
+                    BusLocation.objects.create(**location)
+            except Exception as exc:
+                failures.append(type(exc).__name__)
+            else:
+                latencies.append(time.perf_counter() - started)
+        connection.close()
+
+    workers = [threading.Thread(target=post, args=(worker,)) for worker in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    if queue is not None:
+        queue.stop()
+
+    latencies.sort()
+    results.put({
+        'mode': mode,
+        'journal_mode': journal_mode,
+        'stored': BusLocation.objects.count(),
+        'failed': len(failures),
+        'elapsed': elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0.0,
+    })
+    connection.close()
+    directory.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32, help='Concurrent writer threads')
+    parser.add_argument('--fixes', type=int, default=5000, help='Fixes stored per mode')
+    parser.add_argument('--buses', type=int, default=200, help='Buses the fixes are spread over')
+    parser.add_argument('--mode', choices=MODES, action='append', help='Modes to run (default: all)')
+    options = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f'{options.fixes} fixes from {options.threads} threads over {options.buses} buses')
+    for mode in options.mode or MODES:
+        results = context.Queue()
+        process = context.Process(target=run, args=(mode, options.threads, options.fixes, options.buses, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f"{result['mode']:8} journal {result['journal_mode']:8} "
+              f"{result['stored'] / result['elapsed']:8.0f} fixes/s  "
+              f"stored {result['stored']:6}  failed {result['failed']:5}  "
+              f"p50 {result['p50']:7.1f} ms  p99 {result['p99']:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
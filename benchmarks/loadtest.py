@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Load test for location ingest and WebSocket fan-out against the in-process ASGI app.
+
+Simulates --buses buses posting fixes concurrently (at most --concurrency
+requests in flight) while --subscribers WebSocket clients listen, all in one
+asyncio loop driving bus_tracking_backend.asgi.application directly: no
+network, no external server. Runs against a throwaway SQLite database and
+reports ingest throughput, HTTP latency percentiles, end-to-end broadcast
+latency (POST sent -> frame received by a subscriber) and database queries.
+
+Each fix carries its request number in ``accuracy`` so subscribers can match
+the frames they receive to the request that produced them. Fixes are random
+points, so the GPS filter is off unless --gps-filter is given.
+
+    python benchmarks/loadtest.py --buses 2000 --subscribers 2000
+    python benchmarks/loadtest.py --endpoint batch --batch-size 200
+    python benchmarks/loadtest.py --max-p99-ms 250 --min-rps 300   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tracking_backend.settings')
+
+from django.conf import settings
+
+# Never touch the real database
+DATABASE_DIR = tempfile.TemporaryDirectory(prefix='bus-loadtest-')
+settings.DATABASES['default']['NAME'] = os.path.join(DATABASE_DIR.name, 'loadtest.sqlite3')
+
+import django
+
+django.setup()
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from bus_tracking_backend.asgi import application
+from buses.models import Bus, Route
+
+HEADERS = [(b'host', b'localhost'), (b'content-type', b'application/json')]
+ROUTES = 20
+
+
+class QueryCounter:
+    """Counts queries on every database connection, whichever thread opened it"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        connection_created.connect(self.install)
+        self.install(connection=connection)
+
+    def install(self, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def create_fleet(bus_count):
+    call_command('migrate', verbosity=0)
+    routes = Route.objects.bulk_create(
+        Route(route_number=f'L{number}', name=f'Load route {number}') for number in range(ROUTES)
+    )
+    return list(Bus.objects.bulk_create(
+        Bus(bus_number=f'L{number}', license_plate=f'LT-{number}', route=routes[number % ROUTES])
+        for number in range(bus_count)
+    ))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    pick = lambda fraction: values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+    return f'p50 {pick(0.50):.1f}  p99 {pick(0.99):.1f}  max {values[-1] * 1000:.1f}'
+
+
+class LoadTest:
+    def __init__(self, options, buses):
+        self.options = options
+        self.buses = buses
+        self.sent_at = {}
+        self.http_latencies = []
+        self.broadcast_latencies = []
+        self.statuses = {}
+        self.fixes = 0
+        self.rng = random.Random(1)
+
+    def fix(self, bus, tag):
+        return {
+            'latitude': 40.70 + self.rng.random() * 0.1,
+            'longitude': -74.02 + self.rng.random() * 0.08,
+            'speed': self.rng.uniform(0, 50),
+            'heading': self.rng.uniform(0, 360),
+            'accuracy': float(tag),
+        }
+
+    def requests(self):
+        """Yield (path, body, tags) for every request of the run, buses interleaved"""
+        tag = 0
+        if self.options.endpoint in ('single', 'async'):
+            path = '/api/ingest/buses/{}/location/' if self.options.endpoint == 'async' else '/api/buses/{}/update_location/'
+            for _ in range(self.options.fixes_per_bus):
+                for bus in self.buses:
+                    tag += 1
+                    yield path.format(bus.id), self.fix(bus, tag), [tag]
+        else:
+            batch = []
+            for _ in range(self.options.fixes_per_bus):
+                for bus in self.buses:
+                    tag += 1
+                    fix = self.fix(bus, tag)
+                    batch.append({'bus_id': bus.id, 'lat': fix.pop('latitude'), 'lng': fix.pop('longitude'), **fix})
+                    if len(batch) == self.options.batch_size:
+                        yield '/api/buses/batch_update_locations/', batch, [int(item['accuracy']) for item in batch]
+                        batch = []
+            if batch:
+                yield '/api/buses/batch_update_locations/', batch, [int(item['accuracy']) for item in batch]
+
+    async def post(self, semaphore, path, body, tags):
+        async with semaphore:
+            body = json.dumps(body).encode()
+            headers = HEADERS + [(b'content-length', str(len(body)).encode())]
+            communicator = HttpCommunicator(application, 'POST', path, body, headers)
+            started = time.perf_counter()
+            for tag in tags:
+                self.sent_at[tag] = started
+            response = await communicator.get_response(timeout=120)
+            self.http_latencies.append(time.perf_counter() - started)
+            # Let Django's handler see the client go away and finish
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(timeout=120)
+            self.statuses[response['status']] = self.statuses.get(response['status'], 0) + 1
+            self.fixes += len(tags)
+
+    async def subscribe(self, path, ready):
+        communicator = WebsocketCommunicator(application, path, headers=[(b'host', b'localhost')])
+        connected, _ = await communicator.connect(timeout=30)
+        assert connected, path
+        await communicator.receive_from(timeout=30)  # initial_data
+        ready.release()
+        try:
+            while True:
+                message = json.loads(await communicator.receive_from(timeout=3600))
+                received = time.perf_counter()
+                if message['type'] == 'location_update':
+                    updates = [message]
+                elif message['type'] == 'locations_batch':
+                    updates = message['updates']
+                else:
+                    continue
+                for update in updates:
+                    sent = self.sent_at.get(int(update['location']['accuracy'] or 0))
+                    if sent is not None:
+                        self.broadcast_latencies.append(received - sent)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            with contextlib.suppress(Exception):
+                await communicator.disconnect()
+
+    async def run(self):
+        options = self.options
+        ready = asyncio.Semaphore(0)
+        if options.subscribe == 'fleet':
+            paths = ['/ws/buses/'] * options.subscribers
+        else:
+            route_ids = sorted({bus.route_id for bus in self.buses})
+            paths = [f'/ws/route/{route_ids[number % len(route_ids)]}/' for number in range(options.subscribers)]
+        subscribers = [asyncio.ensure_future(self.subscribe(path, ready)) for path in paths]
+        for _ in subscribers:
+            await ready.acquire()
+
+        semaphore = asyncio.Semaphore(options.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.post(semaphore, *request) for request in self.requests()))
+        elapsed = time.perf_counter() - started
+
+        # Let the last broadcasts (and coalescing windows) drain
+        await asyncio.sleep(options.drain)
+        for subscriber in subscribers:
+            subscriber.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+        return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buses', type=int, default=1000, help='Simulated buses')
+    parser.add_argument('--fixes-per-bus', type=int, default=3, help='Fixes each bus posts')
+    parser.add_argument('--concurrency', type=int, default=200, help='Requests in flight at once')
+    parser.add_argument('--subscribers', type=int, default=1000, help='WebSocket clients')
+    parser.add_argument('--subscribe', choices=['route', 'fleet'], default='route',
+                        help='Subscribe to ws/route/<id>/ (spread over routes) or ws/buses/')
+    parser.add_argument('--endpoint', choices=['single', 'async', 'batch'], default='single',
+                        help='POST update_location per fix, the async ingest view per fix, or batch_update_locations')
+    parser.add_argument('--batch-size', type=int, default=100, help='Fixes per batch request')
+    parser.add_argument('--ingest-mode', choices=['sync', 'queued', 'group'], help='Override BUS_INGEST_MODE')
+    parser.add_argument('--gps-filter', action='store_true', help='Keep the GPS filter (BUS_GPS_FILTER) on')
+    parser.add_argument('--drain', type=float, default=1.0, help='Seconds to wait for broadcasts after the last POST')
+    parser.add_argument('--max-p99-ms', type=float, help='Fail if HTTP p99 latency exceeds this')
+    parser.add_argument('--min-rps', type=float, help='Fail if ingest requests per second drop below this')
+    options = parser.parse_args()
+
+    if options.ingest_mode:
+        settings.BUS_INGEST_MODE = options.ingest_mode
+    settings.BUS_GPS_FILTER = options.gps_filter
+
+    buses = create_fleet(options.buses)
+    queries = QueryCounter()
+    load_test = LoadTest(options, buses)
+
+    # Django logs every failed request; keep the report readable,
+    # failures show up in the status counts
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed = asyncio.run(load_test.run())
+
+    requests = len(load_test.http_latencies)
+    rps = requests / elapsed
+    http_p99 = sorted(load_test.http_latencies)[min(requests - 1, int(requests * 0.99))] * 1000
+    print(f'{options.buses} buses, {options.subscribers} {options.subscribe} subscribers, '
+          f'{options.endpoint} endpoint, concurrency {options.concurrency}, '
+          f'ingest mode {getattr(settings, "BUS_INGEST_MODE", "sync")}')
+    print(f'ingest:    {requests} requests / {load_test.fixes} fixes in {elapsed:.2f}s = '
+          f'{rps:.0f} req/s, {load_test.fixes / elapsed:.0f} fixes/s, statuses {load_test.statuses}')
+    print(f'http ms:   {percentiles(load_test.http_latencies)}')
+    print(f'broadcast: {len(load_test.broadcast_latencies)} updates delivered, '
+          f'ms {percentiles(load_test.broadcast_latencies)}')
+    print(f'database:  {queries.count} queries, {queries.count / requests:.1f} per request')
+
+    failures = []
+    if options.max_p99_ms is not None and http_p99 > options.max_p99_ms:
+        failures.append(f'HTTP p99 {http_p99:.1f} ms > {options.max_p99_ms} ms')
+    if options.min_rps is not None and rps < options.min_rps:
+        failures.append(f'{rps:.0f} req/s < {options.min_rps} req/s')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
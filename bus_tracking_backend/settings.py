@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'buses.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -77,12 +79,37 @@ WSGI_APPLICATION = 'bus_tracking_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Opt-in high-ingest mode for deployments that stay on SQLite: WAL and the
+# pragmas below on every connection, and IMMEDIATE write transactions. Pair it
+# with BUS_INGEST_MODE = 'group'. Enable with BUS_SQLITE_HIGH_INGEST=1.
+BUS_SQLITE_HIGH_INGEST = os.environ.get('BUS_SQLITE_HIGH_INGEST', '').lower() in ('1', 'true', 'yes')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+if BUS_SQLITE_HIGH_INGEST:
+    DATABASES['default']['OPTIONS'] = {
+        # Write transactions take the database lock when they begin and wait
+        # up to `timeout` seconds for it, instead of failing with "database is
+        # locked" when two transactions try to upgrade their read locks at once
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': 20,
+    }
+
+# Pragmas run on every new SQLite connection in high-ingest mode (buses/sqlite.py). WAL lets readers
+# carry on while fixes are written; synchronous=NORMAL only syncs at checkpoints,
+# so a power cut may lose the last commits but never corrupts the database.
+BUS_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -20000,  # KiB
+    'mmap_size': 128 * 1024 * 1024,
+    'wal_autocheckpoint': 1000,  # pages
+}
 
 
 # Password validation
@@ -148,8 +175,97 @@ REST_FRAMEWORK = {
 # Channels configuration for WebSockets
 ASGI_APPLICATION = 'bus_tracking_backend.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
+# Channel layer
+# Without REDIS_URL each process keeps its own in-memory layer, so a broadcast
+# only reaches clients of the process that sent it: run a single ASGI worker.
+# With REDIS_URL every worker shares groups through Redis. The pub/sub layer is
+# the default because location updates are fire-and-forget; set
+# CHANNEL_LAYER_BACKEND=channels_redis.core.RedisChannelLayer for the
+# list-based layer. `python manage.py run_local_redis` serves a Redis-compatible
+# stand-in for development and load tests.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': os.environ.get('CHANNEL_LAYER_BACKEND', 'channels_redis.pubsub.RedisPubSubChannelLayer'),
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Location ingest
+# 'sync' writes and broadcasts each fix before responding (201); 'queued' responds
+# with 202 and lets a background writer flush fixes in micro-batches, answering
+# 429 once BUS_INGEST_QUEUE_SIZE fixes are waiting. 'group' keeps the 201 of
+# 'sync' but hands fixes to the same single writer and waits for the transaction
+# that stores them, so concurrent requests share commits instead of queueing
+# for the SQLite write lock.
+BUS_INGEST_MODE = 'sync'
+BUS_INGEST_QUEUE_SIZE = 10000
+BUS_INGEST_BATCH_SIZE = 500
+BUS_INGEST_FLUSH_INTERVAL = 0.2  # seconds
+BUS_INGEST_COMMIT_TIMEOUT = 10  # seconds a 'group' request waits for its commit before a 503
+
+# GPS filter applied to every fix before it is stored (buses/gpsfilter.py)
+BUS_GPS_FILTER = True
+BUS_GPS_MIN_MOVE_M = 10  # smaller moves since the last stored fix are dropped...
+BUS_GPS_HEARTBEAT_SECONDS = 60  # ...except one fix per interval, stored but not broadcast
+BUS_GPS_MAX_SPEED_KMH = 130  # fixes implying a faster move are rejected as jumps
+BUS_GPS_MAX_JUMPS = 3  # this many jumps in a row restart the bus's track instead
+BUS_GPS_KALMAN = False  # store Kalman-smoothed positions instead of raw fixes
+BUS_GPS_KALMAN_PROCESS_NOISE = 1.0  # m^2/s^3; higher follows turns and stops faster
+BUS_GPS_DEFAULT_ACCURACY_M = 10  # for fixes without a reported accuracy
+
+# Map matching of fixes onto route shapes (buses/mapmatch.py)
+BUS_MAP_MATCH = True
+BUS_MAP_MATCH_MAX_OFFSET_M = 50  # fixes further from the shape are left unmatched
+# Shapes are reloaded after this many seconds to pick up imports by other processes
+BUS_MAP_MATCH_SHAPE_MAX_AGE = 300
+
+# Rows per bulk_create chunk and transaction in python manage.py import_gtfs
+BUS_GTFS_IMPORT_CHUNK = 2000
+
+# Spatial grid used for bounding-box WebSocket subscriptions
+BUS_GRID_CELL_DEGREES = 0.01  # roughly 1.1 km of latitude per cell
+BUS_BBOX_MAX_CELLS = 64  # larger boxes fall back to the global group
+
+# In-memory spatial indexes behind the nearby endpoints are rebuilt from the
+# database after this many seconds to pick up fixes written by other processes
+BUS_SPATIAL_INDEX_MAX_AGE = 30
+
+# Fleet and per-route tracking snapshots (/api/buses/tracking/, route buses,
+# WebSocket initial data) are shared by every request and connection, patched
+# as fixes are recorded and rebuilt from the database at most this often (seconds)
+BUS_FLEET_SNAPSHOT_MAX_AGE = 5
+BUS_FLEET_SNAPSHOT_CACHE_SIZE = 64  # snapshots kept per process, least recently used dropped first
+# Name of a Django cache to share rebuilt snapshots between worker processes
+BUS_FLEET_SNAPSHOT_CACHE = None
+
+# Dead reckoning sent with every location update (buses/motion.py)
+BUS_MOTION_HORIZON = 30  # seconds of predicted positions after each fix
+BUS_MOTION_STEP = 5  # seconds between predicted positions
+BUS_MOTION_MAX_GAP = 60  # older previous fixes are not used for speed, heading or turn rate
+BUS_MOTION_MIN_SPEED = 0.5  # m/s; slower buses are treated as standing
+BUS_MOTION_MAX_TURN_DEG = 90  # total turn a prediction may make
+
+# Stop arrival predictions
+BUS_ETA_DEFAULT_SPEED_KMH = 20  # used until a bus has shown progress along its route
+BUS_ETA_MAX_OFF_ROUTE_M = 300  # fixes further than this from the route get no ETAs
+BUS_ETA_MAX_FIX_AGE = 300  # seconds before a prediction is considered stale
+BUS_ETA_ROUTE_MAX_AGE = 300  # seconds before a route's stops are reloaded from the database
+
+# Location history retention (python manage.py prune_locations, or
+# buses.retention.run_retention() from a scheduler)
+BUS_LOCATION_RAW_DAYS = 7  # every fix is kept this long
+BUS_LOCATION_DOWNSAMPLE_SECONDS = 60  # then one fix per bus per interval
+BUS_LOCATION_KEEP_DAYS = 90  # then rows are removed; archives stay on disk
+BUS_LOCATION_ARCHIVE_DIR = BASE_DIR / 'location_archive'
+BUS_LOCATION_DELETE_CHUNK = 2000
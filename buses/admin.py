@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Route, Bus, BusLocation, RouteStop
+from .models import Route, Bus, BusLocation, RouteShape, RouteStop
 
 
 @admin.register(Route)
@@ -28,7 +28,7 @@ class BusAdmin(admin.ModelAdmin):
 
 @admin.register(BusLocation)
 class BusLocationAdmin(admin.ModelAdmin):
-    list_display = ['bus', 'latitude', 'longitude', 'speed', 'timestamp']
+    list_display = ['bus', 'latitude', 'longitude', 'distance_along_route', 'speed', 'timestamp']
     list_filter = ['bus', 'timestamp']
     search_fields = ['bus__bus_number']
     readonly_fields = ['created_at']
@@ -47,3 +47,10 @@ class RouteStopAdmin(admin.ModelAdmin):
     list_filter = ['route', 'is_active']
     search_fields = ['stop_name', 'route__route_number']
     ordering = ['route', 'stop_order']
+
+
+@admin.register(RouteShape)
+class RouteShapeAdmin(admin.ModelAdmin):
+    list_display = ['route', 'shape_id', 'length_m', 'updated_at']
+    search_fields = ['route__route_number', 'shape_id']
+    readonly_fields = ['length_m', 'updated_at']
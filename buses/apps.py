@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BusesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'buses'
+
+    def ready(self):
+        # Connect signal receivers that keep in-process state current and
+        # tune database connections
+        from . import eta, fleet, mapmatch, spatial, sqlite  # noqa: F401
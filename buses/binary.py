@@ -0,0 +1,67 @@
+import struct
+
+# Binary WebSocket subprotocol for location updates.
+#
+# Clients that list BINARY_SUBPROTOCOL in Sec-WebSocket-Protocol receive
+# location updates as binary frames instead of location_update /
+# locations_batch JSON; every other message stays a JSON text frame.
+#
+# Frame:  uint8 frame type (1 = locations), uint32 record count, then records
+# Record: uint32 bus id, uint32 fleet sequence (0 = none),
+#         int32 latitude and int32 longitude in 1e-7 degrees,
+#         float32 speed (km/h), uint16 heading in 0.01 degrees (0xFFFF = none),
+#         int64 fix timestamp in milliseconds since the Unix epoch
+# All fields little-endian: 5 + 30 bytes for a single update.
+
+BINARY_SUBPROTOCOL = 'bus-tracking.v1.binary'
+JSON_SUBPROTOCOL = 'bus-tracking.v1.json'
+
+FRAME_LOCATIONS = 1
+
+HEADER = struct.Struct('<BI')
+RECORD = struct.Struct('<IIiifHq')
+
+COORDINATE_SCALE = 10_000_000
+NO_HEADING = 0xFFFF
+
+
+def pack_location(location):
+    """Pack one fix into a location record"""
+    heading = NO_HEADING if location.heading is None else round(location.heading % 360 * 100) % 36000
+    return RECORD.pack(
+        location.bus_id,
+        getattr(location, 'fleet_sequence', None) or 0,
+        round(location.latitude * COORDINATE_SCALE),
+        round(location.longitude * COORDINATE_SCALE),
+        location.speed or 0.0,
+        heading,
+        round(location.timestamp.timestamp() * 1000),
+    )
+
+
+def locations_frame(records):
+    """Join packed records into one binary locations frame"""
+    return HEADER.pack(FRAME_LOCATIONS, len(records)) + b''.join(records)
+
+
+def unpack_locations(frame):
+    """Decode a locations frame into dicts, for clients and tests"""
+    frame_type, count = HEADER.unpack_from(frame)
+    if frame_type != FRAME_LOCATIONS:
+        raise ValueError(f'Unknown frame type {frame_type}')
+
+    locations = []
+    for index in range(count):
+        bus_id, sequence, latitude, longitude, speed, heading, timestamp = RECORD.unpack_from(
+            frame, HEADER.size + index * RECORD.size
+        )
+        locations.append({
+            'bus_id': bus_id,
+            'sequence': sequence or None,
+            'latitude': latitude / COORDINATE_SCALE,
+            'longitude': longitude / COORDINATE_SCALE,
+            'speed': speed,
+            'heading': None if heading == NO_HEADING else heading / 100,
+            'timestamp_ms': timestamp,
+        })
+    return locations
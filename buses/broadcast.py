@@ -0,0 +1,111 @@
+import json
+
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .binary import pack_location
+from .geo import cell_group_name, grid_cell
+from .models import newest_per_bus
+from .motion import location_motion, locations_motion
+from .serializers import BusLocationSerializer
+
+# Location events carry their WebSocket frames already encoded, so a broadcast
+# costs one json.dumps no matter how many clients are subscribed. Consumers
+# forward ``text`` as-is, or join the per-bus ``update`` fragments when they
+# coalesce several fixes into one frame; binary clients get the ``packed``
+# records (see binary.py) joined the same way.
+
+# Grid cell each bus was last broadcast in, so the cell it leaves hears about the move
+_last_cells = {}
+
+
+def location_update_data(location):
+    """The {"bus_id": ..., "location": {...}, "sequence": ...} object sent to clients for one fix"""
+    data = BusLocationSerializer(location).data
+    # Velocity and predicted positions, so clients can animate between fixes
+    data['motion'] = location_motion(location)
+    return {
+        'bus_id': location.bus_id,
+        'location': data,
+        # Fleet state sequence number, for resuming after a reconnect
+        'sequence': getattr(location, 'fleet_sequence', None),
+    }
+
+
+def encode_location_update(location):
+    """Encode the update for one fix"""
+    # Fleet state encodes each recorded fix once; the broadcast reuses it
+    update = getattr(location, 'encoded_update', None)
+    if update is None:
+        update = location.encoded_update = json.dumps(location_update_data(location))
+    return update
+
+
+def location_groups(location):
+    """Groups that should receive a fix: everyone, its route, and its grid cell(s)"""
+    cell = grid_cell(location.latitude, location.longitude)
+    groups = ['bus_tracking', f'route_{location.bus.route_id}', cell_group_name(cell)]
+    previous = _last_cells.get(location.bus_id)
+    if previous is not None and previous != cell:
+        groups.append(cell_group_name(previous))
+    _last_cells[location.bus_id] = cell
+    return groups
+
+
+def location_update_frame(update):
+    """Wrap one encoded update into a location_update frame without re-encoding it"""
+    return '{"type": "location_update", ' + update[1:]
+
+
+def locations_batch_frame(updates):
+    """Join encoded updates into a locations_batch frame without re-encoding them"""
+    return '{"type": "locations_batch", "updates": [' + ', '.join(updates) + ']}'
+
+
+def location_update_event(location):
+    """Build the group event for a single fix"""
+    update = encode_location_update(location)
+    return {
+        'type': 'bus_location_update',
+        'bus_id': location.bus_id,
+        'latitude': float(location.latitude),
+        'longitude': float(location.longitude),
+        'update': update,
+        'packed': pack_location(location),
+        'text': location_update_frame(update),
+    }
+
+
+def broadcast_location_batch(locations):
+    """Send one batched update to every group affected by the batch"""
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+
+    # Heartbeats of standing buses (see gpsfilter.py) are stored but not sent
+    locations = [location for location in locations if not getattr(location, 'suppress_broadcast', False)]
+    newest = list(newest_per_bus(locations).values())
+    # Fixes not recorded as a bus's latest have no motion yet; look their previous fixes up together
+    locations_motion(newest)
+    groups = {}
+    for location in newest:
+        update = {
+            'bus_id': location.bus_id,
+            'latitude': float(location.latitude),
+            'longitude': float(location.longitude),
+            'update': encode_location_update(location),
+            'packed': pack_location(location),
+        }
+        for group in location_groups(location):
+            groups.setdefault(group, []).append(update)
+
+    for group, updates in groups.items():
+        if updates:
+            async_to_sync(channel_layer.group_send)(
+                group,
+                {
+                    'type': 'bus_locations_batch',
+                    'updates': updates,
+                    'text': locations_batch_frame([update['update'] for update in updates]),
+                }
+            )
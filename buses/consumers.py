@@ -1,35 +1,217 @@
+import asyncio
 import json
+import weakref
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
+from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from .models import Bus, BusLocation
-from .serializers import BusTrackingSerializer
+from .binary import BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL, locations_frame
+from .broadcast import locations_batch_frame
+from .fleet import fleet_state, tracking_data
+from .geo import bbox_contains, cell_group_name, cells_for_bbox, parse_bbox
+from .metrics import WS_CONNECTIONS, WS_DROPPED, WS_FRAMES, CallbackGauge, group_label
+from .models import Bus, BusLocation, Route
 
 
-class BusTrackingConsumer(AsyncWebsocketConsumer):
+_live_consumers = weakref.WeakSet()
+
+
+def pending_messages():
+    """Messages waiting for each consumer class: channel layer queue plus held fixes"""
+    pending = {}
+    for _ in range(3):
+        try:
+            consumers = list(_live_consumers)
+            break
+        except RuntimeError:
+            # A connection opened or closed while copying
+            continue
+    else:
+        return pending
+
+    for consumer in consumers:
+        # Only the in-memory layer keeps per-channel queues in this process
+        queue = getattr(consumer.channel_layer, 'channels', {}).get(getattr(consumer, 'channel_name', None))
+        queued = queue.qsize() if hasattr(queue, 'qsize') else 0
+        key = (type(consumer).__name__,)
+        pending[key] = pending.get(key, 0) + queued + len(consumer._pending_locations)
+    return pending
+
+
+WS_PENDING = CallbackGauge(
+    'bus_ws_pending_messages', 'Messages queued for WebSocket clients but not sent yet', pending_messages, ['consumer'],
+)
+
+
+class LocationFanoutMixin:
+    """Forwards pre-encoded location events from the room group.
+
+    With ``coalesce_window_ms`` set, the newest fix of each bus is held for that
+    many milliseconds and then sent as a single ``locations_batch`` frame, so a
+    client receives at most one frame per window no matter how often buses report.
+
+    After a ``subscribe_bbox`` message only buses inside the bounding box are
+    forwarded, plus one last update for a bus that leaves it.
+
+    Clients that negotiate the binary subprotocol receive location updates as
+    packed binary frames; everything else stays JSON.
+    """
+    coalesce_window_ms = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_locations = {}
+        self._flush_task = None
+        self.bbox = None
+        self._visible_buses = set()
+        self.binary = False
+        _live_consumers.add(self)
+
+    def select_subprotocol(self):
+        """Pick the subprotocol to accept from the ones the client offered"""
+        offered = self.scope.get('subprotocols') or []
+        if BINARY_SUBPROTOCOL in offered:
+            self.binary = True
+            return BINARY_SUBPROTOCOL
+        if JSON_SUBPROTOCOL in offered:
+            return JSON_SUBPROTOCOL
+        return None
+
+    async def join_group(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        WS_CONNECTIONS.inc(group=group_label(group))
+
+    async def leave_group(self, group):
+        await self.channel_layer.group_discard(group, self.channel_name)
+        WS_CONNECTIONS.dec(group=group_label(group))
+
+    # Receive message from room group
+    async def bus_location_update(self, event):
+        await self.forward_locations([event], event['text'])
+
+    async def bus_locations_batch(self, event):
+        await self.forward_locations(event['updates'], event['text'])
+
+    async def forward_locations(self, updates, text):
+        if self.bbox is not None:
+            visible = [update for update in updates if self.in_view(update)]
+            if len(visible) != len(updates):
+                WS_DROPPED.inc(len(updates) - len(visible), consumer=type(self).__name__, reason='outside_bbox')
+                updates, text = visible, None
+        if not updates:
+            return
+
+        if self.coalesce_window_ms:
+            self.hold_locations(updates)
+        else:
+            await self.send_locations(updates, text)
+
+    async def send_locations(self, updates, text=None):
+        # Events from older senders may lack packed records; those go out as JSON
+        if self.binary and all('packed' in update for update in updates):
+            await self.send(bytes_data=locations_frame([update['packed'] for update in updates]))
+            WS_FRAMES.inc(consumer=type(self).__name__, kind='binary')
+        else:
+            await self.send(text_data=text or locations_batch_frame([update['update'] for update in updates]))
+            WS_FRAMES.inc(consumer=type(self).__name__, kind='json')
+
+    def in_view(self, update):
+        if bbox_contains(self.bbox, update['latitude'], update['longitude']):
+            self._visible_buses.add(update['bus_id'])
+            return True
+        if update['bus_id'] in self._visible_buses:
+            # Let the client see the bus leave its viewport once
+            self._visible_buses.discard(update['bus_id'])
+            return True
+        return False
+
+    async def subscribe_bbox(self, bbox):
+        """Restrict location updates to a bounding box, or lift the restriction with None"""
+        if bbox is None:
+            self.bbox = None
+            self._visible_buses.clear()
+            await self.bbox_changed()
+            await self.send(text_data=json.dumps({'type': 'bbox_buses', 'bbox': None, 'buses': []}))
+            return
+
+        try:
+            self.bbox = parse_bbox(bbox)
+        except ValueError as exc:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': str(exc)}))
+            return
+
+        await self.bbox_changed()
+        buses = await self.get_bbox_buses_data(self.bbox)
+        self._visible_buses = {bus['id'] for bus in buses}
+        await self.send(text_data=json.dumps({
+            'type': 'bbox_buses',
+            'bbox': list(self.bbox),
+            'buses': buses
+        }))
+
+    async def bbox_changed(self):
+        """Hook for consumers that re-subscribe to groups when the bounding box changes"""
+
+    def get_buses_queryset(self):
+        raise NotImplementedError
+
+    @database_sync_to_async
+    def get_bbox_buses_data(self, bbox):
+        south, west, north, east = bbox
+        return tracking_data(self.get_buses_queryset().filter(
+            latest_location__location__latitude__range=(south, north),
+            latest_location__location__longitude__range=(west, east),
+        ))
+
+    def hold_locations(self, updates):
+        for update in updates:
+            # Later fixes for the same bus supersede earlier ones within a window
+            if self._pending_locations.pop(update['bus_id'], None) is not None:
+                WS_DROPPED.inc(consumer=type(self).__name__, reason='superseded')
+            self._pending_locations[update['bus_id']] = update
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self.flush_locations_after_window())
+
+    async def flush_locations_after_window(self):
+        await asyncio.sleep(self.coalesce_window_ms / 1000)
+        updates = list(self._pending_locations.values())
+        self._pending_locations.clear()
+        self._flush_task = None
+        if updates:
+            await self.send_locations(updates)
+
+    def cancel_location_flush(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+
+class BusTrackingConsumer(LocationFanoutMixin, AsyncWebsocketConsumer):
+    # Map clients only need one position per bus every half second
+    coalesce_window_ms = 500
+
     async def connect(self):
         self.room_group_name = 'bus_tracking'
+        self.location_groups = {self.room_group_name}
         
         # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.join_group(self.room_group_name)
         
-        await self.accept()
+        await self.accept(self.select_subprotocol())
         
-        # Send initial data
-        initial_data = await self.get_all_buses_data()
-        await self.send(text_data=json.dumps({
-            'type': 'initial_data',
-            'buses': initial_data
-        }))
+        # Send initial data, or only what changed if the client is resuming
+        # (ws/buses/?epoch=<epoch>&sequence=<last sequence seen>)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        epoch = query.get('epoch', [None])[0]
+        sequence = query.get('sequence', [None])[0]
+        await self.send_resume(epoch, sequence)
     
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        self.cancel_location_flush()
+
+        # Leave room group and any grid cell groups
+        for group in self.location_groups:
+            await self.leave_group(group)
     
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -37,20 +219,28 @@ class BusTrackingConsumer(AsyncWebsocketConsumer):
         message_type = text_data_json.get('type')
         
         if message_type == 'get_buses':
-            buses_data = await self.get_all_buses_data()
-            await self.send(text_data=json.dumps({
-                'type': 'buses_update',
-                'buses': buses_data
-            }))
-    
-    # Receive message from room group
-    async def bus_location_update(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'location_update',
-            'bus_id': event['bus_id'],
-            'location': event['location']
-        }))
+            await self.send(text_data=await database_sync_to_async(fleet_state.initial_frame)('buses_update'))
+        elif message_type == 'resume':
+            await self.send_resume(text_data_json.get('epoch'), text_data_json.get('sequence'))
+        elif message_type == 'subscribe_bbox':
+            await self.subscribe_bbox(text_data_json.get('bbox'))
+
+    async def bbox_changed(self):
+        # Small boxes listen to the grid cells they cover instead of the whole
+        # fleet; boxes spanning too many cells stay on the global group and
+        # rely on the per-update filter alone.
+        wanted = {self.room_group_name}
+        if self.bbox is not None:
+            cells = cells_for_bbox(self.bbox)
+            if len(cells) <= getattr(settings, 'BUS_BBOX_MAX_CELLS', 64):
+                wanted = {cell_group_name(cell) for cell in cells}
+
+        # Join before leaving so no update slips between the two
+        for group in wanted - self.location_groups:
+            await self.join_group(group)
+        for group in self.location_groups - wanted:
+            await self.leave_group(group)
+        self.location_groups = wanted
     
     async def bus_status_update(self, event):
         # Send bus status update to WebSocket
@@ -60,40 +250,35 @@ class BusTrackingConsumer(AsyncWebsocketConsumer):
             'status': event['status']
         }))
     
-    @database_sync_to_async
-    def get_all_buses_data(self):
-        buses = Bus.objects.filter(is_active=True)
-        serializer = BusTrackingSerializer(buses, many=True)
-        return serializer.data
+    def get_buses_queryset(self):
+        return Bus.objects.filter(is_active=True)
 
+    async def send_resume(self, epoch, sequence):
+        try:
+            sequence = int(sequence) if sequence is not None else None
+        except (TypeError, ValueError):
+            sequence = None
+        await self.send(text_data=await database_sync_to_async(fleet_state.resume_frame)(epoch, sequence))
 
-class RouteTrackingConsumer(AsyncWebsocketConsumer):
+
+class RouteTrackingConsumer(LocationFanoutMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.route_id = self.scope['url_route']['kwargs']['route_id']
         self.room_group_name = f'route_{self.route_id}'
         
         # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.join_group(self.room_group_name)
         
-        await self.accept()
+        await self.accept(self.select_subprotocol())
         
         # Send initial data for this route
-        initial_data = await self.get_route_buses_data()
-        await self.send(text_data=json.dumps({
-            'type': 'initial_data',
-            'route_id': self.route_id,
-            'buses': initial_data
-        }))
+        await self.send(text_data=await self.route_buses_frame('initial_data'))
     
     async def disconnect(self, close_code):
+        self.cancel_location_flush()
+
         # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.leave_group(self.room_group_name)
     
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -101,24 +286,25 @@ class RouteTrackingConsumer(AsyncWebsocketConsumer):
         message_type = text_data_json.get('type')
         
         if message_type == 'get_route_buses':
-            buses_data = await self.get_route_buses_data()
-            await self.send(text_data=json.dumps({
-                'type': 'route_buses_update',
-                'route_id': self.route_id,
-                'buses': buses_data
-            }))
-    
-    # Receive message from room group
-    async def bus_location_update(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'location_update',
-            'bus_id': event['bus_id'],
-            'location': event['location']
-        }))
+            await self.send(text_data=await self.route_buses_frame('route_buses_update'))
+        elif message_type == 'subscribe_bbox':
+            await self.subscribe_bbox(text_data_json.get('bbox'))
     
+    async def stop_arrivals_update(self, event):
+        # Forward pre-encoded arrival predictions for this route's stops
+        await self.send(text_data=event['text'])
+
+    def get_buses_queryset(self):
+        return Bus.objects.filter(route_id=self.route_id, is_active=True)
+
     @database_sync_to_async
     def get_route_buses_data(self):
-        buses = Bus.objects.filter(route_id=self.route_id, is_active=True)
-        serializer = BusTrackingSerializer(buses, many=True)
-        return serializer.data
\ No newline at end of file
+        """Encoded buses of this route from the shared fleet snapshot cache"""
+        try:
+            return fleet_state.snapshot(self.route_id)[1]
+        except Route.DoesNotExist:
+            return '[]'
+
+    async def route_buses_frame(self, message_type):
+        buses = await self.get_route_buses_data()
+        return f'{{"type": "{message_type}", "route_id": {json.dumps(self.route_id)}, "buses": {buses}}}'
\ No newline at end of file
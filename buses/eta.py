@@ -0,0 +1,212 @@
+import json
+import math
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .geo import METERS_PER_DEGREE_LAT, haversine_m
+from .models import BusLatestLocation, RouteStop
+from .signals import locations_recorded
+
+
+class RoutePath:
+    """A route's ordered stops as a polyline with cumulative distance at each stop"""
+
+    def __init__(self, stops):
+        self.stop_ids = [stop_id for stop_id, _, _ in stops]
+        self.points = [(float(lat), float(lng)) for _, lat, lng in stops]
+        self.cumulative = [0.0]
+        for (lat1, lng1), (lat2, lng2) in zip(self.points, self.points[1:]):
+            self.cumulative.append(self.cumulative[-1] + haversine_m(lat1, lng1, lat2, lng2))
+
+    def project(self, latitude, longitude):
+        """Return (distance along the route, distance off the route) in meters for a point"""
+        if len(self.points) < 2:
+            return None, None
+
+        # Planar approximation around the point; fine at the scale of one segment
+        scale_x = METERS_PER_DEGREE_LAT * math.cos(math.radians(latitude))
+        best = None
+        for index, ((lat1, lng1), (lat2, lng2)) in enumerate(zip(self.points, self.points[1:])):
+            ax, ay = (lng1 - longitude) * scale_x, (lat1 - latitude) * METERS_PER_DEGREE_LAT
+            bx, by = (lng2 - longitude) * scale_x, (lat2 - latitude) * METERS_PER_DEGREE_LAT
+            dx, dy = bx - ax, by - ay
+            length_sq = dx * dx + dy * dy
+            t = 0.0 if length_sq == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / length_sq))
+            offset = math.hypot(ax + t * dx, ay + t * dy)
+            if best is None or offset < best[0]:
+                segment = self.cumulative[index + 1] - self.cumulative[index]
+                best = (offset, self.cumulative[index] + t * segment)
+        return best[1], best[0]
+
+
+class ETAEngine:
+    """Keeps per-(route, stop) arrival predictions current as fixes arrive.
+
+    Each fix is projected onto its route's stop polyline; the bus speed is a
+    moving average of observed progress along the route (falling back to the
+    reported speed), and only that bus's predictions are recomputed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._buses = {}
+        self._arrivals = {}
+        self._warmed_routes = set()
+
+    def path_for(self, route_id):
+        """The route's stop polyline, reloaded after BUS_ETA_ROUTE_MAX_AGE seconds.
+
+        Saving a stop drops the path in this process; the reload picks up
+        stops changed by other processes, e.g. ``import_gtfs``.
+        """
+        cached = self._paths.get(route_id)
+        if cached is not None and time.monotonic() - cached[1] <= getattr(settings, 'BUS_ETA_ROUTE_MAX_AGE', 300):
+            return cached[0]
+        stops = RouteStop.objects.filter(route_id=route_id, is_active=True).order_by('stop_order')
+        path = RoutePath(list(stops.values_list('id', 'latitude', 'longitude')))
+        self._paths[route_id] = (path, time.monotonic())
+        return path
+
+    def invalidate_route(self, route_id):
+        with self._lock:
+            self._paths.pop(route_id, None)
+            self._warmed_routes.discard(route_id)
+
+    def update(self, location):
+        """Recompute predictions for the bus of a new fix; returns its downstream arrivals"""
+        bus = location.bus
+        route_id = bus.route_id
+        path = self.path_for(route_id)
+        latitude, longitude = float(location.latitude), float(location.longitude)
+        along, offset = path.project(latitude, longitude)
+
+        with self._lock:
+            previous = self._buses.get(bus.id)
+            self._clear_bus(bus.id, previous)
+            if along is None or offset > getattr(settings, 'BUS_ETA_MAX_OFF_ROUTE_M', 300):
+                self._buses.pop(bus.id, None)
+                return []
+
+            speed = self._estimate_speed(location, along, previous)
+            arrivals = []
+            for stop_id, stop_along in zip(path.stop_ids, path.cumulative):
+                remaining = stop_along - along
+                if remaining < 0:
+                    continue
+                arrival = {
+                    'bus_id': bus.id,
+                    'bus_number': bus.bus_number,
+                    'stop_id': stop_id,
+                    'eta': location.timestamp + timedelta(seconds=remaining / speed),
+                    'distance_m': round(remaining, 1),
+                    'fix_time': location.timestamp,
+                }
+                self._arrivals.setdefault((route_id, stop_id), {})[bus.id] = arrival
+                arrivals.append(arrival)
+
+            self._buses[bus.id] = {
+                'route_id': route_id,
+                'along': along,
+                'timestamp': location.timestamp,
+                'speed': speed,
+                'stop_ids': [arrival['stop_id'] for arrival in arrivals],
+            }
+        return arrivals
+
+    def arrivals_for_stop(self, stop):
+        """Upcoming arrivals at a stop, soonest first, skipping stale predictions"""
+        if stop.route_id not in self._warmed_routes:
+            self.warm_route(stop.route_id)
+
+        now = timezone.now()
+        max_fix_age = timedelta(seconds=getattr(settings, 'BUS_ETA_MAX_FIX_AGE', 300))
+        with self._lock:
+            arrivals = list(self._arrivals.get((stop.route_id, stop.id), {}).values())
+        arrivals = [
+            arrival for arrival in arrivals
+            if now - arrival['fix_time'] <= max_fix_age and arrival['eta'] >= now - timedelta(minutes=1)
+        ]
+        return sorted(arrivals, key=lambda arrival: arrival['eta'])
+
+    def warm_route(self, route_id):
+        """Seed predictions for a route from the latest stored fix of each of its buses"""
+        latest = BusLatestLocation.objects.filter(
+            bus__route_id=route_id, bus__is_active=True
+        ).select_related('location__bus')
+        for entry in latest:
+            if entry.location.bus_id not in self._buses:
+                self.update(entry.location)
+        self._warmed_routes.add(route_id)
+
+    def _estimate_speed(self, location, along, previous):
+        default_speed = getattr(settings, 'BUS_ETA_DEFAULT_SPEED_KMH', 20) / 3.6
+        reported = location.speed / 3.6 if location.speed else None
+        speed = reported or (previous['speed'] if previous else default_speed)
+
+        if previous is not None:
+            elapsed = (location.timestamp - previous['timestamp']).total_seconds()
+            progress = along - previous['along']
+            if elapsed > 0 and progress > 0:
+                speed = progress / elapsed
+            # Smooth over recent fixes so one stop at a light does not blow up the ETA
+            speed = 0.7 * previous['speed'] + 0.3 * speed
+        return max(speed, 1.0)
+
+    def _clear_bus(self, bus_id, previous):
+        if previous is None:
+            return
+        for stop_id in previous['stop_ids']:
+            self._arrivals.get((previous['route_id'], stop_id), {}).pop(bus_id, None)
+
+
+eta_engine = ETAEngine()
+
+
+def arrivals_frame(updates):
+    """Encode the stop_arrivals frame pushed to a route group"""
+    return json.dumps({
+        'type': 'stop_arrivals',
+        'buses': [
+            {
+                'bus_id': bus_id,
+                'arrivals': [
+                    {'stop_id': arrival['stop_id'], 'eta': arrival['eta'], 'distance_m': arrival['distance_m']}
+                    for arrival in arrivals
+                ],
+            }
+            for bus_id, arrivals in updates
+        ],
+    }, cls=DjangoJSONEncoder)
+
+
+@receiver(locations_recorded)
+def update_arrivals(sender, locations, **kwargs):
+    routes = {}
+    for location in locations:
+        arrivals = eta_engine.update(location)
+        routes.setdefault(location.bus.route_id, []).append((location.bus_id, arrivals))
+
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    for route_id, updates in routes.items():
+        async_to_sync(channel_layer.group_send)(
+            f'route_{route_id}',
+            {'type': 'stop_arrivals_update', 'text': arrivals_frame(updates)}
+        )
+
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def invalidate_route_path(sender, instance, **kwargs):
+    eta_engine.invalidate_route(instance.route_id)
@@ -0,0 +1,138 @@
+import csv
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+
+# Same columns as BusLocationSerializer and the retention archives
+EXPORT_FIELDS = [
+    'id', 'bus_id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'timestamp',
+    'matched_latitude', 'matched_longitude', 'distance_along_route',
+]
+TIMESTAMP_COLUMN = EXPORT_FIELDS.index('timestamp')
+EXPORT_CHUNK_SIZE = 2000
+# Bytes pulled per thread hop when streaming under ASGI
+EXPORT_HOP_BYTES = 256 * 1024
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+
+
+def export_rows(queryset):
+    """Stream plain tuples from the database without building model instances"""
+    return queryset.values_list(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def ndjson_stream(rows):
+    for row in rows:
+        record = dict(zip(EXPORT_FIELDS, row))
+        record['timestamp'] = record['timestamp'].isoformat()
+        yield json.dumps(record) + '\n'
+
+
+def csv_stream(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row[:TIMESTAMP_COLUMN] + (row[TIMESTAMP_COLUMN].isoformat(),) + row[TIMESTAMP_COLUMN + 1:])
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parquet_stream(rows):
+    """Write one Parquet row group per chunk and yield the bytes as they are produced"""
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('bus_id', pyarrow.int64()),
+        ('latitude', pyarrow.float64()),
+        ('longitude', pyarrow.float64()),
+        ('speed', pyarrow.float64()),
+        ('heading', pyarrow.float64()),
+        ('accuracy', pyarrow.float64()),
+        ('timestamp', pyarrow.timestamp('us', tz='UTC')),
+        ('matched_latitude', pyarrow.float64()),
+        ('matched_longitude', pyarrow.float64()),
+        ('distance_along_route', pyarrow.float64()),
+    ])
+    sink = io.BytesIO()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+
+    def flush(chunk):
+        columns = list(zip(*chunk))
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        ))
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield flush(chunk)
+            chunk = []
+    if chunk:
+        yield flush(chunk)
+    writer.close()
+    yield sink.getvalue()
+
+
+EXPORT_FORMATS = {
+    'ndjson': (ndjson_stream, 'application/x-ndjson'),
+    'csv': (csv_stream, 'text/csv'),
+    'parquet': (parquet_stream, 'application/vnd.apache.parquet'),
+}
+
+
+def export_available(export_format):
+    return export_format in EXPORT_FORMATS and (export_format != 'parquet' or pyarrow is not None)
+
+
+async def async_stream(pieces):
+    """Pull a synchronous stream through sync_to_async, about EXPORT_HOP_BYTES per thread hop.
+
+    ASGI servers only stream async iterators; a sync one is read into memory
+    with sync_to_async(list) first. NDJSON yields a small piece per row while
+    CSV and Parquet yield one per EXPORT_CHUNK_SIZE rows, so hops are capped by
+    size rather than by piece count.
+    """
+    pieces = iter(pieces)
+
+    @sync_to_async
+    def take():
+        chunk, size = [], 0
+        for piece in pieces:
+            chunk.append(piece)
+            size += len(piece)
+            if size >= EXPORT_HOP_BYTES:
+                break
+        return chunk
+
+    try:
+        while chunk := await take():
+            yield ''.join(chunk) if isinstance(chunk[0], str) else b''.join(chunk)
+    finally:
+        # Release the database cursor in the thread that opened it
+        await sync_to_async(pieces.close)()
+
+
+def export_response(queryset, export_format, filename, asynchronous=False):
+    """Stream a location queryset in the requested format; ``asynchronous`` for ASGI servers"""
+    stream, content_type = EXPORT_FORMATS[export_format]
+    content = stream(export_rows(queryset))
+    if asynchronous:
+        content = async_stream(content)
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+
+from .broadcast import location_update_data
+from .models import Bus, Route
+from .motion import locations_motion
+from .serializers import BusTrackingSerializer
+from .signals import locations_recorded
+
+
+def tracking_data(queryset):
+    """Serialize buses like BusTrackingSerializer, with the motion of each current location.
+
+    Location update frames and snapshots patched by them carry motion, so
+    everything else sending buses to clients does too.
+    """
+    buses = list(queryset.with_tracking_data())
+    locations_motion([bus.current_location for bus in buses if bus.current_location is not None])
+    data = [dict(bus) for bus in BusTrackingSerializer(buses, many=True).data]
+    for bus, entry in zip(buses, data):
+        if entry['current_location'] is not None:
+            entry['current_location'] = {**entry['current_location'], 'motion': bus.current_location.motion}
+    return data
+
+
+class FleetSnapshot:
+    """Serialized active buses of the whole fleet or of one route.
+
+    Recorded fixes are patched into the bus entries, so a snapshot stays current
+    between rebuilds; its JSON encoding and ETag are only recomputed after
+    something changed.
+    """
+
+    def __init__(self, buses):
+        self.buses = {bus['id']: bus for bus in buses}
+        self.sequence = 0
+        self.built_at = time.monotonic()
+        self._encoded = None
+
+    def apply(self, bus_id, location, sequence):
+        bus = self.buses.get(bus_id)
+        if bus is not None:
+            bus['current_location'] = location
+            self._encoded = None
+        self.sequence = sequence
+
+    def encode(self):
+        """Return (encoded buses, ETag)"""
+        if self._encoded is None:
+            encoded = json.dumps(list(self.buses.values()))
+            self._encoded = encoded, '"%s"' % hashlib.md5(encoded.encode(), usedforsecurity=False).hexdigest()
+        return self._encoded
+
+
+class FleetState:
+    """Sequence-numbered newest location of every bus, plus cached fleet snapshots.
+
+    Each change takes the next sequence number. A client reconnecting with the
+    epoch and sequence it last saw gets only the buses that moved since; a client
+    from another epoch (another worker, a restart, or a fleet change such as a
+    bus being added) gets the full snapshot.
+
+    Snapshots of the fleet and of single routes live in an LRU of
+    ``BUS_FLEET_SNAPSHOT_CACHE_SIZE`` entries, are rebuilt from the database at
+    most once per ``BUS_FLEET_SNAPSHOT_MAX_AGE`` seconds and are shared by every
+    request and connection. With ``BUS_FLEET_SNAPSHOT_CACHE`` naming a Django
+    cache, rebuilds are shared between worker processes too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.epoch = uuid.uuid4().hex[:12]
+            self.sequence = 0
+            # bus_id -> (sequence, timestamp, serialized location, encoded update);
+            # only the newest change per bus matters
+            self._changes = {}
+            # route id (None for the whole fleet) -> FleetSnapshot, least recently used first
+            self._snapshots = OrderedDict()
+
+    def record(self, bus_id, timestamp, encode):
+        """Register a new location of a bus and return its sequence number.
+
+        ``encode(sequence)`` returns the serialized location and the encoded
+        update clients receive for it. Locations no newer than the one already
+        registered are ignored.
+        """
+        with self._lock:
+            current = self._changes.get(bus_id)
+            if current is not None and current[1] >= timestamp:
+                return current[0]
+            self.sequence += 1
+            location, update = encode(self.sequence)
+            self._changes[bus_id] = (self.sequence, timestamp, location, update)
+            for snapshot in self._snapshots.values():
+                snapshot.apply(bus_id, location, self.sequence)
+            return self.sequence
+
+    def changes_since(self, sequence):
+        """Encoded updates of the buses that changed after ``sequence``, oldest first"""
+        with self._lock:
+            changes = sorted((change[0], change[3]) for change in self._changes.values() if change[0] > sequence)
+        return [update for _, update in changes]
+
+    def can_resume(self, epoch, sequence):
+        return epoch == self.epoch and sequence is not None and 0 <= sequence <= self.sequence
+
+    def snapshot(self, route_id=None):
+        """Return (sequence, encoded buses, ETag) for the fleet or one route.
+
+        Raises Route.DoesNotExist for a route id that is not in the database.
+        """
+        key = str(int(route_id)) if route_id is not None else None
+        with self._lock:
+            snapshot = self._cached_snapshot(key)
+            if snapshot is not None:
+                return (snapshot.sequence, *snapshot.encode())
+
+        # One rebuild at a time; whoever waited finds the fresh snapshot
+        with self._build_lock:
+            with self._lock:
+                snapshot = self._cached_snapshot(key)
+                if snapshot is not None:
+                    return (snapshot.sequence, *snapshot.encode())
+
+            snapshot = self.build_snapshot(key)
+            # Unknown routes must not push real snapshots out of the LRU
+            if key is not None and not snapshot.buses and not Route.objects.filter(pk=key).exists():
+                raise Route.DoesNotExist(f'Route {key} does not exist')
+
+            with self._lock:
+                # Catch up with fixes registered while the snapshot was queried
+                for bus_id in snapshot.buses:
+                    change = self._changes.get(bus_id)
+                    if change is not None:
+                        snapshot.apply(bus_id, change[2], change[0])
+                snapshot.sequence = self.sequence
+
+                self._snapshots[key] = snapshot
+                while len(self._snapshots) > getattr(settings, 'BUS_FLEET_SNAPSHOT_CACHE_SIZE', 64):
+                    self._snapshots.popitem(last=False)
+                return (snapshot.sequence, *snapshot.encode())
+
+    def _cached_snapshot(self, key):
+        snapshot = self._snapshots.get(key)
+        if snapshot is None or time.monotonic() - snapshot.built_at > getattr(settings, 'BUS_FLEET_SNAPSHOT_MAX_AGE', 5):
+            return None
+        self._snapshots.move_to_end(key)
+        return snapshot
+
+    def build_snapshot(self, key):
+        cache_alias = getattr(settings, 'BUS_FLEET_SNAPSHOT_CACHE', None)
+        cache_key = f'bus_fleet_snapshot:{key or "all"}'
+        buses = caches[cache_alias].get(cache_key) if cache_alias else None
+        if buses is None:
+            queryset = Bus.objects.filter(is_active=True)
+            if key is not None:
+                queryset = queryset.filter(route_id=key)
+            buses = tracking_data(queryset)
+            if cache_alias:
+                caches[cache_alias].set(cache_key, buses, timeout=getattr(settings, 'BUS_FLEET_SNAPSHOT_MAX_AGE', 5))
+
+        # Fixes written by other worker processes only reach this one through
+        # the database; register them so resuming clients hear about them too
+        for bus in buses:
+            location = bus['current_location']
+            if location is not None:
+                self.record(bus['id'], parse_datetime(location['timestamp']), lambda sequence: (location, json.dumps({
+                    'bus_id': bus['id'],
+                    'location': location,
+                    'sequence': sequence,
+                })))
+        return FleetSnapshot(buses)
+
+    def initial_frame(self, message_type='initial_data'):
+        """Full fleet snapshot with the epoch and sequence it is current at"""
+        sequence, buses, _ = self.snapshot()
+        return (
+            f'{{"type": "{message_type}", "epoch": "{self.epoch}", "sequence": {sequence}, '
+            f'"buses": {buses}}}'
+        )
+
+    def resume_frame(self, epoch, sequence):
+        """Deltas since ``sequence`` for a client of this epoch, else the full snapshot"""
+        if not self.can_resume(epoch, sequence):
+            return self.initial_frame()
+        return (
+            f'{{"type": "fleet_delta", "epoch": "{self.epoch}", "sequence": {self.sequence}, '
+            f'"updates": [{", ".join(self.changes_since(sequence))}]}}'
+        )
+
+
+fleet_state = FleetState()
+
+
+@receiver(locations_recorded)
+def sequence_recorded_locations(sender, locations, **kwargs):
+    # May read the buses' previous fixes from the database; not under the state lock
+    locations_motion(locations)
+    for location in locations:
+        def encode(sequence):
+            # Kept on the instance so the live broadcast of this fix reuses it
+            location.fleet_sequence = sequence
+            data = location_update_data(location)
+            location.encoded_update = json.dumps(data)
+            return data['location'], location.encoded_update
+
+        fleet_state.record(location.bus_id, location.timestamp, encode)
+
+
+@receiver(post_save, sender=Bus)
+@receiver(post_delete, sender=Bus)
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def reset_fleet_state(sender, **kwargs):
+    # Buses joining or leaving the fleet can't be expressed as location deltas
+    fleet_state.reset()
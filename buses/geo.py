@@ -0,0 +1,82 @@
+import math
+
+from django.conf import settings
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def path_length_m(points):
+    """Length of a (lat, lng) polyline in meters"""
+    return sum(haversine_m(lat1, lng1, lat2, lng2) for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]))
+
+
+def bbox_around(latitude, longitude, radius_m):
+    """(south, west, north, east) box enclosing a circle of radius_m around a point"""
+    dlat = radius_m / METERS_PER_DEGREE_LAT
+    dlng = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 1e-6))
+    return (
+        max(latitude - dlat, -90.0),
+        max(longitude - dlng, -180.0),
+        min(latitude + dlat, 90.0),
+        min(longitude + dlng, 180.0),
+    )
+
+
+def grid_cell_size():
+    """Edge length of a spatial grid cell in degrees"""
+    return getattr(settings, 'BUS_GRID_CELL_DEGREES', 0.01)
+
+
+def grid_cell(latitude, longitude):
+    """Return the (row, column) grid cell containing a point"""
+    size = grid_cell_size()
+    return math.floor(float(latitude) / size), math.floor(float(longitude) / size)
+
+
+def cells_for_bbox(bbox):
+    """Return every grid cell overlapping a (south, west, north, east) bounding box"""
+    south, west, north, east = bbox
+    first_row, first_col = grid_cell(south, west)
+    last_row, last_col = grid_cell(north, east)
+    return [
+        (row, col)
+        for row in range(first_row, last_row + 1)
+        for col in range(first_col, last_col + 1)
+    ]
+
+
+def cell_group_name(cell):
+    """Channel layer group that receives updates for buses inside a grid cell"""
+    row, col = cell
+    return f'cell_{row}_{col}'
+
+
+def parse_bbox(value):
+    """Validate a bounding box given as [south, west, north, east] or a dict with those keys"""
+    if isinstance(value, dict):
+        value = [value.get(key) for key in ('south', 'west', 'north', 'east')]
+    try:
+        south, west, north, east = (float(coordinate) for coordinate in value)
+    except (TypeError, ValueError):
+        raise ValueError('bbox must be [south, west, north, east]')
+
+    if not (-90 <= south <= north <= 90):
+        raise ValueError('bbox latitudes must satisfy -90 <= south <= north <= 90')
+    if not (-180 <= west <= east <= 180):
+        raise ValueError('bbox longitudes must satisfy -180 <= west <= east <= 180')
+    return south, west, north, east
+
+
+def bbox_contains(bbox, latitude, longitude):
+    south, west, north, east = bbox
+    return south <= latitude <= north and west <= longitude <= east
@@ -0,0 +1,224 @@
+import math
+import threading
+
+from django.conf import settings
+
+from .geo import METERS_PER_DEGREE_LAT, haversine_m
+from .metrics import FILTERED_BROADCASTS, FILTERED_ROWS
+
+ACCEPT = 'accept'
+# Stored so the history and "last seen" stay current, but not broadcast
+HEARTBEAT = 'heartbeat'
+# Dropped
+DUPLICATE = 'duplicate'
+STATIONARY = 'stationary'
+JUMP = 'jump'
+# Older than the last fix of the bus: stored as history, not broadcast as its position
+LATE = 'late'
+
+
+class KalmanTrack:
+    """Constant-velocity Kalman filter over local east/north meters.
+
+    Each axis keeps (position, velocity) and its 2x2 covariance; the two axes
+    are independent. Measurement noise comes from the fix's reported accuracy.
+    """
+
+    def __init__(self, latitude, longitude, variance):
+        self.origin = (latitude, longitude)
+        self.scale_x = METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 1e-6)
+        # [position, velocity, p00, p01, p11] per axis
+        self.axes = [[0.0, 0.0, variance, 0.0, 100.0] for _ in range(2)]
+
+    def copy(self):
+        copied = KalmanTrack.__new__(KalmanTrack)
+        copied.origin, copied.scale_x = self.origin, self.scale_x
+        copied.axes = [list(axis) for axis in self.axes]
+        return copied
+
+    def update(self, latitude, longitude, dt, variance, process_noise):
+        """Fold in a measurement taken ``dt`` seconds after the previous one; returns the smoothed point"""
+        measured = (
+            (longitude - self.origin[1]) * self.scale_x,
+            (latitude - self.origin[0]) * METERS_PER_DEGREE_LAT,
+        )
+        for axis, z in zip(self.axes, measured):
+            x, v, p00, p01, p11 = axis
+            # Predict
+            x += v * dt
+            p00 += dt * (2 * p01 + dt * p11) + process_noise * dt ** 3 / 3
+            p01 += dt * p11 + process_noise * dt ** 2 / 2
+            p11 += process_noise * dt
+            # Update with the measured position
+            gain_x = p00 / (p00 + variance)
+            gain_v = p01 / (p00 + variance)
+            residual = z - x
+            x += gain_x * residual
+            v += gain_v * residual
+            p11 -= gain_v * p01
+            p01 -= gain_x * p01
+            p00 -= gain_x * p00
+            axis[:] = [x, v, p00, p01, p11]
+
+        east, north = self.axes[0][0], self.axes[1][0]
+        return self.origin[0] + north / METERS_PER_DEGREE_LAT, self.origin[1] + east / self.scale_x
+
+
+class BusTrack:
+    """What the filter remembers about one bus"""
+
+    def __init__(self, location):
+        self.seen_at = location.timestamp
+        self.seen = (location.latitude, location.longitude, location.accuracy)
+        self.stored_at = location.timestamp
+        self.stored = (location.latitude, location.longitude)
+        self.jumps = 0
+        self.kalman = None
+
+    def copy(self):
+        copied = BusTrack.__new__(BusTrack)
+        copied.__dict__.update(self.__dict__)
+        copied.kalman = self.kalman.copy() if self.kalman is not None else None
+        return copied
+
+
+class GPSFilter:
+    """Per-bus ingest filter backed by an in-memory cache of each bus's last fix.
+
+    A fix is dropped when it repeats the timestamp of the last one, when it
+    implies a speed above ``BUS_GPS_MAX_SPEED_KMH`` (allowing for both fixes'
+    accuracy), or when the bus moved less than ``BUS_GPS_MIN_MOVE_M`` since
+    the last stored fix. A standing bus still stores one fix every
+    ``BUS_GPS_HEARTBEAT_SECONDS``, which is not broadcast, and fixes older
+    than the bus's last one are stored without being broadcast. After
+    ``BUS_GPS_MAX_JUMPS`` rejected jumps in a row the bus is assumed to really
+    be elsewhere and its track restarts. With ``BUS_GPS_KALMAN`` accepted fixes
+    are replaced by Kalman-smoothed positions.
+
+    ``check`` only judges a fix: the track it would leave behind is kept on the
+    fix as ``gps_track`` and becomes the bus's track once ``remember`` is
+    called after the fix was stored or queued. A client retrying a fix whose
+    write failed is therefore not turned away as a duplicate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tracks = {}
+
+    def check(self, location, pending=None):
+        """Return the verdict for an unsaved fix, smoothing its coordinates if enabled.
+
+        ``pending`` maps bus ids to tracks of earlier fixes of the same batch
+        that are not remembered yet.
+        """
+        with self._lock:
+            track = (pending or {}).get(location.bus_id) or self._tracks.get(location.bus_id)
+            if track is None:
+                location.gps_track = self.new_track(location)
+                return ACCEPT
+
+            elapsed = (location.timestamp - track.seen_at).total_seconds()
+            if elapsed == 0:
+                return DUPLICATE
+            if elapsed < 0:
+                # Late fix from a device's buffer: history, not a new position
+                return LATE
+
+            if self.is_jump(track, location, elapsed):
+                track.jumps += 1
+                if track.jumps < getattr(settings, 'BUS_GPS_MAX_JUMPS', 3):
+                    return JUMP
+                location.gps_track = self.new_track(location)
+                return ACCEPT
+
+            updated = track.copy()
+            updated.jumps = 0
+            updated.seen_at = location.timestamp
+            updated.seen = (location.latitude, location.longitude, location.accuracy)
+            if updated.kalman is not None:
+                location.latitude, location.longitude = updated.kalman.update(
+                    location.latitude, location.longitude, elapsed, self.variance(location),
+                    getattr(settings, 'BUS_GPS_KALMAN_PROCESS_NOISE', 1.0),
+                )
+
+            verdict = ACCEPT
+            moved = haversine_m(track.stored[0], track.stored[1], location.latitude, location.longitude)
+            if moved < getattr(settings, 'BUS_GPS_MIN_MOVE_M', 10):
+                since_stored = (location.timestamp - track.stored_at).total_seconds()
+                if since_stored < getattr(settings, 'BUS_GPS_HEARTBEAT_SECONDS', 60):
+                    return STATIONARY
+                verdict = HEARTBEAT
+            updated.stored_at = location.timestamp
+            updated.stored = (location.latitude, location.longitude)
+            location.gps_track = updated
+            return verdict
+
+    def remember(self, locations):
+        """Make the tracks of stored or queued fixes the buses' current ones"""
+        with self._lock:
+            for location in locations:
+                track = getattr(location, 'gps_track', None)
+                if track is None:
+                    continue
+                current = self._tracks.get(location.bus_id)
+                if current is None or current.seen_at <= track.seen_at:
+                    self._tracks[location.bus_id] = track
+
+    def new_track(self, location):
+        track = BusTrack(location)
+        if getattr(settings, 'BUS_GPS_KALMAN', False):
+            track.kalman = KalmanTrack(location.latitude, location.longitude, self.variance(location))
+        return track
+
+    def is_jump(self, track, location, elapsed):
+        latitude, longitude, accuracy = track.seen
+        distance = haversine_m(latitude, longitude, location.latitude, location.longitude)
+        # Both fixes may be off by their accuracy in opposite directions
+        default_accuracy = getattr(settings, 'BUS_GPS_DEFAULT_ACCURACY_M', 10)
+        distance -= (accuracy or default_accuracy) + (location.accuracy or default_accuracy)
+        return distance / elapsed * 3.6 > getattr(settings, 'BUS_GPS_MAX_SPEED_KMH', 130)
+
+    def variance(self, location):
+        accuracy = location.accuracy or getattr(settings, 'BUS_GPS_DEFAULT_ACCURACY_M', 10)
+        return max(accuracy, 1.0) ** 2
+
+
+gps_filter = GPSFilter()
+
+
+def filter_locations(locations, path):
+    """Drop filtered fixes and return the ones to store.
+
+    Heartbeat and late fixes are kept but marked with ``suppress_broadcast``.
+    Call ``remember_locations`` once the kept fixes are stored. Nothing is
+    filtered unless ``BUS_GPS_FILTER`` is enabled.
+    """
+    if not getattr(settings, 'BUS_GPS_FILTER', True):
+        return locations
+
+    kept = []
+    # Tracks of fixes earlier in this batch, until they are remembered
+    pending = {}
+    for location in locations:
+        verdict = gps_filter.check(location, pending)
+        if verdict == ACCEPT:
+            kept.append(location)
+        elif verdict in (HEARTBEAT, LATE):
+            location.suppress_broadcast = True
+            kept.append(location)
+            FILTERED_BROADCASTS.inc(path=path, reason=STATIONARY if verdict == HEARTBEAT else LATE)
+        else:
+            FILTERED_ROWS.inc(path=path, reason=verdict)
+            FILTERED_BROADCASTS.inc(path=path, reason=verdict)
+        if getattr(location, 'gps_track', None) is not None:
+            pending[location.bus_id] = location.gps_track
+    return kept
+
+
+def remember_locations(locations):
+    """Update the filter's tracks once the fixes ``filter_locations`` kept are stored.
+
+    Queued fixes are remembered by the ingest writer after it stores them.
+    """
+    if getattr(settings, 'BUS_GPS_FILTER', True):
+        gps_filter.remember(locations)
@@ -0,0 +1,324 @@
+import csv
+import io
+import os
+import time
+import zipfile
+from collections import Counter, defaultdict
+from datetime import time as dt_time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from .eta import eta_engine
+from .fleet import fleet_state
+from .geo import path_length_m
+from .mapmatch import map_matcher
+from .models import Route, RouteShape, RouteStop
+from .spatial import invalidate_stop_index
+
+
+class GTFSFeed:
+    """Streams the CSV files of a GTFS feed from a zip archive or a directory.
+
+    Rows are read one at a time straight from the archive, so even a
+    multi-million row stop_times.txt or shapes.txt never sits in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_read = Counter()
+        self.archive = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+        if self.archive is None and not os.path.isdir(path):
+            raise ValueError(f'{path} is neither a GTFS zip archive nor a directory')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+    def member(self, name):
+        """Path of ``name`` inside the archive (feeds are sometimes zipped with a top-level folder)"""
+        for candidate in self.archive.namelist():
+            if candidate == name or candidate.endswith('/' + name):
+                return candidate
+        return None
+
+    def has(self, name):
+        if self.archive is not None:
+            return self.member(name) is not None
+        return os.path.exists(os.path.join(self.path, name))
+
+    def rows(self, name):
+        """Yield each row of a feed file as a dict with stripped keys and values"""
+        if self.archive is not None:
+            member = self.member(name)
+            if member is None:
+                raise FileNotFoundError(f'{name} is missing from {self.path}')
+            raw = self.archive.open(member)
+        else:
+            raw = open(os.path.join(self.path, name), 'rb')
+
+        with raw, io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+            reader = csv.reader(text)
+            header = [column.strip() for column in next(reader, [])]
+            for values in reader:
+                if values:
+                    self.rows_read[name] += 1
+                    yield dict(zip(header, (value.strip() for value in values)))
+
+
+ROUTE_NUMBER_LENGTH = Route._meta.get_field('route_number').max_length
+
+
+def route_number(row):
+    """Route.route_number for a routes.txt row: the short name riders know, else the route_id.
+
+    Either is cut to the column's max_length, which SQLite ignores but
+    Postgres enforces.
+    """
+    return (row.get('route_short_name') or row['route_id'])[:ROUTE_NUMBER_LENGTH]
+
+
+def route_numbers(feed):
+    """GTFS route_id -> Route.route_number"""
+    return {row['route_id']: route_number(row) for row in feed.rows('routes.txt')}
+
+
+def representative_trips(feed, numbers):
+    """route_number -> (trip_id, shape_id) of the first trip following the route's most common shape"""
+    counts = defaultdict(Counter)
+    first_trips = {}
+    for row in feed.rows('trips.txt'):
+        number = numbers.get(row['route_id'])
+        if number is None:
+            continue
+        shape_id = row.get('shape_id', '')
+        counts[number][shape_id] += 1
+        first_trips.setdefault((number, shape_id), row['trip_id'])
+    trips = {}
+    for number, shapes in counts.items():
+        shape_id = shapes.most_common(1)[0][0]
+        trips[number] = (first_trips[number, shape_id], shape_id)
+    return trips
+
+
+def route_shape_ids(feed):
+    """route_number -> the shape_id used by most of the route's trips"""
+    return {
+        number: shape_id
+        for number, (_, shape_id) in representative_trips(feed, route_numbers(feed)).items()
+        if shape_id
+    }
+
+
+def read_shapes(feed, shape_ids=None):
+    """shape_id -> [(lat, lng), ...] in shape_pt_sequence order, for the given shapes (or all)"""
+    shapes = defaultdict(list)
+    for row in feed.rows('shapes.txt'):
+        shape_id = row['shape_id']
+        if shape_ids is None or shape_id in shape_ids:
+            shapes[shape_id].append((int(row['shape_pt_sequence']), float(row['shape_pt_lat']), float(row['shape_pt_lon'])))
+    return {
+        shape_id: [(lat, lng) for _, lat, lng in sorted(points)]
+        for shape_id, points in shapes.items()
+    }
+
+
+def gtfs_time(value):
+    """A stop_times.txt time as a time of day; GTFS allows hours past 24 for trips after midnight"""
+    if not value:
+        return None
+    hours, minutes, seconds = (int(part) for part in value.split(':'))
+    return dt_time(hours % 24, minutes, seconds)
+
+
+def coordinate(value, limit):
+    """A stop_lat/stop_lon value as a Decimal, or None if it isn't a number within +/- ``limit``"""
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() and abs(number) <= limit else None
+
+
+def route_fields(row):
+    """Route field values a routes.txt row provides; missing ones keep the stored (or default) value"""
+    fields = {}
+    if row.get('route_long_name'):
+        fields['name'] = row['route_long_name'][:200]
+    if row.get('route_desc'):
+        fields['description'] = row['route_desc']
+    color = row.get('route_color', '')
+    if len(color) == 6:
+        fields['color'] = f'#{color.upper()}'
+    return fields
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def upsert(model, objects, chunk_size, unique_fields, update_fields):
+    """bulk_create ``objects`` in chunks, updating rows that already exist; returns rows written"""
+    written = 0
+    for chunk in chunked(objects, chunk_size):
+        with transaction.atomic():
+            model.objects.bulk_create(
+                chunk, update_conflicts=True, unique_fields=unique_fields, update_fields=update_fields,
+            )
+        written += len(chunk)
+    return written
+
+
+class ImportStats:
+    """Rows read per feed file and rows written per model, with the time each step took"""
+
+    def __init__(self, log=None):
+        self.log = log or (lambda message: None)
+        self.steps = []
+
+    def step(self, name, read, written, started):
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        self.steps.append({'name': name, 'read': read, 'written': written, 'seconds': elapsed})
+        self.log(f'{name}: read {read:,} rows, wrote {written:,} in {elapsed:.2f}s ({read / elapsed:,.0f} rows/s)')
+
+    @property
+    def read(self):
+        return sum(step['read'] for step in self.steps)
+
+    @property
+    def written(self):
+        return sum(step['written'] for step in self.steps)
+
+    @property
+    def seconds(self):
+        return sum(step['seconds'] for step in self.steps)
+
+
+def import_feed(feed, chunk_size=None, shapes=True, log=None):
+    """Upsert a GTFS feed's routes, their stops and their shapes.
+
+    Every file is streamed once. Each route's stops are those of one
+    representative trip (the first trip following its most common shape), so
+    only those trips' stop_times rows, the stops they visit and the chosen
+    shapes are held in memory. Rows are written with ``bulk_create`` in
+    chunks of ``chunk_size``, each in its own transaction, updating routes
+    by route_number, stops by (route, stop_order) and shapes by route.
+    """
+    chunk_size = chunk_size or getattr(settings, 'BUS_GTFS_IMPORT_CHUNK', 2000)
+    stats = ImportStats(log)
+
+    started = time.perf_counter()
+    numbers = {}
+    seen = set()
+
+    # Routes grouped by the fields their row provides, so an upsert never
+    # overwrites e.g. an operator's colour with a default, or re-activates a route
+    routes = defaultdict(list)
+    for row in feed.rows('routes.txt'):
+        number = numbers[row['route_id']] = route_number(row)
+        # Two feed routes sharing a short name become one Route
+        if number in seen:
+            continue
+        seen.add(number)
+        fields = route_fields(row)
+        routes[tuple(sorted(fields))].append(Route(route_number=number, **{'name': number, **fields}))
+
+    written = 0
+    for provided, group in routes.items():
+        written += upsert(Route, group, chunk_size, ['route_number'], [*provided, 'updated_at'])
+    route_ids = dict(Route.objects.filter(route_number__in=set(numbers.values())).values_list('route_number', 'id'))
+    stats.step('routes.txt', feed.rows_read['routes.txt'], written, started)
+
+    started = time.perf_counter()
+    trips = representative_trips(feed, numbers)
+    routes_by_trip = {trip_id: number for number, (trip_id, _) in trips.items()}
+    stats.step('trips.txt', feed.rows_read['trips.txt'], 0, started)
+
+    started = time.perf_counter()
+    visits = defaultdict(list)
+    for row in feed.rows('stop_times.txt'):
+        number = routes_by_trip.get(row['trip_id'])
+        if number is not None:
+            visits[number].append((int(row['stop_sequence']), row['stop_id'], row.get('arrival_time', '')))
+    stats.step('stop_times.txt', feed.rows_read['stop_times.txt'], 0, started)
+
+    started = time.perf_counter()
+    wanted = {stop_id for stop_visits in visits.values() for _, stop_id, _ in stop_visits}
+    stops = {}
+    for row in feed.rows('stops.txt'):
+        if row['stop_id'] in wanted:
+            latitude, longitude = coordinate(row['stop_lat'], 90), coordinate(row['stop_lon'], 180)
+            # A stop with a malformed position is left out of its routes like a missing one
+            if latitude is None or longitude is None:
+                stats.log(f"stops.txt: skipped stop {row['stop_id']}: invalid position "
+                          f"({row['stop_lat']!r}, {row['stop_lon']!r})")
+                continue
+            stops[row['stop_id']] = (row.get('stop_name') or row['stop_id'], latitude, longitude)
+
+    def route_stops():
+        for number, stop_visits in visits.items():
+            order = 0
+            for _, stop_id, arrival in sorted(stop_visits):
+                if stop_id not in stops:
+                    continue
+                order += 1
+                name, latitude, longitude = stops[stop_id]
+                yield RouteStop(
+                    route_id=route_ids[number], stop_name=name[:200], stop_order=order,
+                    latitude=latitude, longitude=longitude,
+                    estimated_time=gtfs_time(arrival),
+                )
+            stop_counts[number] = order
+
+    stop_counts = {}
+    written = upsert(RouteStop, route_stops(), chunk_size, ['route', 'stop_order'],
+                     ['stop_name', 'latitude', 'longitude', 'estimated_time', 'updated_at'])
+    # Stops past the end of a route that got shorter
+    with transaction.atomic():
+        for number, count in stop_counts.items():
+            RouteStop.objects.filter(route_id=route_ids[number], stop_order__gt=count).delete()
+    stats.step('stops.txt', feed.rows_read['stops.txt'], written, started)
+
+    if shapes and feed.has('shapes.txt'):
+        started = time.perf_counter()
+        shape_ids = {number: shape_id for number, (_, shape_id) in trips.items() if shape_id}
+        points_by_shape = read_shapes(feed, set(shape_ids.values()))
+
+        def route_shapes():
+            for number, shape_id in shape_ids.items():
+                points = points_by_shape.get(shape_id, [])
+                if len(points) < 2:
+                    continue
+                shape = RouteShape(route_id=route_ids[number], shape_id=shape_id, length_m=path_length_m(points))
+                shape.set_points(points)
+                yield shape
+
+        written = upsert(RouteShape, route_shapes(), chunk_size, ['route'],
+                         ['shape_id', 'polyline', 'length_m', 'updated_at'])
+        stats.step('shapes.txt', feed.rows_read['shapes.txt'], written, started)
+
+    invalidate_route_caches(route_ids.values())
+    return stats
+
+
+def invalidate_route_caches(route_ids):
+    """Drop this process's cached stop paths, shape indexes and snapshots of imported routes.
+
+    bulk_create sends no post_save. Other processes reload them after
+    BUS_ETA_ROUTE_MAX_AGE and BUS_MAP_MATCH_SHAPE_MAX_AGE seconds.
+    """
+    for route_id in route_ids:
+        eta_engine.invalidate_route(route_id)
+        map_matcher.invalidate(route_id)
+    invalidate_stop_index(sender=RouteStop)
+    fleet_state.reset()
@@ -0,0 +1,230 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .broadcast import broadcast_location_batch
+from .gpsfilter import remember_locations
+from .metrics import INGEST_FIXES, INGEST_SECONDS, CallbackGauge
+from .models import BusLocation
+
+logger = logging.getLogger(__name__)
+
+
+def write_locations(locations):
+    """Store a batch of unsaved locations and broadcast the newest fix per bus"""
+    with INGEST_SECONDS.time(path='queued', stage='write'):
+        BusLocation.objects.bulk_record(locations)
+    # Only fixes that reached the database update the GPS filter
+    remember_locations(locations)
+    INGEST_FIXES.inc(len(locations), path='queued', outcome='stored')
+    with INGEST_SECONDS.time(path='queued', stage='broadcast'):
+        broadcast_location_batch(locations)
+
+
+class LatencyStat:
+    """Running count/total/max of a duration in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'last_ms': round(self.last * 1000, 3),
+        }
+
+
+class IngestQueue:
+    """Bounded in-process queue drained by a background writer in micro-batches.
+
+    A batch is flushed as soon as ``batch_size`` fixes are pending or the oldest
+    pending fix has waited ``flush_interval`` seconds, whichever comes first.
+    With ``flush_interval`` 0 the writer takes whatever is pending right away, and
+    fixes arriving during a write form the next batch (group commit).
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, writer=write_locations):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer = writer
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.failed = 0
+        self.flush_latency = LatencyStat()
+        self.queue_wait = LatencyStat()
+
+    def submit(self, locations):
+        """Queue unsaved locations for writing.
+
+        Returns a Future that resolves once they are stored, or None if the queue
+        is full.
+        """
+        with self._condition:
+            if len(self._pending) + len(locations) > self.max_size:
+                self.rejected += len(locations)
+                return None
+            enqueued_at = time.monotonic()
+            future = Future()
+            self._pending.extend((enqueued_at, location, future) for location in locations)
+            self.accepted += len(locations)
+            self._condition.notify()
+        self._ensure_started()
+        return future
+
+    def depth(self):
+        with self._condition:
+            return len(self._pending)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'depth': len(self._pending),
+                'max_size': self.max_size,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'written': self.written,
+                'failed': self.failed,
+                'flush_latency': self.flush_latency.as_dict(),
+                'queue_wait': self.queue_wait.as_dict(),
+            }
+
+    def stop(self, timeout=5.0):
+        """Flush whatever is pending and stop the writer thread"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _ensure_started(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._condition:
+            # Also replaces a writer thread that died
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='bus-ingest-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending and not self._stopping:
+                self._condition.wait()
+            while self._pending and len(self._pending) < self.batch_size and not self._stopping:
+                remaining = self._pending[0][0] + self.flush_interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            count = min(self.batch_size, len(self._pending))
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                self._flush(batch)
+        except BaseException as exc:
+            # Errors of the writer itself are handled in _flush; this thread is
+            # done for, so don't leave the batch's submitters waiting. The next
+            # submit starts a new writer for whatever is still pending.
+            logger.exception("Ingest writer thread died")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        locations = [location for _, location, _ in batch]
+        # A submission may span two batches; it is done once its last fix is written
+        futures = {future for _, _, future in batch}
+        close_old_connections()
+        try:
+            self.writer(locations)
+        except Exception as exc:
+            logger.exception("Failed to write %d queued locations", len(locations))
+            INGEST_FIXES.inc(len(locations), path='queued', outcome='failed')
+            with self._condition:
+                self.failed += len(locations)
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            with self._condition:
+                self.written += len(locations)
+                waiting = {future for _, _, future in self._pending}
+            for future in futures:
+                if future not in waiting and not future.done():
+                    future.set_result(None)
+        finally:
+            close_old_connections()
+
+        finished = time.monotonic()
+        with self._condition:
+            self.flush_latency.observe(finished - started)
+            self.queue_wait.observe(started - batch[0][0])
+
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+
+QUEUE_DEPTH = CallbackGauge(
+    'bus_ingest_queue_depth', 'Fixes waiting for the background writer',
+    lambda: {(): _ingest_queue.depth()} if _ingest_queue is not None else {},
+)
+
+
+def queued_ingest_enabled():
+    return getattr(settings, 'BUS_INGEST_MODE', 'sync') == 'queued'
+
+
+def group_commit_enabled():
+    return getattr(settings, 'BUS_INGEST_MODE', 'sync') == 'group'
+
+
+def commit_timeout():
+    """Seconds a group-commit request waits for its transaction before answering 503"""
+    return getattr(settings, 'BUS_INGEST_COMMIT_TIMEOUT', 10)
+
+
+def get_ingest_queue():
+    """Return the process-wide ingest queue, creating it from settings on first use"""
+    global _ingest_queue
+    if _ingest_queue is None:
+        with _ingest_queue_lock:
+            if _ingest_queue is None:
+                _ingest_queue = IngestQueue(
+                    max_size=getattr(settings, 'BUS_INGEST_QUEUE_SIZE', 10000),
+                    batch_size=getattr(settings, 'BUS_INGEST_BATCH_SIZE', 500),
+                    # Requests waiting for their commit should not wait for a timer too
+                    flush_interval=0 if group_commit_enabled() else getattr(settings, 'BUS_INGEST_FLUSH_INTERVAL', 0.2),
+                )
+                atexit.register(_ingest_queue.stop)
+    return _ingest_queue
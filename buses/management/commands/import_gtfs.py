@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from buses.gtfs import GTFSFeed, import_feed
+
+
+class Command(BaseCommand):
+    help = 'Import routes, stops and shapes from a GTFS static feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='GTFS zip archive or directory')
+        parser.add_argument('--chunk-size', type=int, help='Rows written per bulk_create and transaction')
+        parser.add_argument('--no-shapes', action='store_true', help='Skip shapes.txt')
+
+    def handle(self, *args, **options):
+        try:
+            feed = GTFSFeed(options['feed'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        with feed:
+            try:
+                stats = import_feed(
+                    feed, chunk_size=options['chunk_size'], shapes=not options['no_shapes'], log=self.stdout.write,
+                )
+            except (FileNotFoundError, KeyError, ValueError) as exc:
+                raise CommandError(f'Invalid GTFS feed: {exc}')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Read {stats.read:,} rows and wrote {stats.written:,} in {stats.seconds:.1f}s '
+                f'({stats.read / stats.seconds:,.0f} rows/s)'
+            )
+        )
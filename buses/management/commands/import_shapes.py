@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from buses.gtfs import GTFSFeed, read_shapes, route_shape_ids
+from buses.models import Route, RouteShape
+
+
+class Command(BaseCommand):
+    help = 'Import route shapes from a GTFS feed (shapes.txt) for map matching'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='GTFS zip archive or directory')
+        parser.add_argument('--route', action='append', dest='routes', metavar='ROUTE_NUMBER',
+                            help='Only import the shape of this route (repeatable)')
+
+    def handle(self, *args, **options):
+        try:
+            feed = GTFSFeed(options['feed'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        with feed:
+            try:
+                # Each route gets the shape most of its trips follow
+                wanted = route_shape_ids(feed)
+                if options['routes']:
+                    wanted = {number: shape_id for number, shape_id in wanted.items() if number in options['routes']}
+                routes = Route.objects.in_bulk(list(wanted), field_name='route_number')
+                shapes = read_shapes(feed, {wanted[number] for number in routes})
+            except (FileNotFoundError, KeyError) as exc:
+                raise CommandError(f'Invalid GTFS feed: {exc}')
+
+        imported = 0
+        for number, route in routes.items():
+            points = shapes.get(wanted[number], [])
+            if len(points) < 2:
+                self.stdout.write(self.style.WARNING(f'Route {number}: shape {wanted[number]} has fewer than 2 points'))
+                continue
+            shape = RouteShape(route=route, shape_id=wanted[number])
+            shape.set_points(points)
+            shape.save()
+            imported += 1
+            self.stdout.write(f'Route {number}: {len(points)} points, {shape.length_m / 1000:.1f} km')
+
+        skipped = sorted(set(wanted) - set(routes))
+        if skipped:
+            self.stdout.write(self.style.WARNING(f'No route with number {", ".join(skipped)}; import the routes first'))
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} route shapes'))
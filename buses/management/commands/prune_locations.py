@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from buses.retention import RetentionPolicy, run_retention
+
+
+class Command(BaseCommand):
+    help = 'Archive, downsample and expire old bus location history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--raw-days', type=int, help='Keep every fix for this many days')
+        parser.add_argument('--keep-days', type=int, help='Delete fixes older than this many days')
+        parser.add_argument('--downsample-seconds', type=int,
+                            help='Keep one fix per bus per this many seconds after --raw-days')
+        parser.add_argument('--archive-dir', help='Directory for gzipped NDJSON day archives')
+        parser.add_argument('--chunk-size', type=int, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between delete chunks')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted without writing')
+
+    def handle(self, *args, **options):
+        try:
+            policy = RetentionPolicy(
+                raw_days=options['raw_days'],
+                keep_days=options['keep_days'],
+                downsample_seconds=options['downsample_seconds'],
+                archive_dir=options['archive_dir'],
+                chunk_size=options['chunk_size'],
+                pause=options['pause'],
+                dry_run=options['dry_run'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        stats = run_retention(policy, log=self.stdout.write)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Processed {stats['days']} days: archived {stats['archived']}, "
+                f"downsampled {stats['downsampled']}, expired {stats['expired']} rows"
+            )
+        )
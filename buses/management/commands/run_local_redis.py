@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # Development-only dependency
+    TcpFakeServer = None
+
+
+class Command(BaseCommand):
+    help = 'Serve a Redis-compatible stand-in for the channel layer (development and load tests only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=6379, help='Port to listen on')
+
+    def handle(self, *args, **options):
+        if TcpFakeServer is None:
+            raise CommandError('run_local_redis needs fakeredis: pip install "fakeredis[lua]"')
+
+        server = TcpFakeServer((options['host'], options['port']), server_type='redis')
+        self.stdout.write(self.style.SUCCESS(
+            f"Serving channel layer stand-in on redis://{options['host']}:{options['port']}/0 "
+            f"(export REDIS_URL to point workers at it, CTRL-C to stop)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
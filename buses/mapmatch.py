@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .geo import METERS_PER_DEGREE_LAT
+from .models import Bus, BusLocation, RouteShape
+
+try:
+    import numpy
+except ImportError:  # fall back to the pure Python path
+    numpy = None
+
+GRID_CELL_M = 100.0
+
+
+class ShapeIndex:
+    """Segments of a route shape in local meters, bucketed into a grid.
+
+    Segments are registered in every ``GRID_CELL_M`` cell their bounding box
+    touches, so a fix only has to be projected onto the segments near it.
+    With NumPy, the fixes of a batch are grouped by cell and each group is
+    projected onto its candidate segments in one vectorized step.
+    """
+
+    def __init__(self, points):
+        self.scale_x = METERS_PER_DEGREE_LAT * math.cos(math.radians(sum(lat for lat, _ in points) / len(points)))
+        xs = [lng * self.scale_x for _, lng in points]
+        ys = [lat * METERS_PER_DEGREE_LAT for lat, _ in points]
+
+        # Segment start, direction, squared length and distance along the shape at its start
+        self.segments = []
+        along = 0.0
+        for x1, y1, x2, y2 in zip(xs, ys, xs[1:], ys[1:]):
+            dx, dy = x2 - x1, y2 - y1
+            length_sq = dx * dx + dy * dy
+            if length_sq == 0:
+                continue
+            self.segments.append((x1, y1, dx, dy, length_sq, along))
+            along += math.sqrt(length_sq)
+        self.length_m = along
+
+        self.grid = {}
+        for index, (x1, y1, dx, dy, _, _) in enumerate(self.segments):
+            for cell in self.cells_between(min(x1, x1 + dx), min(y1, y1 + dy), max(x1, x1 + dx), max(y1, y1 + dy)):
+                self.grid.setdefault(cell, []).append(index)
+
+        if numpy is not None:
+            self.arrays = numpy.array(self.segments, dtype=float).reshape(-1, 6).T
+
+    def cells_between(self, min_x, min_y, max_x, max_y):
+        for column in range(math.floor(min_x / GRID_CELL_M), math.floor(max_x / GRID_CELL_M) + 1):
+            for row in range(math.floor(min_y / GRID_CELL_M), math.floor(max_y / GRID_CELL_M) + 1):
+                yield column, row
+
+    def candidates(self, cell, max_offset):
+        """Segments that may lie within max_offset of a point in the cell"""
+        column, row = cell
+        reach = math.ceil(max_offset / GRID_CELL_M)
+        found = set()
+        for neighbour_column in range(column - reach, column + reach + 1):
+            for neighbour_row in range(row - reach, row + reach + 1):
+                found.update(self.grid.get((neighbour_column, neighbour_row), ()))
+        return found
+
+    def match(self, points, max_offset):
+        """(matched lat, matched lng, distance along) for each (lat, lng) point, or None if off the shape"""
+        if not self.segments or not points:
+            return [None] * len(points)
+        if numpy is not None:
+            return self.match_vectorized(points, max_offset)
+        return [self.match_one(lat, lng, max_offset) for lat, lng in points]
+
+    def match_vectorized(self, points, max_offset):
+        coordinates = numpy.asarray(points, dtype=float)
+        px_all = coordinates[:, 1] * self.scale_x
+        py_all = coordinates[:, 0] * METERS_PER_DEGREE_LAT
+        columns = numpy.floor(px_all / GRID_CELL_M).astype(numpy.int64)
+        rows = numpy.floor(py_all / GRID_CELL_M).astype(numpy.int64)
+
+        matches = [None] * len(points)
+        # Group the fixes by grid cell; each group shares its candidate segments
+        cells, inverse = numpy.unique(numpy.stack([columns, rows], axis=1), axis=0, return_inverse=True)
+        order = numpy.argsort(inverse.ravel(), kind='stable')
+        bounds = numpy.searchsorted(inverse.ravel()[order], numpy.arange(len(cells) + 1))
+        for number, (column, row) in enumerate(cells.tolist()):
+            candidates = self.candidates((column, row), max_offset)
+            if not candidates:
+                continue
+            fixes = order[bounds[number]:bounds[number + 1]]
+            segments = numpy.fromiter(candidates, dtype=numpy.int64, count=len(candidates))
+            x1, y1, dx, dy, length_sq, along = self.arrays[:, segments]
+
+            px = px_all[fixes, None] - x1
+            py = py_all[fixes, None] - y1
+            t = numpy.clip((px * dx + py * dy) / length_sq, 0.0, 1.0)
+            offset_sq = (px - t * dx) ** 2 + (py - t * dy) ** 2
+            best = offset_sq.argmin(axis=1)
+            picked = numpy.arange(len(best))
+            t_best = t[picked, best]
+            latitudes = (y1[best] + t_best * dy[best]) / METERS_PER_DEGREE_LAT
+            longitudes = (x1[best] + t_best * dx[best]) / self.scale_x
+            distances = along[best] + t_best * numpy.sqrt(length_sq[best])
+            within = offset_sq[picked, best] <= max_offset * max_offset
+            for fix, ok, lat, lng, distance in zip(fixes.tolist(), within.tolist(), latitudes.tolist(),
+                                                   longitudes.tolist(), distances.tolist()):
+                if ok:
+                    matches[fix] = (lat, lng, distance)
+        return matches
+
+    def match_one(self, latitude, longitude, max_offset):
+        px0, py0 = longitude * self.scale_x, latitude * METERS_PER_DEGREE_LAT
+        cell = (math.floor(px0 / GRID_CELL_M), math.floor(py0 / GRID_CELL_M))
+
+        best = None
+        for index in self.candidates(cell, max_offset):
+            x1, y1, dx, dy, length_sq, along = self.segments[index]
+            px, py = px0 - x1, py0 - y1
+            t = min(1.0, max(0.0, (px * dx + py * dy) / length_sq))
+            offset_sq = (px - t * dx) ** 2 + (py - t * dy) ** 2
+            if offset_sq <= max_offset * max_offset and (best is None or offset_sq < best[0]):
+                best = (offset_sq, (y1 + t * dy) / METERS_PER_DEGREE_LAT, (x1 + t * dx) / self.scale_x,
+                        along + t * math.sqrt(length_sq))
+        return best[1:] if best is not None else None
+
+
+class MapMatcher:
+    """Per-route shape indexes, loaded on first use.
+
+    An index is dropped when its shape is saved in this process, and reloaded
+    after ``BUS_MAP_MATCH_SHAPE_MAX_AGE`` seconds to pick up shapes imported by
+    other processes (``import_shapes``, ``import_gtfs``).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def index_for(self, route_id):
+        max_age = getattr(settings, 'BUS_MAP_MATCH_SHAPE_MAX_AGE', 300)
+        with self._lock:
+            cached = self._indexes.get(route_id)
+            if cached is not None and time.monotonic() - cached[1] <= max_age:
+                return cached[0]
+        shape = RouteShape.objects.filter(route_id=route_id).only('polyline').first()
+        points = shape.points if shape is not None else []
+        # Routes without a shape are remembered too, so they cost no query per fix
+        index = ShapeIndex(points) if len(points) >= 2 else None
+        with self._lock:
+            self._indexes[route_id] = (index, time.monotonic())
+        return index
+
+    def invalidate(self, route_id):
+        with self._lock:
+            self._indexes.pop(route_id, None)
+
+    def match(self, locations):
+        """Set matched_latitude/matched_longitude/distance_along_route on unsaved locations"""
+        if not locations:
+            return
+        route_ids = self.route_ids(locations)
+        by_route = {}
+        for location in locations:
+            by_route.setdefault(route_ids.get(location.bus_id), []).append(location)
+
+        max_offset = getattr(settings, 'BUS_MAP_MATCH_MAX_OFFSET_M', 50)
+        for route_id, matched in by_route.items():
+            index = self.index_for(route_id) if route_id is not None else None
+            if index is None:
+                continue
+            results = index.match([(float(location.latitude), float(location.longitude)) for location in matched],
+                                  max_offset)
+            for location, result in zip(matched, results):
+                if result is not None:
+                    location.matched_latitude, location.matched_longitude, location.distance_along_route = (
+                        round(result[0], 7), round(result[1], 7), round(result[2], 1)
+                    )
+
+    def route_ids(self, locations):
+        """bus_id -> route_id, from loaded buses where possible and one query for the rest"""
+        route_ids = {}
+        missing = set()
+        for location in locations:
+            if BusLocation.bus.is_cached(location):
+                route_ids[location.bus_id] = location.bus.route_id
+            else:
+                missing.add(location.bus_id)
+        missing -= route_ids.keys()
+        if missing:
+            route_ids.update(Bus.objects.filter(id__in=missing).values_list('id', 'route_id'))
+        return route_ids
+
+
+map_matcher = MapMatcher()
+
+
+def match_locations(locations):
+    if getattr(settings, 'BUS_MAP_MATCH', True):
+        map_matcher.match(locations)
+
+
+@receiver(post_save, sender=RouteShape)
+@receiver(post_delete, sender=RouteShape)
+def invalidate_route_shape(sender, instance, **kwargs):
+    map_matcher.invalidate(instance.route_id)
@@ -0,0 +1,196 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Process-local metrics in the Prometheus text exposition format.
+#
+# Hot paths never take a lock: every thread updates its own cell, and a scrape
+# sums the cells. Cells of threads that have exited (Django runs each ASGI
+# request in a fresh thread) are folded into a shared total whenever a new
+# thread registers, so memory stays bounded by the number of live threads.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._cells = []  # [(thread, cell)]
+        self._retired = self.new_cell()
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def new_cell(self):
+        return {}
+
+    def merge(self, total, cell):
+        raise NotImplementedError
+
+    def _cell(self):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = self._local.cell = self.new_cell()
+            with self._lock:
+                alive = []
+                for thread, other in self._cells:
+                    if thread.is_alive():
+                        alive.append((thread, other))
+                    else:
+                        self.merge(self._retired, other)
+                alive.append((threading.current_thread(), cell))
+                self._cells = alive
+        return cell
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        """Sum of every thread's cell, as {label values: value}"""
+        with self._lock:
+            total = self.new_cell()
+            self.merge(total, self._retired)
+            for _, cell in self._cells:
+                # dict.copy() is atomic, so the owner thread may keep writing
+                self.merge(total, cell.copy())
+        return total
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                              for name, value in pairs) + '}'
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        cell = self._cell()
+        key = self._key(labels)
+        cell[key] = cell.get(key, 0) + amount
+
+    def merge(self, total, cell):
+        for key, value in cell.items():
+            total[key] = total.get(key, 0) + value
+
+    def samples(self):
+        return [f'{self.name}{self.format_labels(key)} {value}' for key, value in sorted(self.collect().items())]
+
+
+class Gauge(Counter):
+    """Up/down value summed over threads, e.g. open connections"""
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackGauge(Metric):
+    """Gauge read at scrape time from ``callback()``, which returns {label values: value}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        return [f'{self.name}{self.format_labels(key)} {value}' for key, value in sorted(self.callback().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames)
+
+    def observe(self, value, **labels):
+        cell = self._cell()
+        key = self._key(labels)
+        counts = cell.get(key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then the sum
+            counts = cell[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, total, cell):
+        for key, counts in cell.items():
+            current = total.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for index, value in enumerate(list(counts)):
+                current[index] += value
+
+    def samples(self):
+        lines = []
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {cumulative}')
+        return lines
+
+
+registry = []
+
+
+def exposition():
+    """All registered metrics in the Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.exposition())
+    return '\n'.join(lines) + '\n'
+
+
+# Ingest
+INGEST_SECONDS = Histogram(
+    'bus_ingest_stage_seconds', 'Time spent per location ingest stage', ['path', 'stage'],
+)
+INGEST_FIXES = Counter('bus_ingest_fixes_total', 'Location fixes received', ['path', 'outcome'])
+FILTERED_ROWS = Counter(
+    'bus_ingest_filtered_rows_total', 'Location fixes not stored by the GPS filter', ['path', 'reason'],
+)
+FILTERED_BROADCASTS = Counter(
+    'bus_ingest_filtered_broadcasts_total', 'Location fixes not broadcast by the GPS filter', ['path', 'reason'],
+)
+
+# HTTP
+HTTP_REQUESTS = Counter('bus_http_requests_total', 'HTTP requests handled', ['endpoint', 'method', 'status'])
+HTTP_SECONDS = Histogram('bus_http_request_seconds', 'HTTP request duration', ['endpoint'])
+HTTP_QUERIES = Histogram(
+    'bus_http_db_queries', 'Database queries per HTTP request', ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+
+# WebSockets
+WS_CONNECTIONS = Gauge('bus_ws_group_connections', 'Open WebSocket connections per group', ['group'])
+WS_FRAMES = Counter('bus_ws_frames_sent_total', 'Frames sent to WebSocket clients', ['consumer', 'kind'])
+WS_DROPPED = Counter(
+    'bus_ws_dropped_updates_total', 'Location updates not delivered to a client', ['consumer', 'reason'],
+)
+
+
+def group_label(group):
+    """Grid cell groups are collapsed into one label to keep cardinality bounded"""
+    return 'cell' if group.startswith('cell_') else group
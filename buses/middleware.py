@@ -0,0 +1,81 @@
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import HTTP_QUERIES, HTTP_REQUESTS, HTTP_SECONDS
+
+# Query counter of the request being handled. Connections are per thread, so
+# every connection counts into whichever request's context runs the query;
+# sync_to_async threads inherit the context of the request that called them.
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+class QueryCounter:
+    """Database queries of one request, from whichever threads ran them"""
+
+    def __init__(self):
+        self.count = 0
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.count += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender=None, connection=connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class MetricsMiddleware:
+    """Records duration, status and database query count of every request per endpoint"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        started = time.perf_counter()
+        install_query_counter(connection=connection)
+        queries = QueryCounter()
+        token = _request_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, time.perf_counter() - started, queries.count)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        queries = QueryCounter()
+        # Queries run in sync_to_async threads on their own connections; the
+        # context carries the counter there
+        token = _request_queries.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, time.perf_counter() - started, queries.count)
+        return response
+
+    def record(self, request, response, seconds, query_count):
+        # Route names, not paths, keep the label set bounded
+        match = request.resolver_match
+        endpoint = match.view_name if match is not None else 'unmatched'
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        HTTP_SECONDS.observe(seconds, endpoint=endpoint)
+        HTTP_QUERIES.observe(query_count, endpoint=endpoint)
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_latest_locations(apps, schema_editor):
+    Bus = apps.get_model('buses', 'Bus')
+    BusLocation = apps.get_model('buses', 'BusLocation')
+    BusLatestLocation = apps.get_model('buses', 'BusLatestLocation')
+
+    newest = BusLocation.objects.filter(bus=OuterRef('pk')).order_by('-timestamp')
+    buses = (
+        Bus.objects
+        .annotate(
+            latest_id=Subquery(newest.values('pk')[:1]),
+            latest_timestamp=Subquery(newest.values('timestamp')[:1]),
+        )
+        .filter(latest_id__isnull=False)
+        .values_list('pk', 'latest_id', 'latest_timestamp')
+    )
+    BusLatestLocation.objects.bulk_create(
+        BusLatestLocation(bus_id=bus_id, location_id=location_id, timestamp=timestamp)
+        for bus_id, location_id, timestamp in buses
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusLatestLocation',
+            fields=[
+                ('bus', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_location', serialize=False, to='buses.bus')),
+                ('timestamp', models.DateTimeField()),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='buses.buslocation')),
+            ],
+        ),
+        migrations.RunPython(backfill_latest_locations, migrations.RunPython.noop),
+    ]
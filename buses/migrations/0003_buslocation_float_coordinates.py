@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:54
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0002_buslatestlocation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='buslocation',
+            name='latitude',
+            field=models.FloatField(validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AlterField(
+            model_name='buslocation',
+            name='longitude',
+            field=models.FloatField(validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0003_buslocation_float_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteShape',
+            fields=[
+                ('route', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shape', serialize=False, to='buses.route')),
+                ('shape_id', models.CharField(blank=True, max_length=100)),
+                ('polyline', models.TextField()),
+                ('length_m', models.FloatField(default=0.0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='buslocation',
+            name='distance_along_route',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='buslocation',
+            name='matched_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='buslocation',
+            name='matched_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:45
+
+import buses.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0004_route_shapes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='buslatestlocation',
+            name='location',
+            field=models.ForeignKey(on_delete=buses.models.previous_location, related_name='+', to='buses.buslocation'),
+        ),
+    ]
@@ -1,6 +1,20 @@
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import connections, models, transaction
+from django.db.models import Count, Prefetch, Q
 from django.utils import timezone
 
+from .geo import path_length_m
+from .signals import locations_recorded
+from .simplify import decode_polyline, encode_polyline
+
+
+class RouteQuerySet(models.QuerySet):
+    def with_details(self):
+        """Prefetch stops and annotate the active bus count shown by RouteSerializer"""
+        return self.prefetch_related('stops').annotate(
+            active_buses_count=Count('buses', filter=Q(buses__is_active=True))
+        )
+
 
 class Route(models.Model):
     """Represents a bus route in the city"""
@@ -12,6 +26,8 @@ class Route(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = RouteQuerySet.as_manager()
+
     def __str__(self):
         return f"Route {self.route_number}: {self.name}"
 
@@ -19,6 +35,23 @@ class Route(models.Model):
         ordering = ['route_number']
 
 
+class BusQuerySet(models.QuerySet):
+    def with_tracking_data(self):
+        """Join the route and latest location shown by BusTrackingSerializer"""
+        return self.select_related('route', 'latest_location__location')
+
+    def with_details(self, recent_locations=10):
+        """Load everything BusSerializer shows with a fixed number of queries"""
+        return self.select_related('latest_location__location').prefetch_related(
+            Prefetch('route', queryset=Route.objects.with_details()),
+            Prefetch(
+                'locations',
+                queryset=BusLocation.objects.order_by('-timestamp')[:recent_locations],
+                to_attr='prefetched_recent_locations',
+            ),
+        )
+
+
 class Bus(models.Model):
     """Represents a bus vehicle"""
     bus_number = models.CharField(max_length=20, unique=True)
@@ -30,33 +63,67 @@ class Bus(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = BusQuerySet.as_manager()
+
     def __str__(self):
         return f"Bus {self.bus_number} - Route {self.route.route_number}"
 
     @property
     def current_location(self):
         """Get the most recent location of this bus"""
-        return self.locations.order_by('-timestamp').first()
+        latest = getattr(self, 'latest_location', None)
+        return latest.location if latest is not None else None
 
     class Meta:
         ordering = ['bus_number']
         verbose_name_plural = 'Buses'
 
 
+class BusLocationManager(models.Manager):
+    def bulk_record(self, locations):
+        """Insert many locations in one transaction and refresh the latest-location table"""
+        from .mapmatch import match_locations
+
+        match_locations(locations)
+        with transaction.atomic():
+            self.bulk_create(locations)
+            BusLatestLocation.objects.record(locations)
+        return locations
+
+
 class BusLocation(models.Model):
     """Represents a bus location at a specific time"""
     bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='locations')
-    latitude = models.DecimalField(max_digits=10, decimal_places=8)
-    longitude = models.DecimalField(max_digits=11, decimal_places=8)
+    # Plain doubles: sub-millimetre precision without Decimal conversions on every fix
+    latitude = models.FloatField(validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(validators=[MinValueValidator(-180), MaxValueValidator(180)])
     speed = models.FloatField(default=0.0)  # km/h
     heading = models.FloatField(null=True, blank=True)  # degrees (0-360)
     accuracy = models.FloatField(null=True, blank=True)  # GPS accuracy in meters
     timestamp = models.DateTimeField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Fix projected onto its route's shape (see mapmatch.py); empty without a shape or when off route
+    matched_latitude = models.FloatField(null=True, blank=True)
+    matched_longitude = models.FloatField(null=True, blank=True)
+    distance_along_route = models.FloatField(null=True, blank=True)  # meters from the start of the shape
+
+    objects = BusLocationManager()
 
     def __str__(self):
         return f"{self.bus.bus_number} at ({self.latitude}, {self.longitude}) - {self.timestamp}"
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            return
+
+        from .mapmatch import match_locations
+
+        match_locations([self])
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            BusLatestLocation.objects.db_manager(self._state.db).record([self])
+
     class Meta:
         ordering = ['-timestamp']
         indexes = [
@@ -65,6 +132,90 @@ class BusLocation(models.Model):
         ]
 
 
+def newest_per_bus(locations):
+    """Map each bus id to the most recent of the given locations"""
+    newest = {}
+    for location in locations:
+        current = newest.get(location.bus_id)
+        if current is None or location.timestamp >= current.timestamp:
+            newest[location.bus_id] = location
+    return newest
+
+
+class BusLatestLocationManager(models.Manager):
+    def record(self, locations):
+        """Point each bus at the newest of the given locations, unless a newer one is already stored"""
+        newest = newest_per_bus(locations)
+        if not newest:
+            return
+
+        # The timestamp check is part of the upsert, so a concurrent writer
+        # holding an older fix can never replace a newer one
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        opts = self.model._meta
+        table = quote(opts.db_table)
+        bus, location, timestamp = (opts.get_field(name) for name in ('bus', 'location', 'timestamp'))
+        columns = [quote(field.column) for field in (bus, location, timestamp)]
+
+        rows = list(newest.values())
+        batch_size = connection.ops.bulk_batch_size(columns, rows) or len(rows)
+        recorded = []
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                params = []
+                for row in batch:
+                    params += [row.bus_id, row.pk, timestamp.get_db_prep_value(row.timestamp, connection)]
+                cursor.execute(
+                    f'INSERT INTO {table} ({", ".join(columns)}) '
+                    f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                    f'ON CONFLICT ({columns[0]}) DO UPDATE SET '
+                    f'{columns[1]} = excluded.{columns[1]}, {columns[2]} = excluded.{columns[2]} '
+                    f'WHERE excluded.{columns[2]} >= {table}.{columns[2]} '
+                    f'RETURNING {columns[0]}',
+                    params,
+                )
+                recorded += [newest[bus_id] for bus_id, in cursor.fetchall()]
+
+        transaction.on_commit(
+            lambda: locations_recorded.send(sender=BusLatestLocation, locations=recorded)
+        )
+
+
+def previous_location(collector, field, sub_objs, using):
+    """on_delete for BusLatestLocation.location: fall back to the bus's newest remaining fix.
+
+    Buses left without any fix are dropped from the table.
+    """
+    deleted = {location.pk for location in collector.data.get(field.related_model, ())}
+    for latest in sub_objs:
+        remaining = (
+            field.related_model.objects.using(using)
+            .filter(bus_id=latest.pk)
+            .order_by('-timestamp')
+            .values_list('pk', 'timestamp')
+        )
+        previous = next((row for row in remaining.iterator() if row[0] not in deleted), None)
+        if previous is None:
+            models.CASCADE(collector, field, [latest], using)
+        else:
+            collector.add_field_update(field, previous[0], [latest])
+            collector.add_field_update(latest._meta.get_field('timestamp'), previous[1], [latest])
+
+
+class BusLatestLocation(models.Model):
+    """One row per bus pointing at its most recent location"""
+    bus = models.OneToOneField(Bus, on_delete=models.CASCADE, primary_key=True, related_name='latest_location')
+    location = models.ForeignKey(BusLocation, on_delete=previous_location, related_name='+')
+    timestamp = models.DateTimeField()
+
+    objects = BusLatestLocationManager()
+
+    def __str__(self):
+        return f"{self.bus_id} latest at {self.timestamp}"
+
+
 class RouteStop(models.Model):
     """Represents a bus stop on a route"""
     route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='stops')
@@ -83,3 +234,29 @@ class RouteStop(models.Model):
     class Meta:
         ordering = ['route', 'stop_order']
         unique_together = ['route', 'stop_order']
+
+
+class RouteShape(models.Model):
+    """Road geometry of a route, e.g. from GTFS shapes.txt"""
+    route = models.OneToOneField(Route, on_delete=models.CASCADE, primary_key=True, related_name='shape')
+    shape_id = models.CharField(max_length=100, blank=True)  # GTFS shape_id it was imported from
+    polyline = models.TextField()  # Google encoded polyline, precision 6
+    length_m = models.FloatField(default=0.0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    POLYLINE_PRECISION = 6
+
+    def __str__(self):
+        return f"Shape of route {self.route_id} ({self.length_m:.0f} m)"
+
+    @property
+    def points(self):
+        return decode_polyline(self.polyline, self.POLYLINE_PRECISION)
+
+    def set_points(self, points):
+        """Store (lat, lng) points as the polyline"""
+        self.polyline = encode_polyline(points, self.POLYLINE_PRECISION)
+
+    def save(self, *args, **kwargs):
+        self.length_m = path_length_m(self.points)
+        super().save(*args, **kwargs)
@@ -0,0 +1,166 @@
+import math
+import threading
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.conf import settings
+
+from .geo import METERS_PER_DEGREE_LAT, haversine_m
+from .models import BusLocation
+
+
+def bearing_deg(lat1, lng1, lat2, lng2):
+    """Initial bearing from the first point to the second, clockwise from north"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dlambda = math.radians(lng2 - lng1)
+    x = math.sin(dlambda) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(dlambda)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def heading_change(previous, current):
+    """Signed smallest turn from one heading to another, in degrees (-180, 180]"""
+    change = (current - previous) % 360
+    return change - 360 if change > 180 else change
+
+
+# Default of MotionTracker.motion(previous=...): look the previous fix up
+LOOKUP = object()
+
+
+class MotionTracker:
+    """Dead reckoning from the newest fixes of each bus.
+
+    A bus moves at its reported speed and heading; when the device reports no
+    heading, speed and heading are derived from the distance to its previous
+    fix. The turn rate between the last two fixes is kept (at most
+    ``BUS_MOTION_MAX_TURN_DEG`` degrees in total), so a bus rounding a corner
+    keeps curving. Clients animate markers along the predicted positions until
+    the next fix arrives instead of jumping between fixes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # bus_id -> (timestamp, latitude, longitude, heading) of the newest fix seen
+        self._fixes = {}
+
+    def motion(self, location, previous=LOOKUP):
+        """Velocity and predicted positions for a fix, as sent to clients.
+
+        ``previous`` is the fix before it as returned by ``previous_fixes``;
+        by default it is looked up.
+        """
+        latitude, longitude = float(location.latitude), float(location.longitude)
+        if previous is LOOKUP:
+            previous = self.previous_fixes([location])[0]
+
+        speed = (location.speed or 0.0) / 3.6
+        heading = location.heading
+        turn_rate = 0.0
+        if previous is not None:
+            elapsed = (location.timestamp - previous[0]).total_seconds()
+            if heading is None:
+                speed = haversine_m(previous[1], previous[2], latitude, longitude) / elapsed
+                if speed >= getattr(settings, 'BUS_MOTION_MIN_SPEED', 0.5):
+                    heading = bearing_deg(previous[1], previous[2], latitude, longitude)
+            if heading is not None and previous[3] is not None:
+                turn_rate = heading_change(previous[3], heading) / elapsed
+
+        with self._lock:
+            current = self._fixes.get(location.bus_id)
+            if current is None or current[0] < location.timestamp:
+                self._fixes[location.bus_id] = (location.timestamp, latitude, longitude, heading)
+
+        moving = heading is not None and speed >= getattr(settings, 'BUS_MOTION_MIN_SPEED', 0.5)
+        if not moving:
+            speed = turn_rate = 0.0
+        direction = math.radians(heading or 0.0)
+        return {
+            'speed_mps': round(speed, 2),
+            'heading': None if heading is None else round(float(heading), 1),
+            # m/s, for clients that extrapolate themselves
+            'velocity': {
+                'north': round(speed * math.cos(direction), 2),
+                'east': round(speed * math.sin(direction), 2),
+            },
+            'turn_rate': round(turn_rate, 2),  # degrees per second, positive clockwise
+            'valid_for': self.horizon(),
+            'predicted': self.predict(latitude, longitude, speed, heading, turn_rate) if moving else [],
+        }
+
+    def previous_fixes(self, locations):
+        """(timestamp, latitude, longitude, heading) of the fix before each one, if recent.
+
+        Fixes not remembered in memory, for example because another worker
+        stored them, are read from the database in one query for all locations.
+        """
+        max_gap = getattr(settings, 'BUS_MOTION_MAX_GAP', 60)
+
+        def recent(location, fix):
+            return fix is not None and 0 < (location.timestamp - fix[0]).total_seconds() <= max_gap
+
+        with self._lock:
+            previous = [self._fixes.get(location.bus_id) for location in locations]
+        missing = [index for index, location in enumerate(locations) if not recent(location, previous[index])]
+        if not missing:
+            return previous
+
+        # Only rows within max_gap of some fix can be its previous one
+        rows = BusLocation.objects.filter(
+            bus_id__in={locations[index].bus_id for index in missing},
+            timestamp__gte=min(locations[index].timestamp for index in missing) - timedelta(seconds=max_gap),
+            timestamp__lt=max(locations[index].timestamp for index in missing),
+        ).order_by('timestamp').values_list('bus_id', 'timestamp', 'latitude', 'longitude', 'heading')
+        by_bus = {}
+        for bus_id, *fix in rows:
+            by_bus.setdefault(bus_id, []).append(tuple(fix))
+        for index in missing:
+            location = locations[index]
+            fixes = by_bus.get(location.bus_id, [])
+            position = bisect_left(fixes, (location.timestamp,))
+            fix = fixes[position - 1] if position else None
+            previous[index] = fix if recent(location, fix) else None
+        return previous
+
+    def horizon(self):
+        return getattr(settings, 'BUS_MOTION_HORIZON', 30)
+
+    def predict(self, latitude, longitude, speed, heading, turn_rate):
+        """Positions every BUS_MOTION_STEP seconds up to the horizon, turning at most BUS_MOTION_MAX_TURN_DEG"""
+        step = getattr(settings, 'BUS_MOTION_STEP', 5)
+        max_turn = getattr(settings, 'BUS_MOTION_MAX_TURN_DEG', 90)
+        predicted = []
+        turned = 0.0
+        elapsed = 0
+        while elapsed < self.horizon():
+            # One-second substeps keep the curve smooth when the bus is turning
+            for _ in range(step):
+                turn = max(-max_turn - turned, min(max_turn - turned, turn_rate))
+                turned += turn
+                direction = math.radians(heading + turned - turn / 2)
+                latitude += speed * math.cos(direction) / METERS_PER_DEGREE_LAT
+                longitude += speed * math.sin(direction) / (
+                    METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 1e-6)
+                )
+            elapsed += step
+            predicted.append({'offset': elapsed, 'latitude': round(latitude, 7), 'longitude': round(longitude, 7)})
+        return predicted
+
+
+motion_tracker = MotionTracker()
+
+
+def location_motion(location):
+    """Motion of a fix, computed once and kept on the instance"""
+    motion = getattr(location, 'motion', None)
+    if motion is None:
+        motion = location.motion = motion_tracker.motion(location)
+    return motion
+
+
+def locations_motion(locations):
+    """location_motion for many fixes, with one query for the previous fixes missing from memory"""
+    pending = [location for location in locations if getattr(location, 'motion', None) is None]
+    if pending:
+        for location, previous in zip(pending, motion_tracker.previous_fixes(pending)):
+            location.motion = motion_tracker.motion(location, previous)
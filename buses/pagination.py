@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class LocationCursorPagination(CursorPagination):
+    """Opt-in cursor pagination for location history, newest first.
+
+    Responses stay plain lists unless the client asks for a page with
+    ``?page_size=`` or follows a ``?cursor=`` link, so existing clients keep working.
+    """
+    ordering = '-timestamp'
+    page_size = 500
+    page_size_query_param = 'page_size'
+    max_page_size = 5000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -0,0 +1,206 @@
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, time as dt_time, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import BusLatestLocation, BusLocation
+
+ARCHIVE_FIELDS = [
+    'id', 'bus_id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'timestamp',
+    'matched_latitude', 'matched_longitude', 'distance_along_route',
+]
+
+
+class RetentionPolicy:
+    """How long BusLocation history is kept and in what shape.
+
+    Fixes newer than ``raw_days`` are untouched. Older days are first written
+    to a gzipped NDJSON archive file, then thinned to one fix per bus per
+    ``downsample_seconds``; days older than ``keep_days`` are removed from the
+    table entirely. The last day archived and thinned is recorded in the
+    archive directory, so the next run starts after it. Deletes run in chunks
+    of ``chunk_size`` rows, each in its own short transaction, optionally
+    pausing ``pause`` seconds in between.
+    """
+
+    def __init__(self, raw_days=None, keep_days=None, downsample_seconds=None,
+                 archive_dir=None, chunk_size=None, pause=0.0, dry_run=False):
+        self.raw_days = raw_days if raw_days is not None else getattr(settings, 'BUS_LOCATION_RAW_DAYS', 7)
+        self.keep_days = keep_days if keep_days is not None else getattr(settings, 'BUS_LOCATION_KEEP_DAYS', 90)
+        self.downsample_seconds = (
+            downsample_seconds if downsample_seconds is not None
+            else getattr(settings, 'BUS_LOCATION_DOWNSAMPLE_SECONDS', 60)
+        )
+        self.archive_dir = Path(archive_dir or getattr(settings, 'BUS_LOCATION_ARCHIVE_DIR', 'location_archive'))
+        self.chunk_size = chunk_size or getattr(settings, 'BUS_LOCATION_DELETE_CHUNK', 2000)
+        self.pause = pause
+        self.dry_run = dry_run
+        if self.keep_days < self.raw_days:
+            raise ValueError('keep_days must be at least raw_days')
+
+
+def day_bounds(day):
+    start = datetime.combine(day, dt_time.min, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def archive_path(policy, day):
+    return policy.archive_dir / f'bus_locations_{day.isoformat()}.ndjson.gz'
+
+
+def progress_path(policy):
+    return policy.archive_dir / 'processed_through.txt'
+
+
+def read_progress(policy):
+    """The last day archived and downsampled by an earlier run, or None"""
+    try:
+        return date.fromisoformat(progress_path(policy).read_text().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_progress(policy, day):
+    if policy.dry_run:
+        return
+    policy.archive_dir.mkdir(parents=True, exist_ok=True)
+    partial = progress_path(policy).with_suffix('.partial')
+    partial.write_text(day.isoformat())
+    os.replace(partial, progress_path(policy))
+
+
+def archive_day(policy, day):
+    """Write every fix of a day to its archive file once; returns rows written"""
+    path = archive_path(policy, day)
+    if path.exists() or policy.dry_run:
+        return 0
+
+    start, end = day_bounds(day)
+    rows = (
+        BusLocation.objects
+        .filter(timestamp__gte=start, timestamp__lt=end)
+        .order_by('timestamp')
+        .values_list(*ARCHIVE_FIELDS)
+        .iterator(chunk_size=policy.chunk_size)
+    )
+
+    policy.archive_dir.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix('.partial')
+    written = 0
+    with gzip.open(partial, 'wt', encoding='utf-8') as archive:
+        for row in rows:
+            record = dict(zip(ARCHIVE_FIELDS, row))
+            record['timestamp'] = record['timestamp'].isoformat()
+            archive.write(json.dumps(record) + '\n')
+            written += 1
+
+    if not written:
+        partial.unlink()
+        return 0
+    # Only a complete file counts as archived
+    os.replace(partial, path)
+    return written
+
+
+def delete_ids(policy, ids):
+    """Delete rows in short chunked transactions; returns rows deleted"""
+    if policy.dry_run:
+        return len(ids)
+    deleted = 0
+    for offset in range(0, len(ids), policy.chunk_size):
+        chunk = ids[offset:offset + policy.chunk_size]
+        deleted += BusLocation.objects.filter(pk__in=chunk).delete()[1].get(BusLocation._meta.label, 0)
+        if policy.pause:
+            time.sleep(policy.pause)
+    return deleted
+
+
+def downsample_day(policy, day):
+    """Keep the first fix of each bus in every downsample interval of a day"""
+    start, end = day_bounds(day)
+    day_rows = BusLocation.objects.filter(timestamp__gte=start, timestamp__lt=end).exclude(
+        pk__in=BusLatestLocation.objects.values('location_id')
+    )
+    bus_ids = day_rows.values_list('bus_id', flat=True).distinct().order_by()
+
+    deleted = 0
+    for bus_id in list(bus_ids):
+        drop = []
+        last_bucket = None
+        rows = day_rows.filter(bus_id=bus_id).order_by('timestamp').values_list('id', 'timestamp')
+        for location_id, timestamp in rows.iterator(chunk_size=policy.chunk_size):
+            bucket = int((timestamp - start).total_seconds() // policy.downsample_seconds)
+            if bucket == last_bucket:
+                drop.append(location_id)
+            last_bucket = bucket
+        deleted += delete_ids(policy, drop)
+    return deleted
+
+
+def expire_before(policy, day):
+    """Remove every fix before a day, except those still referenced as a bus's latest location.
+
+    Deletes walk the id range of those rows ``chunk_size`` ids at a time
+    instead of loading their ids.
+    """
+    start, _ = day_bounds(day)
+    rows = BusLocation.objects.filter(timestamp__lt=start).exclude(
+        pk__in=BusLatestLocation.objects.values('location_id')
+    )
+    if policy.dry_run:
+        return rows.count()
+
+    bounds = rows.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return 0
+    deleted = 0
+    for low in range(bounds['first'], bounds['last'] + 1, policy.chunk_size):
+        chunk = rows.filter(pk__gte=low, pk__lt=low + policy.chunk_size).delete()[1].get(BusLocation._meta.label, 0)
+        deleted += chunk
+        if chunk and policy.pause:
+            time.sleep(policy.pause)
+    return deleted
+
+
+def run_retention(policy=None, now=None, log=None):
+    """Archive, downsample and expire location history; safe to run repeatedly (e.g. from cron)"""
+    policy = policy or RetentionPolicy()
+    now = now or timezone.now()
+    log = log or (lambda message: None)
+
+    oldest = BusLocation.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+    stats = {'days': 0, 'archived': 0, 'downsampled': 0, 'expired': 0}
+    if oldest is None:
+        return stats
+
+    # Only whole days strictly before the cutoffs are touched
+    raw_cutoff = (now - timedelta(days=policy.raw_days)).astimezone(dt_timezone.utc).date()
+    keep_cutoff = (now - timedelta(days=policy.keep_days)).astimezone(dt_timezone.utc).date()
+
+    day = oldest.astimezone(dt_timezone.utc).date()
+    progress = read_progress(policy)
+    if progress is not None:
+        day = max(day, progress + timedelta(days=1))
+    while day < raw_cutoff:
+        archived = archive_day(policy, day)
+        # Days past keep_days are only archived; expire_before removes them
+        downsampled = downsample_day(policy, day) if day >= keep_cutoff else 0
+        write_progress(policy, day)
+
+        stats['days'] += 1
+        stats['archived'] += archived
+        stats['downsampled'] += downsampled
+        if archived or downsampled:
+            log(f'{day}: archived {archived}, downsampled {downsampled}')
+        day += timedelta(days=1)
+
+    stats['expired'] = expire_before(policy, keep_cutoff)
+    if stats['expired']:
+        log(f'before {keep_cutoff}: expired {stats["expired"]}')
+    return stats
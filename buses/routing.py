@@ -3,5 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/buses/$', consumers.BusTrackingConsumer.as_asgi()),
-    re_path(r'ws/route/(?P<route_id>\w+)/$', consumers.RouteTrackingConsumer.as_asgi()),
+    re_path(r'ws/route/(?P<route_id>\d+)/$', consumers.RouteTrackingConsumer.as_asgi()),
 ]
\ No newline at end of file
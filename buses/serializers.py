@@ -1,3 +1,4 @@
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Route, Bus, BusLocation, RouteStop
 
@@ -18,13 +19,16 @@ class RouteSerializer(serializers.ModelSerializer):
                  'stops', 'buses_count', 'created_at', 'updated_at']
 
     def get_buses_count(self, obj):
+        if hasattr(obj, 'active_buses_count'):
+            return obj.active_buses_count
         return obj.buses.filter(is_active=True).count()
 
 
 class BusLocationSerializer(serializers.ModelSerializer):
     class Meta:
         model = BusLocation
-        fields = ['id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'timestamp']
+        fields = ['id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'timestamp',
+                  'matched_latitude', 'matched_longitude', 'distance_along_route']
 
 
 class BusSerializer(serializers.ModelSerializer):
@@ -39,8 +43,10 @@ class BusSerializer(serializers.ModelSerializer):
                  'capacity', 'is_active', 'current_location', 'recent_locations', 'created_at', 'updated_at']
 
     def get_recent_locations(self, obj):
-        # Get last 10 locations for this bus
-        locations = obj.locations.order_by('-timestamp')[:10]
+        # Get last 10 locations for this bus, prefetched by Bus.objects.with_details()
+        locations = getattr(obj, 'prefetched_recent_locations', None)
+        if locations is None:
+            locations = obj.locations.order_by('-timestamp')[:10]
         return BusLocationSerializer(locations, many=True).data
 
 
@@ -50,6 +56,53 @@ class BusLocationCreateSerializer(serializers.ModelSerializer):
         fields = ['latitude', 'longitude', 'speed', 'heading', 'accuracy']
 
 
+class BusLocationBatchListSerializer(serializers.ListSerializer):
+    """Validates a batch of fixes with a single bus lookup and stores them with bulk_create"""
+
+    def validate(self, attrs):
+        bus_ids = {item['bus_id'] for item in attrs}
+        buses = Bus.objects.filter(is_active=True).only('id', 'bus_number', 'route_id').in_bulk(bus_ids)
+        unknown = sorted(bus_ids - buses.keys())
+        if unknown:
+            raise serializers.ValidationError(f"Unknown or inactive bus ids: {unknown}")
+        for item in attrs:
+            item['bus'] = buses[item['bus_id']]
+        return attrs
+
+    def build_locations(self, validated_data):
+        """Turn validated fixes into unsaved BusLocation instances"""
+        now = timezone.now()
+        return [
+            BusLocation(
+                bus=item['bus'],
+                latitude=item['lat'],
+                longitude=item['lng'],
+                speed=item.get('speed', 0.0),
+                heading=item.get('heading'),
+                accuracy=item.get('accuracy'),
+                timestamp=item.get('timestamp') or now,
+            )
+            for item in validated_data
+        ]
+
+    def create(self, validated_data):
+        return BusLocation.objects.bulk_record(self.build_locations(validated_data))
+
+
+class BusLocationBatchItemSerializer(serializers.Serializer):
+    """A single fix in a batched ingest request"""
+    bus_id = serializers.IntegerField()
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    speed = serializers.FloatField(required=False, default=0.0)
+    heading = serializers.FloatField(required=False, allow_null=True, min_value=0, max_value=360)
+    accuracy = serializers.FloatField(required=False, allow_null=True, min_value=0)
+    timestamp = serializers.DateTimeField(required=False, allow_null=True)
+
+    class Meta:
+        list_serializer_class = BusLocationBatchListSerializer
+
+
 class BusTrackingSerializer(serializers.ModelSerializer):
     """Optimized serializer for real-time tracking"""
     route_number = serializers.CharField(source='route.route_number', read_only=True)
@@ -58,4 +111,23 @@ class BusTrackingSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Bus
-        fields = ['id', 'bus_number', 'route_number', 'route_color', 'current_location']
\ No newline at end of file
+        fields = ['id', 'bus_number', 'route_number', 'route_color', 'current_location']
+
+class NearbyQuerySerializer(serializers.Serializer):
+    """Query parameters of the nearby endpoints"""
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    radius = serializers.FloatField(required=False, default=500, min_value=1, max_value=50000)  # meters
+    limit = serializers.IntegerField(required=False, default=50, min_value=1, max_value=500)
+
+
+class FleetQuerySerializer(serializers.Serializer):
+    """Query parameters of the tracking endpoint"""
+    route = serializers.IntegerField(required=False, min_value=1)
+
+
+class TrackQuerySerializer(serializers.Serializer):
+    """Simplification options of the bus location history endpoint"""
+    simplify = serializers.FloatField(required=False, min_value=0)  # tolerance in meters
+    max_points = serializers.IntegerField(required=False, min_value=2)
+    encoding = serializers.ChoiceField(choices=['json', 'polyline'], required=False, default='json')
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after the latest-location table moved on, once the transaction commits.
+# ``locations`` holds the new latest BusLocation of every bus that changed.
+locations_recorded = Signal()
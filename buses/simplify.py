@@ -0,0 +1,118 @@
+import heapq
+import math
+
+from .geo import METERS_PER_DEGREE_LAT
+
+try:
+    import numpy
+except ImportError:  # fall back to the pure Python path
+    numpy = None
+
+
+def project_to_meters(points):
+    """Equirectangular projection of (lat, lng) points around their mean latitude"""
+    mean_lat = sum(lat for lat, _ in points) / len(points)
+    scale_x = METERS_PER_DEGREE_LAT * math.cos(math.radians(mean_lat))
+    xs = [lng * scale_x for _, lng in points]
+    ys = [lat * METERS_PER_DEGREE_LAT for lat, _ in points]
+    if numpy is not None:
+        return numpy.asarray(xs), numpy.asarray(ys)
+    return xs, ys
+
+
+def farthest_point(xs, ys, start, end):
+    """Return (distance, index) of the point between start and end farthest from segment start-end"""
+    ax, ay, bx, by = xs[start], ys[start], xs[end], ys[end]
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+
+    if numpy is not None:
+        px, py = xs[start + 1:end] - ax, ys[start + 1:end] - ay
+        if length_sq == 0:
+            distances = numpy.hypot(px, py)
+        else:
+            t = numpy.clip((px * dx + py * dy) / length_sq, 0.0, 1.0)
+            distances = numpy.hypot(px - t * dx, py - t * dy)
+        index = int(numpy.argmax(distances))
+        return float(distances[index]), start + 1 + index
+
+    best = (-1.0, start)
+    for index in range(start + 1, end):
+        px, py = xs[index] - ax, ys[index] - ay
+        t = 0.0 if length_sq == 0 else min(1.0, max(0.0, (px * dx + py * dy) / length_sq))
+        distance = math.hypot(px - t * dx, py - t * dy)
+        if distance > best[0]:
+            best = (distance, index)
+    return best
+
+
+def simplify_track(points, tolerance_m=0.0, max_points=None):
+    """Douglas-Peucker simplification of (lat, lng) points; returns the indices to keep.
+
+    Ranges are split in order of decreasing error, so the work done is
+    proportional to the number of points kept rather than the input size.
+    Splitting stops once the largest remaining error is within ``tolerance_m``
+    meters or ``max_points`` points are kept.
+    """
+    count = len(points)
+    if count <= 2 or (max_points is not None and max_points >= count and not tolerance_m):
+        return list(range(count))
+
+    xs, ys = project_to_meters(points)
+    kept = {0, count - 1}
+    heap = []
+
+    def push(start, end):
+        if end - start >= 2:
+            distance, index = farthest_point(xs, ys, start, end)
+            heapq.heappush(heap, (-distance, start, end, index))
+
+    push(0, count - 1)
+    while heap and (max_points is None or len(kept) < max_points):
+        negative_distance, start, end, index = heapq.heappop(heap)
+        if -negative_distance <= tolerance_m:
+            break
+        kept.add(index)
+        push(start, index)
+        push(index, end)
+    return sorted(kept)
+
+
+def encode_polyline(points, precision=5):
+    """Encode (lat, lng) points with the Google encoded polyline algorithm"""
+    factor = 10 ** precision
+    encoded = []
+    previous_lat = previous_lng = 0
+    for lat, lng in points:
+        lat, lng = round(lat * factor), round(lng * factor)
+        for delta in (lat - previous_lat, lng - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous_lat, previous_lng = lat, lng
+    return ''.join(encoded)
+
+
+def decode_polyline(encoded, precision=5):
+    """Decode a Google encoded polyline into (lat, lng) points"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = value = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                value |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .geo import bbox_around, cells_for_bbox, grid_cell, haversine_m
+from .models import BusLatestLocation, RouteStop
+from .signals import locations_recorded
+
+
+class GridIndex:
+    """Points bucketed into the shared lat/lng grid for fast radius queries"""
+
+    def __init__(self):
+        self._cells = defaultdict(dict)
+        self._points = {}
+        self._lock = threading.Lock()
+        self.built_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._points)
+
+    def update(self, key, latitude, longitude):
+        latitude, longitude = float(latitude), float(longitude)
+        cell = grid_cell(latitude, longitude)
+        with self._lock:
+            previous = self._points.get(key)
+            if previous is not None and previous[2] != cell:
+                self._cells[previous[2]].pop(key, None)
+            self._points[key] = (latitude, longitude, cell)
+            self._cells[cell][key] = (latitude, longitude)
+
+    def remove(self, key):
+        with self._lock:
+            previous = self._points.pop(key, None)
+            if previous is not None:
+                self._cells[previous[2]].pop(key, None)
+
+    def nearby(self, latitude, longitude, radius_m):
+        """Return [(distance_m, key)] within radius_m of a point, nearest first.
+
+        Callers filter the keys (e.g. by is_active) before applying a limit.
+        """
+        cells = cells_for_bbox(bbox_around(latitude, longitude, radius_m))
+        found = []
+        with self._lock:
+            for cell in cells:
+                bucket = self._cells.get(cell)
+                if not bucket:
+                    continue
+                for key, (point_lat, point_lng) in bucket.items():
+                    distance = haversine_m(latitude, longitude, point_lat, point_lng)
+                    if distance <= radius_m:
+                        found.append((distance, key))
+        found.sort()
+        return found
+
+
+def build_bus_index():
+    index = GridIndex()
+    latest = BusLatestLocation.objects.values_list(
+        'bus_id', 'location__latitude', 'location__longitude'
+    )
+    for bus_id, latitude, longitude in latest:
+        index.update(bus_id, latitude, longitude)
+    return index
+
+
+def build_stop_index():
+    index = GridIndex()
+    stops = RouteStop.objects.filter(is_active=True).values_list('id', 'latitude', 'longitude')
+    for stop_id, latitude, longitude in stops:
+        index.update(stop_id, latitude, longitude)
+    return index
+
+
+_indexes = {}
+_builders = {'buses': build_bus_index, 'stops': build_stop_index}
+_indexes_lock = threading.Lock()
+
+
+def get_index(name):
+    """Return the named index, rebuilding it from the database when missing or too old.
+
+    Fixes written by this process update the bus index as they arrive; the
+    periodic rebuild picks up fixes written by other worker processes.
+    """
+    max_age = getattr(settings, 'BUS_SPATIAL_INDEX_MAX_AGE', 30)
+    index = _indexes.get(name)
+    if index is None or time.monotonic() - index.built_at > max_age:
+        with _indexes_lock:
+            index = _indexes.get(name)
+            if index is None or time.monotonic() - index.built_at > max_age:
+                index = _indexes[name] = _builders[name]()
+    return index
+
+
+@receiver(locations_recorded)
+def index_recorded_locations(sender, locations, **kwargs):
+    index = _indexes.get('buses')
+    if index is None:
+        return
+    for location in locations:
+        index.update(location.bus_id, location.latitude, location.longitude)
+
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def invalidate_stop_index(sender, **kwargs):
+    _indexes.pop('stops', None)
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """Tune every new SQLite connection for concurrent ingest (BUS_SQLITE_PRAGMAS) in high-ingest mode"""
+    if connection.vendor != 'sqlite' or not getattr(settings, 'BUS_SQLITE_HIGH_INGEST', False):
+        return
+    pragmas = getattr(settings, 'BUS_SQLITE_PRAGMAS', {})
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
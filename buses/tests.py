@@ -1,3 +1,1081 @@
-from django.test import TestCase
+import contextlib
+import gzip
+import json
+import math
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+try:
+    import channels_redis  # noqa: F401
+    from fakeredis import TcpFakeServer
+except ImportError:  # Optional: the Redis channel layer test is skipped
+    TcpFakeServer = None
+
+from bus_tracking_backend.asgi import application
+
+from .binary import BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL, locations_frame, pack_location, unpack_locations
+from .broadcast import location_update_event
+from .eta import eta_engine
+from .export import EXPORT_HOP_BYTES, async_stream
+from .geo import METERS_PER_DEGREE_LAT, cell_group_name, grid_cell
+from .gtfs import GTFSFeed, import_feed
+from .gpsfilter import ACCEPT, DUPLICATE, HEARTBEAT, JUMP, LATE, STATIONARY, GPSFilter, filter_locations, gps_filter
+from .ingest import IngestQueue
+from .fleet import fleet_state
+from .mapmatch import map_matcher
+from .metrics import HTTP_QUERIES
+from .consumers import BusTrackingConsumer
+from .models import Route, Bus, BusLatestLocation, BusLocation, RouteShape, RouteStop
+from . import ingest, spatial
+from .simplify import decode_polyline
+from .retention import RetentionPolicy, archive_path, read_progress, run_retention
+from .motion import MotionTracker, locations_motion, motion_tracker
+
+
+class ListQueryCountTests(TestCase):
+    """List endpoints must issue the same number of queries however many rows they return"""
+
+    def setUp(self):
+        motion_tracker._fixes.clear()
+
+    def create_route(self, number):
+        route = Route.objects.create(route_number=str(number), name=f'Route {number}')
+        for order in range(1, 4):
+            RouteStop.objects.create(
+                route=route,
+                stop_name=f'Stop {number}-{order}',
+                latitude=Decimal('40.75') + order,
+                longitude=Decimal('-73.98'),
+                stop_order=order,
+            )
+        return route
+
+    def create_buses(self, count):
+        for _ in range(count):
+            index = Bus.objects.count()
+            route = self.create_route(index)
+            bus = Bus.objects.create(bus_number=f'B{index}', license_plate=f'P{index}', route=route)
+            for step in range(12):
+                BusLocation.objects.create(
+                    bus=bus,
+                    latitude=40.75,
+                    longitude=-73.98 + step / 1000,
+                    timestamp=timezone.now(),
+                )
+
+    def assertConstantQueries(self, url, expected):
+        self.create_buses(1)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        self.create_buses(5)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_bus_list(self):
+        buses = self.assertConstantQueries('/api/buses/', 4)
+        self.assertEqual(len(buses), 6)
+        self.assertEqual(len(buses[0]['recent_locations']), 10)
+        self.assertEqual(buses[0]['route']['buses_count'], 1)
+        self.assertEqual(len(buses[0]['route']['stops']), 3)
+        self.assertEqual(buses[0]['current_location'], buses[0]['recent_locations'][0])
+
+    def test_route_list(self):
+        routes = self.assertConstantQueries('/api/routes/', 2)
+        self.assertEqual(len(routes), 6)
+        self.assertEqual(routes[0]['buses_count'], 1)
+
+    def test_stop_list(self):
+        stops = self.assertConstantQueries('/api/stops/', 1)
+        self.assertEqual(len(stops), 18)
+
+    def test_tracking(self):
+        # Buses, then the fixes before their latest ones for the motion
+        buses = self.assertConstantQueries('/api/buses/tracking/', 2)
+        self.assertIsNotNone(buses[0]['current_location'])
+        self.assertIn('motion', buses[0]['current_location'])
+
+    def test_latest_locations(self):
+        locations = self.assertConstantQueries('/api/locations/latest/', 1)
+        self.assertEqual(len(locations), 6)
+
+
+class FleetSnapshotTests(TestCase):
+    """Tracking snapshots are cached, patched by new fixes and revalidated with ETags"""
+
+    def setUp(self):
+        motion_tracker._fixes.clear()
+        route = Route.objects.create(route_number='1', name='Route 1')
+        self.bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        self.record_location(40.75)
+
+    def record_location(self, latitude):
+        with self.captureOnCommitCallbacks(execute=True):
+            BusLocation.objects.create(bus=self.bus, latitude=latitude, longitude=-73.98, timestamp=timezone.now())
+
+    def test_unchanged_snapshot_is_not_modified(self):
+        response = self.client.get('/api/buses/tracking/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/buses/tracking/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_fix_updates_cached_snapshot(self):
+        etag = self.client.get('/api/buses/tracking/')['ETag']
+        self.record_location(40.76)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/buses/tracking/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()[0]['current_location']['latitude'], 40.76)
+
+    def test_rebuilt_and_patched_snapshots_match(self):
+        patched = self.client.get('/api/buses/tracking/').json()
+        fleet_state.reset()
+        rebuilt = self.client.get('/api/buses/tracking/').json()
+        self.assertEqual(rebuilt, patched)
+        self.assertIn('motion', rebuilt[0]['current_location'])
+
+    def test_resume_sends_only_buses_changed_since(self):
+        other = Bus.objects.create(bus_number='B2', license_plate='P2', route=self.bus.route)
+        fleet_state.reset()
+        self.record_location(40.76)
+        epoch, sequence = fleet_state.epoch, fleet_state.sequence
+        with self.captureOnCommitCallbacks(execute=True):
+            BusLocation.objects.create(bus=other, latitude=40.77, longitude=-73.98, timestamp=timezone.now())
+
+        frame = json.loads(fleet_state.resume_frame(epoch, sequence))
+
+        self.assertEqual(frame['type'], 'fleet_delta')
+        self.assertEqual(frame['sequence'], sequence + 1)
+        self.assertEqual([update['bus_id'] for update in frame['updates']], [other.id])
+        self.assertEqual(frame['updates'][0]['sequence'], sequence + 1)
+
+    def test_resume_falls_back_to_snapshot(self):
+        self.record_location(40.76)
+        for epoch, sequence in [('other-epoch', 0), (fleet_state.epoch, fleet_state.sequence + 1),
+                                (fleet_state.epoch, None)]:
+            frame = json.loads(fleet_state.resume_frame(epoch, sequence))
+            self.assertEqual(frame['type'], 'initial_data')
+            self.assertEqual(frame['epoch'], fleet_state.epoch)
+            self.assertEqual([bus['id'] for bus in frame['buses']], [self.bus.id])
+
+    def test_fleet_change_starts_a_new_epoch(self):
+        epoch = fleet_state.epoch
+        self.bus.driver_name = 'Alex'
+        self.bus.save()
+        self.assertNotEqual(fleet_state.epoch, epoch)
+        self.assertFalse(fleet_state.can_resume(epoch, fleet_state.sequence))
+
+    def test_route_must_be_a_route_id(self):
+        self.assertEqual(self.client.get('/api/buses/tracking/?route=abc').status_code, 400)
+        self.assertEqual(self.client.get('/api/buses/tracking/?route=999').status_code, 404)
+        response = self.client.get(f'/api/buses/tracking/?route={self.bus.route_id}')
+        self.assertEqual([bus['id'] for bus in response.json()], [self.bus.pk])
+
+
+class LatestLocationTests(TestCase):
+    """The latest-location table follows inserts and deletes of fixes"""
+
+    def setUp(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        self.bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        self.now = timezone.now()
+
+    def create_location(self, seconds_ago):
+        return BusLocation.objects.create(
+            bus=self.bus, latitude=40.75, longitude=-73.98, timestamp=self.now - timedelta(seconds=seconds_ago)
+        )
+
+    def latest_location_id(self):
+        return BusLatestLocation.objects.get(bus=self.bus).location_id
+
+    def store(self, seconds_ago):
+        """Insert a fix without recording it as the latest"""
+        location = BusLocation(bus=self.bus, latitude=40.75, longitude=-73.98,
+                               timestamp=self.now - timedelta(seconds=seconds_ago))
+        super(BusLocation, location).save()
+        return location
+
+    def test_record_is_one_conditional_upsert(self):
+        current = self.create_location(10)
+        older, newer = self.store(30), self.store(0)
+
+        # No read before the write that a concurrent writer could race
+        with self.assertNumQueries(1):
+            BusLatestLocation.objects.record([older])
+        self.assertEqual(self.latest_location_id(), current.pk)
+
+        with self.assertNumQueries(1):
+            BusLatestLocation.objects.record([newer])
+        self.assertEqual(self.latest_location_id(), newer.pk)
+
+    def test_updating_a_fix_does_not_touch_latest(self):
+        older = self.create_location(30)
+        newer = self.create_location(0)
+        older.speed = 10.0
+        with self.assertNumQueries(1):
+            older.save()
+        self.assertEqual(self.latest_location_id(), newer.pk)
+
+    def test_deleting_latest_falls_back_to_previous_fix(self):
+        older = self.create_location(30)
+        self.create_location(0).delete()
+
+        latest = BusLatestLocation.objects.get(bus=self.bus)
+        self.assertEqual(latest.location_id, older.pk)
+        self.assertEqual(latest.timestamp, older.timestamp)
+        self.assertEqual(len(self.client.get('/api/locations/latest/').json()), 1)
+
+    def test_deleting_every_fix_drops_the_bus(self):
+        self.create_location(30)
+        self.create_location(0)
+        BusLocation.objects.filter(bus=self.bus).delete()
+
+        self.assertFalse(BusLatestLocation.objects.filter(bus=self.bus).exists())
+        self.assertTrue(Bus.objects.filter(pk=self.bus.pk).exists())
+
+
+@override_settings(BUS_GPS_FILTER=False, BUS_INGEST_MODE='sync')
+class BatchIngestTests(TestCase):
+    """batch_update_locations validates every fix and stores the batch with one bulk insert"""
+
+    url = '/api/buses/batch_update_locations/'
+
+    def setUp(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        self.buses = [
+            Bus.objects.create(bus_number=f'B{number}', license_plate=f'P{number}', route=route)
+            for number in range(2)
+        ]
+        self.inactive = Bus.objects.create(bus_number='B9', license_plate='P9', route=route, is_active=False)
+
+    def fixes(self, count):
+        started = timezone.now()
+        return [
+            {'bus_id': self.buses[number % 2].id, 'lat': 40.75 + number / 1000, 'lng': -73.98,
+             'timestamp': (started + timedelta(seconds=number)).isoformat()}
+            for number in range(count)
+        ]
+
+    def post(self, fixes):
+        return self.client.post(self.url, json.dumps(fixes), content_type='application/json')
+
+    def test_json_batch(self):
+        response = self.post(self.fixes(3))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'created': 3, 'filtered': 0})
+        self.assertEqual(BusLocation.objects.count(), 3)
+        latest = BusLatestLocation.objects.get(bus=self.buses[0])
+        self.assertAlmostEqual(latest.location.latitude, 40.752)
+
+    def test_ndjson_batch(self):
+        body = '\n'.join(json.dumps(fix) for fix in self.fixes(4)) + '\n'
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 4)
+        self.assertEqual(BusLocation.objects.count(), 4)
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        # Warm the route shape cache
+        self.post(self.fixes(1))
+        motion_tracker._fixes.clear()
+        with CaptureQueriesContext(connection) as small:
+            self.post(self.fixes(2))
+        motion_tracker._fixes.clear()
+        with CaptureQueriesContext(connection) as large:
+            self.post(self.fixes(50))
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(BusLocation.objects.count(), 53)
+
+    def test_unknown_or_inactive_bus(self):
+        for bus_id in (self.inactive.id, 999):
+            fixes = self.fixes(2)
+            fixes[1]['bus_id'] = bus_id
+            response = self.post(fixes)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(str(bus_id), json.dumps(response.json()))
+        self.assertFalse(BusLocation.objects.exists())
+
+    def test_item_errors_point_at_the_item(self):
+        fixes = self.fixes(3)
+        fixes[1]['lat'] = 91
+        del fixes[2]['lng']
+
+        response = self.post(fixes)
+
+        self.assertEqual(response.status_code, 400)
+        # Keyed by the index of each invalid item
+        errors = response.json()
+        self.assertEqual(sorted(errors), ['1', '2'])
+        self.assertIn('lat', errors['1'])
+        self.assertIn('lng', errors['2'])
+        self.assertFalse(BusLocation.objects.exists())
+
+    def test_batch_size_is_capped(self):
+        with mock.patch('buses.views.MAX_LOCATION_BATCH_SIZE', 2):
+            self.assertEqual(self.post(self.fixes(3)).status_code, 400)
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertFalse(BusLocation.objects.exists())
+
+
+class TrackSimplificationTests(TestCase):
+    """?simplify=, ?max_points= and ?encoding=polyline on a bus's location history"""
+
+    def setUp(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        self.bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        started = timezone.now() - timedelta(minutes=30)
+        # 1 km north, then 1 km east, a fix every 50 m
+        self.points = [(40.75 + step * 50 / METERS_PER_DEGREE_LAT, -73.98) for step in range(21)]
+        east = 50 / (METERS_PER_DEGREE_LAT * math.cos(math.radians(self.points[-1][0])))
+        self.points += [(self.points[-1][0], -73.98 + step * east) for step in range(1, 21)]
+        BusLocation.objects.bulk_create(
+            BusLocation(bus=self.bus, latitude=latitude, longitude=longitude, timestamp=started + timedelta(seconds=index))
+            for index, (latitude, longitude) in enumerate(self.points)
+        )
+        self.url = f'/api/buses/{self.bus.id}/locations/'
+
+    def test_simplify_keeps_endpoints_and_corner(self):
+        locations = self.client.get(self.url, {'simplify': 5}).json()
+        # Newest first, like the full history
+        kept = [(location['latitude'], location['longitude']) for location in reversed(locations)]
+        self.assertEqual(kept, [self.points[0], self.points[20], self.points[-1]])
+
+    def test_max_points(self):
+        locations = self.client.get(self.url, {'max_points': 2}).json()
+        self.assertEqual(len(locations), 2)
+        self.assertEqual((locations[-1]['latitude'], locations[-1]['longitude']), self.points[0])
+        self.assertEqual((locations[0]['latitude'], locations[0]['longitude']), self.points[-1])
+
+    def test_polyline_encoding(self):
+        data = self.client.get(self.url, {'encoding': 'polyline', 'max_points': 10}).json()
+
+        decoded = decode_polyline(data['polyline'])
+        self.assertEqual((data['points'], data['original_points']), (len(decoded), len(self.points)))
+        self.assertLessEqual(len(decoded), 10)
+        for actual, expected in ((decoded[0], self.points[0]), (decoded[-1], self.points[-1])):
+            self.assertAlmostEqual(actual[0], expected[0], places=5)
+            self.assertAlmostEqual(actual[1], expected[1], places=5)
+
+    def test_invalid_options(self):
+        self.assertEqual(self.client.get(self.url, {'max_points': 1}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'encoding': 'geojson'}).status_code, 400)
+
+
+class GroupCommitTests(SimpleTestCase):
+    """Submissions resolve once the single writer has stored all of their fixes"""
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.queue = IngestQueue(max_size=10, batch_size=2, flush_interval=0, writer=self.write)
+        self.addCleanup(self.queue.stop)
+
+    def write(self, locations):
+        self.release.wait(5)
+        self.batches.append(list(locations))
+
+    def test_submission_spanning_batches_waits_for_the_last(self):
+        first = self.queue.submit(['a1'])
+        second = self.queue.submit(['b1', 'b2', 'b3'])
+        self.release.set()
+
+        second.result(5)
+        self.assertTrue(first.done())
+        self.assertGreater(len(self.batches), 1)
+        self.assertEqual([location for batch in self.batches for location in batch], ['a1', 'b1', 'b2', 'b3'])
+
+    def test_full_queue_rejects(self):
+        self.assertIsNone(self.queue.submit(['x'] * 11))
+        self.release.set()
+
+    def test_dead_writer_fails_its_batch_and_is_replaced(self):
+        class WriterDied(BaseException):
+            pass
+
+        def die(locations):
+            raise WriterDied()
+
+        self.queue.writer = die
+        with self.assertLogs('buses.ingest', 'ERROR'):
+            with self.assertRaises(WriterDied):
+                self.queue.submit(['a1']).result(5)
+        self.queue._thread.join(5)
+
+        self.queue.writer = self.write
+        self.release.set()
+        self.queue.submit(['b1']).result(5)
+        self.assertEqual(self.batches, [['b1']])
+
+
+class GroupCommitTimeoutTests(TestCase):
+    """A group-commit request whose transaction doesn't finish in time gets a 503"""
+
+    @override_settings(BUS_INGEST_MODE='group', BUS_INGEST_COMMIT_TIMEOUT=0.1, BUS_GPS_FILTER=False)
+    def test_commit_timeout_answers_503(self):
+        release = threading.Event()
+        stuck = IngestQueue(max_size=10, batch_size=10, flush_interval=0, writer=lambda locations: release.wait(5))
+        self.addCleanup(stuck.stop)
+        self.addCleanup(release.set)
+        self.addCleanup(setattr, ingest, '_ingest_queue', ingest._ingest_queue)
+        ingest._ingest_queue = stuck
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+
+        response = self.client.post(f'/api/buses/{bus.id}/update_location/',
+                                    {'latitude': 40.75, 'longitude': -73.98}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class MotionTests(TestCase):
+    """Fixes without a reported heading are dead-reckoned from the previous fix"""
+
+    def test_heading_and_speed_derived_from_previous_fix(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        started = timezone.now()
+        BusLocation.objects.create(bus=bus, latitude=40.75, longitude=-73.98, timestamp=started)
+        location = BusLocation(
+            bus=bus, latitude=40.75 + 100 / METERS_PER_DEGREE_LAT, longitude=-73.98,
+            timestamp=started + timedelta(seconds=10),
+        )
+
+        motion = MotionTracker().motion(location)
+
+        self.assertAlmostEqual(motion['speed_mps'], 10, places=1)
+        self.assertEqual(motion['heading'], 0)
+        self.assertEqual(motion['predicted'][-1]['offset'], 30)
+        self.assertAlmostEqual(motion['predicted'][-1]['latitude'], location.latitude + 300 / METERS_PER_DEGREE_LAT, places=5)
+        self.assertAlmostEqual(motion['predicted'][-1]['longitude'], -73.98, places=6)
+
+    def test_previous_fixes_of_a_batch_read_in_one_query(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        started = timezone.now()
+        locations = []
+        for number in range(5):
+            bus = Bus.objects.create(bus_number=f'B{number}', license_plate=f'P{number}', route=route)
+            BusLocation.objects.create(bus=bus, latitude=40.75, longitude=-73.98, timestamp=started)
+            locations.append(BusLocation(bus=bus, latitude=40.75 + 100 / METERS_PER_DEGREE_LAT, longitude=-73.98,
+                                         timestamp=started + timedelta(seconds=10)))
+        # Nothing remembered in memory, as in a freshly started worker
+        motion_tracker._fixes.clear()
+
+        with self.assertNumQueries(1):
+            locations_motion(locations)
+        self.assertEqual([location.motion['heading'] for location in locations], [0] * 5)
+
+    @override_settings(BUS_GPS_FILTER=False, BUS_INGEST_MODE='sync')
+    async def test_stale_fix_on_async_ingest(self):
+        """A fix older than the stored latest one is broadcast with motion from the fix before it"""
+        motion_tracker._fixes.clear()
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        bus = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            await BusLocation.objects.acreate(bus=bus, latitude=40.75, longitude=-73.98,
+                                              timestamp=now - timedelta(seconds=10))
+            newer = await BusLocation.objects.acreate(bus=bus, latitude=40.76, longitude=-73.98,
+                                                      timestamp=now + timedelta(minutes=1))
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add('bus_tracking', channel)
+
+        # The ingest serializer takes no timestamp: the fix is stamped now, before the stored latest one
+        latitude = 40.75 + 100 / METERS_PER_DEGREE_LAT
+        with self.captureOnCommitCallbacks(execute=True):
+            response = await self.async_client.post(
+                f'/api/ingest/buses/{bus.id}/location/',
+                {'latitude': latitude, 'longitude': -73.98},
+                content_type='application/json',
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((await BusLatestLocation.objects.aget(bus=bus)).location_id, newer.pk)
+        update = json.loads((await channel_layer.receive(channel))['update'])
+        await channel_layer.group_discard('bus_tracking', channel)
+        self.assertAlmostEqual(update['location']['latitude'], latitude)
+        self.assertEqual(update['location']['motion']['heading'], 0)
+        self.assertAlmostEqual(update['location']['motion']['speed_mps'], 10, delta=0.5)
+
+
+class ArrivalTests(TestCase):
+    """Recorded fixes update the arrival predictions of the stops ahead of the bus"""
+
+    def setUp(self):
+        for state in (eta_engine._paths, eta_engine._buses, eta_engine._arrivals, eta_engine._warmed_routes):
+            state.clear()
+        self.route = Route.objects.create(route_number='1', name='Route 1')
+        # Three stops 1 km apart, heading north
+        self.stops = [
+            RouteStop.objects.create(route=self.route, stop_name=f'Stop {order}', stop_order=order,
+                                     latitude=Decimal(40.75 + order * 1000 / METERS_PER_DEGREE_LAT),
+                                     longitude=Decimal('-73.98'))
+            for order in range(3)
+        ]
+
+    def record(self, bus_number, meters):
+        bus = Bus.objects.create(bus_number=bus_number, license_plate=bus_number, route=self.route)
+        with self.captureOnCommitCallbacks(execute=True):
+            BusLocation.objects.create(bus=bus, latitude=40.75 + meters / METERS_PER_DEGREE_LAT, longitude=-73.98,
+                                       speed=36.0, timestamp=timezone.now())
+        return bus
+
+    async def receive_arrivals(self, channel):
+        return json.loads((await get_channel_layer().receive(channel))['text'])
+
+    def test_arrivals_at_stop(self):
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'route_{self.route.id}', channel)
+        self.addCleanup(async_to_sync(channel_layer.group_discard), f'route_{self.route.id}', channel)
+
+        behind = self.record('B1', 500)
+        ahead = self.record('B2', 1200)
+
+        response = self.client.get(f'/api/stops/{self.stops[2].id}/arrivals/')
+        arrivals = response.json()['arrivals']
+        self.assertEqual([arrival['bus_id'] for arrival in arrivals], [ahead.id, behind.id])
+        self.assertAlmostEqual(arrivals[0]['distance_m'], 800, delta=5)
+        self.assertAlmostEqual(arrivals[0]['seconds_away'], 80, delta=2)
+        self.assertAlmostEqual(arrivals[1]['distance_m'], 1500, delta=5)
+        self.assertAlmostEqual(arrivals[1]['seconds_away'], 150, delta=2)
+        # Both buses have passed the first stop
+        self.assertEqual(self.client.get(f'/api/stops/{self.stops[0].id}/arrivals/').json()['arrivals'], [])
+
+        frame = async_to_sync(self.receive_arrivals)(channel)
+        self.assertEqual(frame['type'], 'stop_arrivals')
+        self.assertEqual(frame['buses'][0]['bus_id'], behind.id)
+        self.assertEqual([arrival['stop_id'] for arrival in frame['buses'][0]['arrivals']],
+                         [self.stops[1].id, self.stops[2].id])
+
+
+@override_settings(BUS_GPS_FILTER=False, BUS_INGEST_MODE='sync')
+class AsyncIngestTests(TestCase):
+    """The async ingest view stores, queues or rejects a single fix"""
+
+    async def create_bus(self, is_active=True):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        return await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route, is_active=is_active)
+
+    async def post(self, bus_id, body):
+        return await self.async_client.post(f'/api/ingest/buses/{bus_id}/location/', body,
+                                            content_type='application/json')
+
+    async def test_stored(self):
+        bus = await self.create_bus()
+
+        response = await self.post(bus.id, {'latitude': 40.75, 'longitude': -73.98, 'speed': 30})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['speed'], 30)
+        latest = await BusLatestLocation.objects.select_related('location').aget(bus=bus)
+        self.assertEqual((latest.location.latitude, latest.location.longitude), (40.75, -73.98))
+
+    async def test_invalid(self):
+        bus = await self.create_bus()
+
+        response = await self.post(bus.id, {'latitude': 91, 'longitude': -73.98})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('latitude', response.json())
+        self.assertEqual((await self.post(bus.id, '{"latitude": ')).status_code, 400)
+        self.assertFalse(await BusLocation.objects.aexists())
+
+    async def test_unknown_or_inactive_bus(self):
+        inactive = await self.create_bus(is_active=False)
+        for bus_id in (inactive.id, inactive.id + 1):
+            response = await self.post(bus_id, {'latitude': 40.75, 'longitude': -73.98})
+            self.assertEqual(response.status_code, 404)
+
+    @override_settings(BUS_INGEST_MODE='queued')
+    async def test_queued(self):
+        bus = await self.create_bus()
+        written = []
+        queue = IngestQueue(max_size=1, batch_size=1, flush_interval=0, writer=written.extend)
+        self.addCleanup(queue.stop)
+        queue._ensure_started = lambda: None  # keep fixes pending
+
+        with mock.patch('buses.views.get_ingest_queue', return_value=queue):
+            response = await self.post(bus.id, {'latitude': 40.75, 'longitude': -73.98})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(queue.depth(), 1)
+
+            response = await self.post(bus.id, {'latitude': 40.76, 'longitude': -73.98})
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response)
+        self.assertFalse(await BusLocation.objects.aexists())
+
+
+class GPSFilterTests(SimpleTestCase):
+    """The ingest filter drops repeats, jitter and impossible jumps per bus"""
+
+    def setUp(self):
+        self.filter = GPSFilter()
+        self.started = timezone.now()
+
+    def check(self, seconds, meters_north, accuracy=5, remember=True):
+        location = BusLocation(
+            bus_id=1, latitude=40.75 + meters_north / METERS_PER_DEGREE_LAT, longitude=-73.98,
+            accuracy=accuracy, timestamp=self.started + timedelta(seconds=seconds),
+        )
+        verdict = self.filter.check(location)
+        if remember:
+            self.filter.remember([location])
+        return verdict
+
+    def test_verdicts(self):
+        self.assertEqual(self.check(0, 0), ACCEPT)
+        self.assertEqual(self.check(0, 0), DUPLICATE)
+        self.assertEqual(self.check(5, 3), STATIONARY)
+        self.assertEqual(self.check(10, 60), ACCEPT)
+        self.assertEqual(self.check(11, 5000), JUMP)
+        self.assertEqual(self.check(75, 62), HEARTBEAT)
+
+    def test_repeated_jumps_restart_the_track(self):
+        self.check(0, 0)
+        self.assertEqual(self.check(1, 5000), JUMP)
+        self.assertEqual(self.check(2, 5010), JUMP)
+        self.assertEqual(self.check(3, 5020), ACCEPT)
+        self.assertEqual(self.check(8, 5060), ACCEPT)
+
+    def test_state_only_changes_once_a_fix_is_stored(self):
+        self.assertEqual(self.check(0, 0), ACCEPT)
+        # The write of this fix failed; the client's retry is not a duplicate
+        self.assertEqual(self.check(10, 60, remember=False), ACCEPT)
+        self.assertEqual(self.check(10, 60), ACCEPT)
+        self.assertEqual(self.check(10, 60), DUPLICATE)
+        self.assertEqual(self.check(5, 30), LATE)
+
+    @override_settings(BUS_GPS_FILTER=True)
+    def test_queued_fix_remembered_only_after_its_write(self):
+        location = BusLocation(bus_id=1, latitude=40.75, longitude=-73.98, accuracy=5, timestamp=self.started)
+        self.addCleanup(gps_filter._tracks.pop, 1, None)
+
+        with mock.patch.object(BusLocation.objects, 'bulk_record', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                ingest.write_locations(filter_locations([location], 'batch'))
+        self.assertEqual(gps_filter.check(location), ACCEPT)
+
+        with mock.patch.object(BusLocation.objects, 'bulk_record'), mock.patch.object(ingest, 'broadcast_location_batch'):
+            ingest.write_locations(filter_locations([location], 'batch'))
+        self.assertEqual(gps_filter.check(location), DUPLICATE)
+
+
+class MapMatchTests(TestCase):
+    """Stored fixes are snapped onto their route's shape"""
+
+    def test_fix_projected_onto_shape(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        shape = RouteShape(route=route, shape_id='S1')
+        # 1 km due north, then 1 km due east
+        corner = 40.75 + 1000 / METERS_PER_DEGREE_LAT
+        east = -73.98 + 1000 / (METERS_PER_DEGREE_LAT * math.cos(math.radians(corner)))
+        shape.set_points([(40.75, -73.98), (corner, -73.98), (corner, east)])
+        shape.save()
+        self.assertAlmostEqual(shape.length_m, 2000, delta=5)
+
+        # 20 m west of the northbound leg, 400 m in
+        offset = 20 / (METERS_PER_DEGREE_LAT * math.cos(math.radians(40.75)))
+        location = BusLocation.objects.create(
+            bus=bus, latitude=40.75 + 400 / METERS_PER_DEGREE_LAT, longitude=-73.98 - offset,
+            timestamp=timezone.now(),
+        )
+        self.assertAlmostEqual(location.distance_along_route, 400, delta=1)
+        self.assertAlmostEqual(location.matched_longitude, -73.98, places=5)
+
+        far = BusLocation.objects.create(bus=bus, latitude=40.70, longitude=-73.98, timestamp=timezone.now())
+        self.assertIsNone(far.distance_along_route)
+
+    @override_settings(BUS_MAP_MATCH_SHAPE_MAX_AGE=0)
+    def test_shape_written_elsewhere_picked_up(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        first = BusLocation.objects.create(bus=bus, latitude=40.7509, longitude=-73.98, timestamp=timezone.now())
+        self.assertIsNone(first.distance_along_route)
+
+        # As import_gtfs writes it: bulk_create sends no post_save
+        shape = RouteShape(route=route, shape_id='S1')
+        shape.set_points([(40.75, -73.98), (40.76, -73.98)])
+        RouteShape.objects.bulk_create([shape])
+
+        second = BusLocation.objects.create(bus=bus, latitude=40.7509, longitude=-73.98, timestamp=timezone.now())
+        self.assertAlmostEqual(second.distance_along_route, 0.0009 * METERS_PER_DEGREE_LAT, delta=1)
+
+
+class GTFSImportTests(TestCase):
+    """import_feed upserts routes, their stops and shapes from a feed"""
+
+    def write_feed(self, directory, stop_times, **overrides):
+        files = {
+            'routes.txt': 'route_id,route_short_name,route_long_name,route_color\nR1,42,Crosstown,FF0000\n',
+            'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\nA,First,40.75,-73.98\nB,Second,40.76,-73.98\n'
+                         'C,Third,40.77,-73.98\n',
+            'trips.txt': 'route_id,service_id,trip_id,shape_id\nR1,wk,T1,S1\nR1,wk,T2,S1\n',
+            'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n' + stop_times,
+            'shapes.txt': 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\nS1,40.77,-73.98,2\nS1,40.75,-73.98,1\n',
+        }
+        files.update({f'{name}.txt': content for name, content in overrides.items()})
+        for name, content in files.items():
+            with open(os.path.join(directory, name), 'w') as handle:
+                handle.write(content)
+
+    def import_directory(self, directory, log=None):
+        with GTFSFeed(directory) as feed:
+            return import_feed(feed, chunk_size=2, log=log)
+
+    def test_import_and_reimport(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_feed(directory, 'T1,08:00:00,,B,20\nT1,07:55:00,,A,10\nT1,24:05:00,,C,30\nT2,09:00:00,,A,1\n')
+            stats = self.import_directory(directory)
+
+            route = Route.objects.get(route_number='42')
+            self.assertEqual((route.name, route.color), ('Crosstown', '#FF0000'))
+            stops = list(route.stops.order_by('stop_order').values_list('stop_order', 'stop_name', 'estimated_time'))
+            self.assertEqual([(order, name) for order, name, _ in stops], [(1, 'First'), (2, 'Second'), (3, 'Third')])
+            self.assertEqual(stops[2][2].hour, 0)
+            self.assertAlmostEqual(route.shape.length_m, 0.02 * METERS_PER_DEGREE_LAT, delta=5)
+            self.assertEqual(stats.read, 1 + 3 + 2 + 4 + 2)
+
+            # An operator's changes to fields the feed doesn't provide survive a re-import
+            Route.objects.filter(pk=route.pk).update(is_active=False, description='Diverted')
+            self.assertIsNotNone(map_matcher.index_for(route.id))
+            self.write_feed(directory, 'T1,08:00:00,,C,1\nT1,08:10:00,,A,2\n')
+            self.import_directory(directory)
+            route.refresh_from_db()
+            self.assertEqual((route.is_active, route.description, route.color), (False, 'Diverted', '#FF0000'))
+
+            self.assertEqual(Route.objects.filter(route_number='42').count(), 1)
+            # bulk_create sent no post_save, the import dropped the cached index itself
+            self.assertNotIn(route.id, map_matcher._indexes)
+            self.assertEqual(list(route.stops.order_by('stop_order').values_list('stop_name', flat=True)),
+                             ['Third', 'First'])
+
+    def test_malformed_stops_and_long_route_numbers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_feed(
+                directory, 'T1,08:00:00,,A,1\nT1,08:05:00,,B,2\nT1,08:10:00,,C,3\n',
+                routes='route_id,route_short_name,route_long_name\nR1,Crosstown Limited Express Service,Crosstown\n',
+                stops='stop_id,stop_name,stop_lat,stop_lon\nA,First,40.75,-73.98\nB,Second,north,-73.98\n'
+                      'C,Third,140.77,-73.98\n',
+            )
+            messages = []
+            self.import_directory(directory, log=messages.append)
+
+            route = Route.objects.get()
+            self.assertEqual(route.route_number, 'Crosstown Limited Ex')
+            self.assertEqual(len(route.route_number), Route._meta.get_field('route_number').max_length)
+            self.assertEqual(list(route.stops.values_list('stop_name', flat=True)), ['First'])
+            self.assertEqual(sum('skipped stop' in message for message in messages), 2)
+
+
+class MetricsTests(TestCase):
+    """Request metrics count the queries a request runs in sync_to_async threads"""
+
+    def query_sum(self, endpoint):
+        counts = HTTP_QUERIES.collect().get((endpoint,))
+        return counts[-1] if counts else 0
+
+    @override_settings(BUS_GPS_FILTER=False, BUS_INGEST_MODE='sync')
+    async def test_async_view_queries_counted(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        bus = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        before = self.query_sum('bus-ingest-location')
+
+        response = await self.async_client.post(
+            f'/api/ingest/buses/{bus.id}/location/', {'latitude': 40.75, 'longitude': -73.98},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(self.query_sum('bus-ingest-location'), before)
+
+
+class ExportTests(TestCase):
+    """Exports stream through an async iterator when served over ASGI"""
+
+    async def test_export_streams_asynchronously(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        bus = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        started = timezone.now()
+        await BusLocation.objects.abulk_create(
+            BusLocation(bus=bus, latitude=40.75, longitude=-73.98, timestamp=started - timedelta(seconds=seconds))
+            for seconds in range(5)
+        )
+
+        response = await self.async_client.get('/api/locations/export/ndjson/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['bus_id'], bus.id)
+
+    def test_csv_has_map_matched_columns(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        BusLocation.objects.create(bus=bus, latitude=40.75, longitude=-73.98, timestamp=timezone.now())
+
+        response = self.client.get('/api/locations/export/csv/')
+
+        header, row = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(header.split(',')[-3:], ['matched_latitude', 'matched_longitude', 'distance_along_route'])
+        self.assertIn('T', row.split(',')[header.split(',').index('timestamp')])
+
+    async def test_thread_hops_are_capped_by_size(self):
+        # CSV and Parquet pieces hold EXPORT_CHUNK_SIZE rows each
+        pieces = (b'x' * (EXPORT_HOP_BYTES // 3 + 1) for _ in range(10))
+        chunks = [chunk async for chunk in async_stream(pieces)]
+        self.assertEqual([len(chunk) // (EXPORT_HOP_BYTES // 3 + 1) for chunk in chunks], [3, 3, 3, 1])
+
+
+class NearbyTests(TestCase):
+    """The nearby limit counts matching rows, not index entries"""
+
+    def setUp(self):
+        spatial._indexes.clear()
+
+    def test_inactive_buses_closer_than_active_ones(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        now = timezone.now()
+        for number in range(6):
+            bus = Bus.objects.create(bus_number=f'B{number}', license_plate=f'P{number}', route=route,
+                                     is_active=number >= 3)
+            # Inactive buses 10-30 m away, active ones 40-60 m away
+            BusLocation.objects.create(bus=bus, latitude=40.75 + (number + 1) * 10 / METERS_PER_DEGREE_LAT,
+                                       longitude=-73.98, timestamp=now)
+
+        response = self.client.get('/api/buses/nearby/', {'lat': 40.75, 'lng': -73.98, 'radius': 500, 'limit': 2})
+
+        self.assertEqual([bus['bus_number'] for bus in response.json()], ['B3', 'B4'])
+
+
+class RetentionTests(TestCase):
+    """Retention resumes after the last processed day and expires in id ranges"""
+
+    def test_runs_resume_and_archive_matched_fields(self):
+        route = Route.objects.create(route_number='1', name='Route 1')
+        bus = Bus.objects.create(bus_number='B1', license_plate='P1', route=route)
+        now = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days, seconds in [(100, 0), (100, 10), (10, 0), (10, 10), (10, 20), (0, 0)]:
+            BusLocation.objects.create(bus=bus, latitude=40.75, longitude=-73.98,
+                                       timestamp=now - timedelta(days=days, seconds=-seconds))
+
+        with tempfile.TemporaryDirectory() as directory:
+            policy = RetentionPolicy(raw_days=7, keep_days=30, downsample_seconds=60,
+                                     archive_dir=directory, chunk_size=1)
+            stats = run_retention(policy, now=now)
+            self.assertEqual((stats['archived'], stats['downsampled'], stats['expired']), (5, 2, 2))
+            self.assertEqual(BusLocation.objects.count(), 2)
+
+            path = archive_path(policy, (now - timedelta(days=100)).date())
+            with gzip.open(path, 'rt') as archive:
+                record = json.loads(archive.readline())
+            self.assertIn('distance_along_route', record)
+            self.assertIn('matched_latitude', record)
+
+            # Nothing left to process until another day passes raw_days
+            with self.assertNumQueries(2):
+                stats = run_retention(policy, now=now)
+            self.assertEqual(stats['days'], 0)
+            self.assertEqual(read_progress(policy), (now - timedelta(days=8)).date())
+
+
+class WebSocketTestMixin:
+    """Helpers for tests driving the consumers through the ASGI application"""
+
+    @contextlib.asynccontextmanager
+    async def connect(self, path, subprotocols=None):
+        """Yield (communicator, accepted subprotocol) of a connected client"""
+        communicator = WebsocketCommunicator(application, path, headers=[(b'host', b'localhost')],
+                                             subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            yield communicator, subprotocol
+        finally:
+            await communicator.disconnect()
+
+    async def location_event(self, bus, latitude, longitude=-73.98, seconds=0):
+        location = BusLocation(id=int(latitude * 1e6), bus=bus, latitude=latitude, longitude=longitude,
+                               speed=20.0, timestamp=timezone.now() + timedelta(seconds=seconds))
+        return await sync_to_async(location_update_event)(location)
+
+
+class BinaryProtocolTests(WebSocketTestMixin, TestCase):
+    """Clients negotiating the binary subprotocol get packed location frames"""
+
+    def test_pack_round_trip(self):
+        timestamp = timezone.now()
+        for heading in (None, 359.99):
+            location = BusLocation(bus_id=7, latitude=40.7589123, longitude=-73.9851456, speed=32.5,
+                                   heading=heading, timestamp=timestamp)
+            location.fleet_sequence = 42
+
+            [unpacked] = unpack_locations(locations_frame([pack_location(location)]))
+
+            self.assertEqual(unpacked['bus_id'], 7)
+            self.assertEqual(unpacked['sequence'], 42)
+            self.assertAlmostEqual(unpacked['latitude'], 40.7589123, places=7)
+            self.assertAlmostEqual(unpacked['longitude'], -73.9851456, places=7)
+            self.assertAlmostEqual(unpacked['speed'], 32.5, places=5)
+            self.assertEqual(unpacked['heading'], heading)
+            self.assertEqual(unpacked['timestamp_ms'], round(timestamp.timestamp() * 1000))
+
+    async def test_subprotocol_selects_frame_encoding(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        bus = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        path = f'/ws/route/{route.id}/'
+        async with self.connect(path, [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL]) as (binary, binary_protocol), \
+                self.connect(path, [JSON_SUBPROTOCOL]) as (text, text_protocol):
+            self.assertEqual((binary_protocol, text_protocol), (BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL))
+            # Snapshots stay JSON for everyone
+            for communicator in (binary, text):
+                self.assertEqual(json.loads(await communicator.receive_from())['type'], 'initial_data')
+
+            await get_channel_layer().group_send(f'route_{route.id}', await self.location_event(bus, 40.75))
+
+            frame = await binary.receive_output()
+            self.assertNotIn('text', frame)
+            self.assertEqual([update['bus_id'] for update in unpack_locations(frame['bytes'])], [bus.id])
+            update = json.loads(await text.receive_from())
+            self.assertEqual((update['type'], update['bus_id']), ('location_update', bus.id))
+
+
+class CoalescingTests(WebSocketTestMixin, TestCase):
+    """ws/buses/ sends the newest fix of each bus once per coalescing window"""
+
+    async def test_fixes_within_window_arrive_as_one_batch(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        first = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        second = await Bus.objects.acreate(bus_number='B2', license_plate='P2', route=route)
+        events = [
+            await self.location_event(first, 40.750, seconds=0),
+            await self.location_event(second, 40.760, seconds=0),
+            await self.location_event(first, 40.751, seconds=1),
+            await self.location_event(first, 40.752, seconds=2),
+        ]
+
+        with mock.patch.object(BusTrackingConsumer, 'coalesce_window_ms', 100):
+            async with self.connect('/ws/buses/') as (communicator, _):
+                self.assertEqual(json.loads(await communicator.receive_from())['type'], 'initial_data')
+                for event in events:
+                    await get_channel_layer().group_send('bus_tracking', event)
+
+                frame = json.loads(await communicator.receive_from())
+                self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+
+        self.assertEqual(frame['type'], 'locations_batch')
+        latest = {update['bus_id']: update['location']['latitude'] for update in frame['updates']}
+        self.assertEqual(latest, {first.id: 40.752, second.id: 40.760})
+
+
+@mock.patch.object(BusTrackingConsumer, 'coalesce_window_ms', 0)
+class BboxSubscriptionTests(WebSocketTestMixin, TestCase):
+    """subscribe_bbox narrows ws/buses/ to the buses inside a bounding box"""
+
+    bbox = [40.74, -73.99, 40.76, -73.97]
+
+    async def create_buses(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        self.inside = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        self.outside = await Bus.objects.acreate(bus_number='B2', license_plate='P2', route=route)
+        await BusLocation.objects.acreate(bus=self.inside, latitude=40.75, longitude=-73.98, timestamp=timezone.now())
+        await BusLocation.objects.acreate(bus=self.outside, latitude=40.80, longitude=-73.98, timestamp=timezone.now())
+
+    async def subscribe(self, communicator, bbox):
+        await communicator.send_json_to({'type': 'subscribe_bbox', 'bbox': bbox})
+        return await communicator.receive_json_from()
+
+    async def test_updates_filtered_to_bbox(self):
+        await self.create_buses()
+        channel_layer = get_channel_layer()
+        cell = cell_group_name(grid_cell(40.75, -73.98))
+        async with self.connect('/ws/buses/') as (communicator, _):
+            await communicator.receive_from()
+            frame = await self.subscribe(communicator, self.bbox)
+
+            self.assertEqual(frame['type'], 'bbox_buses')
+            self.assertEqual([bus['id'] for bus in frame['buses']], [self.inside.id])
+            # Same payload shape as snapshots and update frames
+            self.assertIn('motion', frame['buses'][0]['current_location'])
+            # A small box listens to its grid cells instead of the whole fleet
+            self.assertEqual(len(channel_layer.groups.get(cell, {})), 1)
+            self.assertFalse(channel_layer.groups.get('bus_tracking'))
+
+            await channel_layer.group_send(cell, await self.location_event(self.inside, 40.751))
+            self.assertEqual(json.loads(await communicator.receive_from())['bus_id'], self.inside.id)
+            await channel_layer.group_send(cell, await self.location_event(self.outside, 40.80))
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+
+            # Leaving the box: one last update, then silence
+            await channel_layer.group_send(cell, await self.location_event(self.inside, 40.80, seconds=1))
+            self.assertEqual(json.loads(await communicator.receive_from())['location']['latitude'], 40.80)
+            await channel_layer.group_send(cell, await self.location_event(self.inside, 40.81, seconds=2))
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+
+            frame = await self.subscribe(communicator, None)
+            self.assertEqual(frame, {'type': 'bbox_buses', 'bbox': None, 'buses': []})
+            self.assertFalse(channel_layer.groups.get(cell))
+            self.assertEqual(len(channel_layer.groups.get('bus_tracking', {})), 1)
+
+    async def test_invalid_bbox(self):
+        async with self.connect('/ws/buses/') as (communicator, _):
+            await communicator.receive_from()
+            for bbox in ([1, 2], 'north', [40.76, -73.99, 40.74, -73.97]):
+                frame = await self.subscribe(communicator, bbox)
+                self.assertEqual(frame['type'], 'error')
+            self.assertEqual(len(get_channel_layer().groups.get('bus_tracking', {})), 1)
+
+
+@skipUnless(TcpFakeServer is not None, 'needs fakeredis and channels_redis')
+class RedisChannelLayerTests(WebSocketTestMixin, TestCase):
+    """Consumers receive group messages through the Redis layer, here against the fakeredis stand-in"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    async def test_group_send_reaches_consumer(self):
+        route = await Route.objects.acreate(route_number='1', name='Route 1')
+        bus = await Bus.objects.acreate(bus_number='B1', license_plate='P1', route=route)
+        layers = {'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {'hosts': ['redis://%s:%d/0' % self.server.server_address]},
+        }}
+
+        with self.settings(CHANNEL_LAYERS=layers):
+            channel_layer = get_channel_layer()
+            self.assertNotIsInstance(channel_layer, InMemoryChannelLayer)
+            async with self.connect(f'/ws/route/{route.id}/') as (communicator, _):
+                await communicator.receive_from()
+                await channel_layer.group_send(f'route_{route.id}', await self.location_event(bus, 40.75))
+                update = json.loads(await communicator.receive_from(timeout=5))
+            await channel_layer.flush()
+
+        self.assertEqual((update['type'], update['bus_id']), ('location_update', bus.id))
 
-# Create your tests here.
@@ -9,5 +9,8 @@ router.register(r'locations', views.BusLocationViewSet)
 router.register(r'stops', views.RouteStopViewSet)
 
 urlpatterns = [
+    # Async ingest endpoint, outside the router since DRF viewsets are sync
+    path('api/ingest/buses/<int:pk>/location/', views.ingest_location, name='bus-ingest-location'),
     path('api/', include(router.urls)),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,19 +1,46 @@
+import asyncio
+import json
+import logging
+
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.utils import timezone
 from datetime import timedelta
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from django.db.models import Q
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
-from .models import Route, Bus, BusLocation, RouteStop
+from .models import Route, Bus, BusLocation, BusLatestLocation, RouteStop
+from .broadcast import broadcast_location_batch, encode_location_update, location_groups, location_update_event
+from .gpsfilter import filter_locations, remember_locations
+from .ingest import commit_timeout, get_ingest_queue, group_commit_enabled, queued_ingest_enabled
+from .pagination import LocationCursorPagination
+from .parsers import NDJSONParser
 from .serializers import (
     RouteSerializer, BusSerializer, BusLocationSerializer, 
-    BusLocationCreateSerializer, BusTrackingSerializer, RouteStopSerializer
+    BusLocationCreateSerializer, BusTrackingSerializer, RouteStopSerializer,
+    BusLocationBatchItemSerializer, FleetQuerySerializer, NearbyQuerySerializer, TrackQuerySerializer
 )
+from .simplify import encode_polyline, simplify_track
+from .eta import eta_engine
+from .fleet import fleet_state
+from .export import EXPORT_FORMATS, export_available, export_response
+from .spatial import get_index
+from .metrics import INGEST_FIXES, INGEST_SECONDS, exposition
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the number of fixes accepted in one batch request
+MAX_LOCATION_BATCH_SIZE = 5000
 
 
 class RouteViewSet(viewsets.ModelViewSet):
@@ -22,13 +49,17 @@ class RouteViewSet(viewsets.ModelViewSet):
     serializer_class = RouteSerializer
     permission_classes = [AllowAny]
 
+    def get_queryset(self):
+        queryset = Route.objects.filter(is_active=True)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.with_details()
+        return queryset
+
     @action(detail=True, methods=['get'])
     def buses(self, request, pk=None):
         """Get all active buses for this route"""
         route = self.get_object()
-        buses = route.buses.filter(is_active=True)
-        serializer = BusTrackingSerializer(buses, many=True)
-        return Response(serializer.data)
+        return fleet_snapshot_response(request, route.pk)
 
     @action(detail=True, methods=['get'])
     def stops(self, request, pk=None):
@@ -50,6 +81,8 @@ class BusViewSet(viewsets.ModelViewSet):
         route_id = self.request.query_params.get('route', None)
         if route_id is not None:
             queryset = queryset.filter(route_id=route_id)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.with_details()
         return queryset
 
     @action(detail=True, methods=['get'])
@@ -64,6 +97,17 @@ class BusViewSet(viewsets.ModelViewSet):
         
         since = timezone.now() - timedelta(hours=hours)
         locations = bus.locations.filter(timestamp__gte=since).order_by('-timestamp')
+
+        track = TrackQuerySerializer(data=request.query_params)
+        track.is_valid(raise_exception=True)
+        options = track.validated_data
+        if 'simplify' in options or 'max_points' in options or options['encoding'] == 'polyline':
+            return simplified_track_response(locations, **options)
+
+        paginator = LocationCursorPagination()
+        page = paginator.paginate_queryset(locations, request, view=self)
+        if page is not None:
+            return paginator.get_paginated_response(BusLocationSerializer(page, many=True).data)
         serializer = BusLocationSerializer(locations, many=True)
         return Response(serializer.data)
 
@@ -72,51 +116,125 @@ class BusViewSet(viewsets.ModelViewSet):
         """Update the location of a specific bus"""
         bus = self.get_object()
         serializer = BusLocationCreateSerializer(data=request.data)
-        if serializer.is_valid():
-            location = serializer.save(bus=bus)
+        with INGEST_SECONDS.time(path='single', stage='validate'):
+            valid = serializer.is_valid()
+        if valid:
+            with INGEST_SECONDS.time(path='single', stage='filter'):
+                kept = filter_locations([BusLocation(bus=bus, **serializer.validated_data)], 'single')
+            if not kept:
+                # Nothing new (duplicate, standing bus or an impossible jump)
+                INGEST_FIXES.inc(path='single', outcome='filtered')
+                return Response(serializer.data, status=status.HTTP_200_OK)
+            location = kept[0]
+
+            if queued_ingest_enabled() or group_commit_enabled():
+                return self._enqueue_locations([location], serializer.data, 'single', wait=group_commit_enabled())
+
+            with INGEST_SECONDS.time(path='single', stage='write'):
+                location.save()
+            remember_locations([location])
+            INGEST_FIXES.inc(path='single', outcome='stored')
             
-            # Broadcast the location update via WebSocket
+            # Broadcast the location update via WebSocket; heartbeats of a
+            # standing bus are only stored
             channel_layer = get_channel_layer()
-            if channel_layer:
-                location_data = BusLocationSerializer(location).data
-                
-                print(f"Broadcasting update for bus {bus.bus_number} (ID: {bus.id})")
-                
-                # Send to global bus tracking group
-                async_to_sync(channel_layer.group_send)(
-                    'bus_tracking',
-                    {
-                        'type': 'bus_location_update',
-                        'bus_id': bus.id,
-                        'bus_number': bus.bus_number,
-                        'location': location_data
-                    }
-                )
-                
-                # Send to route-specific group
-                async_to_sync(channel_layer.group_send)(
-                    f'route_{bus.route_id}',
-                    {
-                        'type': 'bus_location_update',
-                        'bus_id': bus.id,
-                        'bus_number': bus.bus_number,
-                        'location': location_data
-                    }
-                )
-                
-                print(f"Broadcast sent for bus {bus.bus_number}")
+            if getattr(location, 'suppress_broadcast', False):
+                logger.debug("Bus %s has not moved, heartbeat not broadcast", bus.bus_number)
+            elif channel_layer:
+                with INGEST_SECONDS.time(path='single', stage='broadcast'):
+                    # Encode the frame once; subscribers forward it as-is
+                    event = location_update_event(location)
+                    
+                    logger.debug("Broadcasting update for bus %s (ID: %s)", bus.bus_number, bus.id)
+                    
+                    # Send to the global, route-specific and grid cell groups
+                    for group in location_groups(location):
+                        async_to_sync(channel_layer.group_send)(group, event)
             else:
-                print("No channel layer available")
+                logger.warning("No channel layer available, location of bus %s not broadcast", bus.bus_number)
             
             return Response(serializer.data, status=status.HTTP_201_CREATED)
+        INGEST_FIXES.inc(path='single', outcome='invalid')
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def batch_update_locations(self, request):
+        """Store a batch of location fixes for many buses at once (JSON array or NDJSON)"""
+        serializer = BusLocationBatchItemSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=MAX_LOCATION_BATCH_SIZE
+        )
+        with INGEST_SECONDS.time(path='batch', stage='validate'):
+            valid = serializer.is_valid()
+        if valid:
+            received = serializer.build_locations(serializer.validated_data)
+            with INGEST_SECONDS.time(path='batch', stage='filter'):
+                locations = filter_locations(received, 'batch')
+            filtered = len(received) - len(locations)
+            if filtered:
+                INGEST_FIXES.inc(filtered, path='batch', outcome='filtered')
+            if not locations:
+                return Response({'created': 0, 'filtered': filtered}, status=status.HTTP_200_OK)
+
+            if group_commit_enabled():
+                return self._enqueue_locations(
+                    locations, {'created': len(locations), 'filtered': filtered}, 'batch', wait=True
+                )
+            if queued_ingest_enabled():
+                return self._enqueue_locations(locations, {'accepted': len(locations), 'filtered': filtered}, 'batch')
+
+            with INGEST_SECONDS.time(path='batch', stage='write'):
+                BusLocation.objects.bulk_record(locations)
+            remember_locations(locations)
+            INGEST_FIXES.inc(len(locations), path='batch', outcome='stored')
+            with INGEST_SECONDS.time(path='batch', stage='broadcast'):
+                broadcast_location_batch(locations)
+            return Response({'created': len(locations), 'filtered': filtered}, status=status.HTTP_201_CREATED)
+        INGEST_FIXES.inc(path='batch', outcome='invalid')
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['get'])
+    def ingest_stats(self, request):
+        """Get queue depth and flush latency of the background location writer"""
+        return Response(get_ingest_queue().stats())
+
+    def _enqueue_locations(self, locations, data, path, wait=False):
+        """Hand locations to the background writer, or ask the client to back off if it is full.
+
+        With ``wait`` the response is only sent once the writer has stored them.
+        """
+        ingest_queue = get_ingest_queue()
+        stored = ingest_queue.submit(locations)
+        if stored is None:
+            INGEST_FIXES.inc(len(locations), path=path, outcome='rejected')
+            return Response(
+                {'detail': 'Location ingest queue is full, retry later.'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(max(1, round(ingest_queue.flush_interval)))},
+            )
+        if wait:
+            try:
+                stored.result(timeout=commit_timeout())
+            except Exception as exc:
+                return Response(
+                    commit_failure(exc, len(locations), path),
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': '1'},
+                )
+            return Response(data, status=status.HTTP_201_CREATED)
+        INGEST_FIXES.inc(len(locations), path=path, outcome='queued')
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
     @action(detail=False, methods=['get'])
     def tracking(self, request):
-        """Get real-time tracking data for all active buses"""
-        buses = self.get_queryset()
-        serializer = BusTrackingSerializer(buses, many=True)
-        return Response(serializer.data)
+        """Get real-time tracking data for all active buses, or those of ?route="""
+        query = FleetQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return fleet_snapshot_response(request, query.validated_data.get('route'))
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """Get active buses within ?radius= meters of ?lat=&lng=, nearest first"""
+        return nearby_response(request, 'buses', self.get_queryset().with_tracking_data(), BusTrackingSerializer)
 
 
 class BusLocationViewSet(viewsets.ModelViewSet):
@@ -124,6 +242,7 @@ class BusLocationViewSet(viewsets.ModelViewSet):
     queryset = BusLocation.objects.all()
     serializer_class = BusLocationSerializer
     permission_classes = [AllowAny]
+    pagination_class = LocationCursorPagination
 
     def get_queryset(self):
         queryset = BusLocation.objects.all()
@@ -147,24 +266,42 @@ class BusLocationViewSet(viewsets.ModelViewSet):
         """Create a new location entry"""
         serializer.save()
 
+    @action(detail=False, methods=['get'], url_path=r'export/(?P<export_format>[a-z]+)')
+    def export(self, request, export_format=None):
+        """Stream location history as NDJSON, CSV or Parquet (same filters as the list)"""
+        if not export_available(export_format):
+            available = [name for name in EXPORT_FORMATS if export_available(name)]
+            return Response(
+                {'detail': f"Unsupported export format '{export_format}'. Available: {', '.join(available)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return export_response(
+            self.get_queryset(), export_format, 'bus_locations',
+            asynchronous=isinstance(request._request, ASGIRequest),
+        )
+
     @action(detail=False, methods=['get'])
     def latest(self, request):
         """Get the latest location for each active bus"""
-        buses = Bus.objects.filter(is_active=True)
+        latest = (
+            BusLatestLocation.objects
+            .filter(bus__is_active=True)
+            .select_related('location', 'bus__route')
+            .order_by('bus__bus_number')
+        )
         latest_locations = []
-        
-        for bus in buses:
-            location = bus.current_location
-            if location:
-                data = BusLocationSerializer(location).data
-                data['bus_info'] = {
-                    'id': bus.id,
-                    'bus_number': bus.bus_number,
-                    'route_number': bus.route.route_number,
-                    'route_color': bus.route.color
-                }
-                latest_locations.append(data)
-        
+
+        for entry in latest:
+            bus = entry.bus
+            data = BusLocationSerializer(entry.location).data
+            data['bus_info'] = {
+                'id': bus.id,
+                'bus_number': bus.bus_number,
+                'route_number': bus.route.route_number,
+                'route_color': bus.route.color
+            }
+            latest_locations.append(data)
+
         return Response(latest_locations)
 
 
@@ -180,3 +317,173 @@ class RouteStopViewSet(viewsets.ModelViewSet):
         if route_id is not None:
             queryset = queryset.filter(route_id=route_id)
         return queryset.order_by('route', 'stop_order')
+
+    @action(detail=True, methods=['get'])
+    def arrivals(self, request, pk=None):
+        """Get predicted arrivals of buses at this stop, soonest first"""
+        stop = self.get_object()
+        now = timezone.now()
+        arrivals = [
+            {
+                'bus_id': arrival['bus_id'],
+                'bus_number': arrival['bus_number'],
+                'eta': arrival['eta'],
+                'seconds_away': max(0, round((arrival['eta'] - now).total_seconds())),
+                'distance_m': arrival['distance_m'],
+            }
+            for arrival in eta_engine.arrivals_for_stop(stop)
+        ]
+        return Response({'stop_id': stop.id, 'route_id': stop.route_id, 'arrivals': arrivals})
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """Get active stops within ?radius= meters of ?lat=&lng=, nearest first"""
+        return nearby_response(request, 'stops', self.get_queryset(), RouteStopSerializer)
+
+
+@csrf_exempt
+@require_POST
+async def ingest_location(request, pk):
+    """Async counterpart of BusViewSet.update_location for high-concurrency GPS posts.
+
+    Runs on the event loop: the only thread hop is the insert itself, and the
+    broadcasts to all groups are awaited concurrently instead of one
+    async_to_sync round trip per group.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'detail': 'JSON parse error.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        bus = await Bus.objects.filter(is_active=True).only('id', 'bus_number', 'route_id').aget(pk=pk)
+    except Bus.DoesNotExist:
+        return JsonResponse({'detail': 'No Bus matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+
+    serializer = BusLocationCreateSerializer(data=data)
+    with INGEST_SECONDS.time(path='async', stage='validate'):
+        valid = serializer.is_valid()
+    if not valid:
+        INGEST_FIXES.inc(path='async', outcome='invalid')
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # In-memory and quick enough to run on the event loop
+    with INGEST_SECONDS.time(path='async', stage='filter'):
+        kept = filter_locations([BusLocation(bus=bus, **serializer.validated_data)], 'async')
+    if not kept:
+        INGEST_FIXES.inc(path='async', outcome='filtered')
+        return JsonResponse(serializer.data, status=status.HTTP_200_OK)
+    location = kept[0]
+
+    if queued_ingest_enabled() or group_commit_enabled():
+        ingest_queue = get_ingest_queue()
+        stored = ingest_queue.submit([location])
+        if stored is None:
+            INGEST_FIXES.inc(path='async', outcome='rejected')
+            response = JsonResponse(
+                {'detail': 'Location ingest queue is full, retry later.'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+            response['Retry-After'] = str(max(1, round(ingest_queue.flush_interval)))
+            return response
+        if group_commit_enabled():
+            try:
+                # Shielded: the writer still owns the future after we stop waiting
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(stored)), commit_timeout())
+            except Exception as exc:
+                response = JsonResponse(commit_failure(exc, 1, 'async'), status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                response['Retry-After'] = '1'
+                return response
+            return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        INGEST_FIXES.inc(path='async', outcome='queued')
+        return JsonResponse(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    with INGEST_SECONDS.time(path='async', stage='write'):
+        await location.asave()
+    remember_locations([location])
+    INGEST_FIXES.inc(path='async', outcome='stored')
+
+    channel_layer = get_channel_layer()
+    if channel_layer and not getattr(location, 'suppress_broadcast', False):
+        with INGEST_SECONDS.time(path='async', stage='broadcast'):
+            if getattr(location, 'encoded_update', None) is None:
+                # Not encoded when it was recorded (e.g. not newer than the stored latest fix);
+                # its motion may need the previous fix from the database
+                await sync_to_async(encode_location_update)(location)
+            event = location_update_event(location)
+            await asyncio.gather(*(channel_layer.group_send(group, event) for group in location_groups(location)))
+
+    return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def commit_failure(exc, count, path):
+    """Body of the 503 for group-commit fixes whose transaction timed out or failed"""
+    if isinstance(exc, TimeoutError):
+        INGEST_FIXES.inc(count, path=path, outcome='timeout')
+        return {'detail': 'Timed out waiting for the location to be stored, retry later.'}
+    # The writer already counted the fixes as failed
+    return {'detail': 'The location could not be stored, retry later.'}
+
+
+def metrics(request):
+    """Process metrics in the Prometheus text exposition format"""
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def fleet_snapshot_response(request, route_id=None):
+    """Serve the cached fleet snapshot, or 304 when the client's ETag still matches"""
+    try:
+        _, buses, etag = fleet_state.snapshot(route_id)
+    except Route.DoesNotExist:
+        raise Http404('No such route.')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(buses, content_type='application/json')
+    response['ETag'] = etag
+    # Pollers must revalidate, which costs them nothing when no bus moved
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def simplified_track_response(locations, simplify=0.0, max_points=None, encoding='json'):
+    """Douglas-Peucker a location history and return it as locations or an encoded polyline"""
+    rows = list(locations.order_by('timestamp').values(*BusLocationSerializer.Meta.fields))
+    points = [(float(row['latitude']), float(row['longitude'])) for row in rows]
+    kept = simplify_track(points, simplify, max_points)
+
+    if encoding == 'polyline':
+        return Response({
+            'polyline': encode_polyline([points[index] for index in kept]),
+            'points': len(kept),
+            'original_points': len(rows),
+        })
+    # Newest first, like the unsimplified history
+    kept_locations = [BusLocation(**rows[index]) for index in reversed(kept)]
+    return Response(BusLocationSerializer(kept_locations, many=True).data)
+
+
+def nearby_response(request, index_name, queryset, serializer_class):
+    """Look up ids in the in-memory spatial index, then load just those rows.
+
+    The index also holds rows the queryset excludes (inactive, other routes),
+    so candidates are checked against it nearest first, ``2 * limit`` at a
+    time, until ``limit`` of them match.
+    """
+    query = NearbyQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+    limit = params['limit']
+
+    found = get_index(index_name).nearby(params['lat'], params['lng'], params['radius'])
+    results = []
+    for start in range(0, len(found), 2 * limit):
+        candidates = found[start:start + 2 * limit]
+        objects = queryset.in_bulk([key for _, key in candidates])
+        for distance, key in candidates:
+            if key in objects:
+                data = serializer_class(objects[key]).data
+                data['distance_m'] = round(distance, 1)
+                results.append(data)
+                if len(results) == limit:
+                    return Response(results)
+    return Response(results)
@@ -77,6 +77,48 @@ const createStopIcon = (color = "#666666", stopNumber = "") => {
   });
 };
 
+// Stamp a location with the time it arrived, the start of its animation
+const received = (location) =>
+  location ? { ...location, receivedAt: Date.now() } : location;
+
+// Where a bus should be drawn now: walk the server's predicted positions
+// (location.motion, seconds after the fix) for the time since the fix arrived,
+// and hold the last one once the prediction runs out
+const animatedPosition = (location, now) => {
+  const start = [parseFloat(location.latitude), parseFloat(location.longitude)];
+  const motion = location.motion;
+  if (!motion || !motion.predicted?.length || !location.receivedAt) {
+    return start;
+  }
+
+  const elapsed = Math.min((now - location.receivedAt) / 1000, motion.valid_for);
+  let previous = { offset: 0, latitude: start[0], longitude: start[1] };
+  for (const point of motion.predicted) {
+    if (elapsed <= point.offset) {
+      const t = (elapsed - previous.offset) / (point.offset - previous.offset);
+      return [
+        previous.latitude + (point.latitude - previous.latitude) * t,
+        previous.longitude + (point.longitude - previous.longitude) * t,
+      ];
+    }
+    previous = point;
+  }
+  return [previous.latitude, previous.longitude];
+};
+
+// Apply {bus_id, location} updates to a list of buses
+const applyUpdates = (buses, updates) => {
+  if (!updates.length) return buses;
+  const locations = new Map(
+    updates.map((update) => [update.bus_id, received(update.location)])
+  );
+  return buses.map((bus) =>
+    locations.has(bus.id)
+      ? { ...bus, current_location: locations.get(bus.id) }
+      : bus
+  );
+};
+
 // Component to update map view when data changes
 function MapUpdater({ buses, selectedRoute }) {
   const map = useMap();
@@ -109,8 +151,15 @@ function BusMap({ buses = [], routes = [], selectedRoute }) {
   const [selectedBus, setSelectedBus] = useState(null);
   const [showRoutes, setShowRoutes] = useState(true);
   const [showStops, setShowStops] = useState(true);
+  const [now, setNow] = useState(Date.now());
   const mapRef = useRef();
 
+  // Redraw moving buses a few times a second between fixes
+  useEffect(() => {
+    const timer = setInterval(() => setNow(Date.now()), 250);
+    return () => clearInterval(timer);
+  }, []);
+
   useEffect(() => {
     setRealTimeBuses(buses);
   }, [buses]);
@@ -126,20 +175,29 @@ function BusMap({ buses = [], routes = [], selectedRoute }) {
             if (bus.id === data.bus_id) {
               return {
                 ...bus,
-                current_location: data.location,
+                current_location: received(data.location),
               };
             }
             return bus;
           })
         );
-      } else if (data.type === "buses_update") {
-        setRealTimeBuses(data.buses);
-      } else if (data.type === "initial_data") {
-        setRealTimeBuses(data.buses);
+      } else if (
+        data.type === "locations_batch" ||
+        data.type === "fleet_delta"
+      ) {
+        setRealTimeBuses((prevBuses) => applyUpdates(prevBuses, data.updates));
+      } else if (
+        data.type === "buses_update" ||
+        data.type === "initial_data"
+      ) {
+        // Snapshots may be a few seconds old; updates bring them current
+        setRealTimeBuses(applyUpdates(data.buses, data.updates || []));
       }
     };
 
     webSocketService.on("location_update", handleLocationUpdate);
+    webSocketService.on("locations_batch", handleLocationUpdate);
+    webSocketService.on("fleet_delta", handleLocationUpdate);
     webSocketService.on("buses_update", handleLocationUpdate);
     webSocketService.on("initial_data", handleLocationUpdate);
 
@@ -152,6 +210,8 @@ function BusMap({ buses = [], routes = [], selectedRoute }) {
 
     return () => {
       webSocketService.off("location_update", handleLocationUpdate);
+      webSocketService.off("locations_batch", handleLocationUpdate);
+      webSocketService.off("fleet_delta", handleLocationUpdate);
       webSocketService.off("buses_update", handleLocationUpdate);
       webSocketService.off("initial_data", handleLocationUpdate);
     };
@@ -197,10 +257,7 @@ function BusMap({ buses = [], routes = [], selectedRoute }) {
         {realTimeBuses.map((bus) => {
           if (!bus.current_location) return null;
 
-          const position = [
-            parseFloat(bus.current_location.latitude),
-            parseFloat(bus.current_location.longitude),
-          ];
+          const position = animatedPosition(bus.current_location, now);
 
           const routeColor = bus.route?.color || "#0066cc";
           const isSelected = selectedBus === bus.id;
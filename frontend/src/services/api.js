@@ -62,9 +62,12 @@ export const fetchBus = async (busId) => {
   }
 };
 
-export const fetchBusLocations = async (busId, hours = 24) => {
+// options: { simplify: meters, max_points: n, encoding: "polyline" }
+export const fetchBusLocations = async (busId, hours = 24, options = {}) => {
   try {
-    const response = await api.get(`/buses/${busId}/locations/?hours=${hours}`);
+    const response = await api.get(`/buses/${busId}/locations/`, {
+      params: { hours, ...options },
+    });
     return response.data;
   } catch (error) {
     console.error("Error fetching bus locations:", error);
@@ -5,11 +5,14 @@ class WebSocketService {
     this.maxReconnectAttempts = 10;
     this.reconnectAttempts = 0;
     this.listeners = {};
+    // Fleet state position, so a reconnect only receives what changed
+    this.epoch = null;
+    this.sequence = null;
   }
 
   connect(url = "ws://localhost:8001/ws/buses/") {
     try {
-      this.socket = new WebSocket(url);
+      this.socket = new WebSocket(this.resumeUrl(url));
 
       this.socket.onopen = (event) => {
         console.log("WebSocket connected");
@@ -21,6 +24,7 @@ class WebSocketService {
         try {
           const data = JSON.parse(event.data);
           console.log("WebSocket message received:", data);
+          this.trackSequence(data);
           this.emit("message", data);
 
           // Emit specific event types
@@ -59,6 +63,25 @@ class WebSocketService {
     }
   }
 
+  resumeUrl(url) {
+    if (this.epoch === null || this.sequence === null) return url;
+    const separator = url.includes("?") ? "&" : "?";
+    return `${url}${separator}epoch=${this.epoch}&sequence=${this.sequence}`;
+  }
+
+  trackSequence(data) {
+    if (data.epoch !== undefined) {
+      this.epoch = data.epoch;
+      this.sequence = data.sequence;
+    }
+    const updates = data.updates || (data.sequence !== undefined ? [data] : []);
+    updates.forEach((update) => {
+      if (update.sequence != null && update.sequence > this.sequence) {
+        this.sequence = update.sequence;
+      }
+    });
+  }
+
   disconnect() {
     if (this.socket) {
       this.socket.close();
@@ -109,6 +132,15 @@ class WebSocketService {
     });
   }
 
+  // Only receive updates for buses inside [south, west, north, east];
+  // pass null to receive the whole fleet again
+  subscribeBbox(bbox) {
+    this.send({
+      type: "subscribe_bbox",
+      bbox,
+    });
+  }
+
   isConnected() {
     return this.socket && this.socket.readyState === WebSocket.OPEN;
   }
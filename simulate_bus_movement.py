@@ -40,8 +40,8 @@ def simulate_bus_movements():
             
             # Create location update
             location_data = {
-                'latitude': round(new_lat, 8),  # Round to 8 decimal places to fit DecimalField(max_digits=10, decimal_places=8)
-                'longitude': round(new_lng, 8), # Round to 8 decimal places to fit DecimalField(max_digits=11, decimal_places=8)
+                'latitude': new_lat,
+                'longitude': new_lng,
                 'speed': round(speed, 2),
                 'heading': round(heading, 2),
                 'accuracy': round(random.uniform(3, 10), 2)  # GPS accuracy in meters
@@ -9,6 +9,7 @@ django.setup()
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from buses.broadcast import location_update_frame
 
 def test_channel_layer():
     """Test if the channel layer is working"""
@@ -17,13 +18,14 @@ def test_channel_layer():
         print(f"✅ Channel layer found: {type(channel_layer)}")
         
         # Test sending a message
+        update = '{"bus_id": 999, "location": null, "test": true}'
         async_to_sync(channel_layer.group_send)(
             'bus_tracking',
             {
                 'type': 'bus_location_update',
                 'bus_id': 999,
-                'test': True,
-                'message': 'Test message'
+                'update': update,
+                'text': location_update_frame(update)
             }
         )
         print("✅ Test message sent successfully")